@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+# Load generation over many concurrent connections
+import asyncio
+
+# Start and stop a local memcached server
+import os.path
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+# Key distributions and values
+import bisect
+import itertools
+import random
+
+# Handle command line arguments and the results files
+import argparse
+import json
+
+from memcachedclient import AsyncConnection
+from main import isReady
+
+class KeySampler:
+    """Draw the key indexes of the benchmark requests, uniformly or following a Zipf distribution
+    where the key of rank i is requested in proportion to 1 / i^exponent, so a few keys are hot
+    """
+    DISTRIBUTIONS = ('uniform', 'zipf')
+
+    def __init__(self, keyCount, distribution='uniform', exponent=0.99, seed=None):
+        """
+        :param keyCount: number of distinct keys
+        :param distribution: one of the DISTRIBUTIONS
+        :param exponent: exponent of the Zipf distribution
+        :param seed: seed of the random generator, None for a random one
+        :no return:
+        """
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError('Unknown key distribution {}'.format(distribution))
+        self.keyCount = keyCount
+        self.random = random.Random(seed)
+        self.cumulativeWeights = None
+        if distribution == 'zipf':
+            self.cumulativeWeights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, keyCount + 1)))
+
+    def sample(self):
+        """
+        :return: key index between 0 and keyCount - 1, 0 being the hottest key of a Zipf distribution
+        """
+        if self.cumulativeWeights is None:
+            return self.random.randrange(self.keyCount)
+        return bisect.bisect_left(self.cumulativeWeights, self.random.random() * self.cumulativeWeights[-1])
+
+def percentile(sortedLatencies, fraction):
+    """
+    :param sortedLatencies: sorted list of latencies
+    :param fraction: percentile between 0 and 1
+    :return: latency at the percentile, 0 if there are none
+    """
+    if not sortedLatencies:
+        return 0
+    return sortedLatencies[min(len(sortedLatencies) - 1, int(fraction * len(sortedLatencies)))]
+
+class Benchmark:
+    """Drive a memcached server with concurrent connections that each send batches of pipelined get and set commands
+    Every command of a batch is given the latency of the whole batch, from its write to its last reply
+    A get that misses is followed by a set of its key in the next batch, like a cache-aside client, and a scan
+    reads and sets a key that is never requested again, like a batch job going through many keys once.
+    The hit ratio is the one of the gets of the benchmark keys, scans always miss
+    """
+    PERCENTILES = (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))
+
+    def __init__(self, host='127.0.0.1', port=11211, connections=50, duration=10, getRatio=0.9, valueSize=100,
+                 keyCount=10000, distribution='uniform', exponent=0.99, pipelineDepth=1, seed=None, scanRatio=0):
+        """
+        :param host: host of the memcached server
+        :param port: port of the memcached server
+        :param connections: number of concurrent connections
+        :param duration: seconds the load runs for
+        :param getRatio: fraction of the commands that are gets, the others are sets
+        :param valueSize: bytes of the values that are set
+        :param keyCount: number of distinct keys
+        :param distribution: one of the KeySampler.DISTRIBUTIONS
+        :param exponent: exponent of the Zipf distribution
+        :param pipelineDepth: commands sent in each write of a connection
+        :param seed: seed of the random generators, None for random ones
+        :param scanRatio: fraction of the commands that are scans of keys read once
+        :no return:
+        """
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.duration = duration
+        self.getRatio = getRatio
+        self.valueSize = valueSize
+        self.keyCount = keyCount
+        self.distribution = distribution
+        self.exponent = exponent
+        self.pipelineDepth = pipelineDepth
+        self.seed = seed
+        self.scanRatio = scanRatio
+        self.value = b'x' * valueSize
+        self.latencies = {b'get': [], b'set': []} # command -> nanoseconds
+        self.gets = 0 # gets of the benchmark keys, without the scans
+        self.hits = 0
+        self.scannedKeys = itertools.count()
+        self.errors = 0
+
+    def config(self):
+        """
+        :return: dictionary of the benchmark parameters
+        """
+        return {
+            'connections': self.connections,
+            'duration': self.duration,
+            'getRatio': self.getRatio,
+            'valueSize': self.valueSize,
+            'keyCount': self.keyCount,
+            'distribution': self.distribution,
+            'exponent': self.exponent,
+            'pipelineDepth': self.pipelineDepth,
+            'scanRatio': self.scanRatio,
+        }
+
+    def key(self, index):
+        return b'benchmark:%d' % index
+
+    def setCommand(self, index):
+        return self.setKeyCommand(self.key(index))
+
+    def setKeyCommand(self, key):
+        return b'set %s 0 0 %d\r\n' % (key, self.valueSize) + self.value + b'\r\n'
+
+    async def preload(self):
+        """Set every key once so the gets hit
+        """
+        connection = await AsyncConnection.open(self.host, self.port)
+        try:
+            for start in range(0, self.keyCount, 100):
+                await connection.request([(self.setCommand(index), False) for index in range(start, min(start + 100, self.keyCount))])
+        finally:
+            connection.close()
+
+    async def runConnection(self, deadline, sampler):
+        """Send batches of pipelined commands until the deadline
+        :param deadline: time.perf_counter() the load stops at
+        :param sampler: KeySampler of this connection
+        :no return:
+        """
+        connection = await AsyncConnection.open(self.host, self.port)
+        random = sampler.random
+        missedKeys = []
+        try:
+            while time.perf_counter() < deadline:
+                # The keys that missed in the previous batch are set first
+                commands = [(self.setKeyCommand(key), False) for key in missedKeys]
+                batch = [(b'set', None)] * len(missedKeys)
+                missedKeys = []
+                for index in range(self.pipelineDepth):
+                    if self.scanRatio and random.random() < self.scanRatio:
+                        key = b'scan:%d' % next(self.scannedKeys)
+                        commands.append((b'get ' + key + b'\r\n', True))
+                        batch.append((b'get', None))
+                        missedKeys.append(key)
+                        continue
+                    key = self.key(sampler.sample())
+                    if random.random() < self.getRatio:
+                        commands.append((b'get ' + key + b'\r\n', True))
+                        batch.append((b'get', key))
+                    else:
+                        commands.append((self.setKeyCommand(key), False))
+                        batch.append((b'set', None))
+                started = time.perf_counter_ns()
+                replies = await connection.request(commands)
+                latency = time.perf_counter_ns() - started
+                for (command, key), reply in zip(batch, replies):
+                    self.latencies[command].append(latency)
+                    if key is not None:
+                        self.gets += 1
+                    if reply.startswith(b'VALUE '):
+                        self.hits += 1
+                    elif reply == b'END\r\n':
+                        if key is not None:
+                            missedKeys.append(key)
+                    elif reply != b'STORED\r\n':
+                        self.errors += 1
+        finally:
+            connection.close()
+
+    async def run(self):
+        """
+        :return: dictionary of the results
+        """
+        await self.preload()
+        seed = self.seed
+        samplers = [KeySampler(self.keyCount, self.distribution, self.exponent, None if seed is None else seed + index)
+                    for index in range(self.connections)]
+        started = time.perf_counter()
+        deadline = started + self.duration
+        await asyncio.gather(*(self.runConnection(deadline, sampler) for sampler in samplers))
+        return self.results(time.perf_counter() - started)
+
+    def results(self, elapsed):
+        """
+        :param elapsed: seconds the load ran for
+        :return: dictionary of the results, the latencies are in microseconds
+        """
+        allLatencies = sorted(self.latencies[b'get'] + self.latencies[b'set'])
+        latencies = {'all': allLatencies}
+        for command, commandLatencies in self.latencies.items():
+            if commandLatencies:
+                latencies[command.decode()] = sorted(commandLatencies)
+        gets = self.gets
+        return {
+            'timestamp': int(time.time()),
+            'commit': gitCommit(),
+            'config': self.config(),
+            'elapsed': round(elapsed, 3),
+            'operations': len(allLatencies),
+            'throughput': round(len(allLatencies) / elapsed, 1) if elapsed else 0,
+            'hitRatio': round(self.hits / gets, 4) if gets else None,
+            'errors': self.errors,
+            'latencyUs': {
+                name: {percentileName: round(percentile(values, fraction) / 1000, 1) for percentileName, fraction in self.PERCENTILES}
+                for name, values in latencies.items()
+            },
+        }
+
+def gitCommit():
+    """
+    :return: commit of the benchmarked tree or None outside of a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def freePort():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def startServers(port, workers, serverArgs, timeout=10):
+    """Start local memcached server processes and wait until they serve the port
+    :param port: port to serve on
+    :param workers: number of worker processes sharing the port
+    :param serverArgs: list of extra memcachedserver.py arguments
+    :param timeout: seconds to wait for the servers to be ready
+    :return: list of Popen objects
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    processes = [subprocess.Popen([sys.executable, 'memcachedserver.py', '--port', str(port),
+                                   '--worker-index', str(workerIndex), '--worker-count', str(workers)] + serverArgs,
+                                  cwd=cwd, stdout=subprocess.DEVNULL)
+                 for workerIndex in range(workers)]
+    deadline = time.monotonic() + timeout
+    while not isReady('127.0.0.1', port):
+        if time.monotonic() > deadline or any(process.poll() is not None for process in processes):
+            stopServers(processes)
+            raise RuntimeError('the memcached server did not start')
+        time.sleep(0.1)
+    return processes
+
+def stopServers(processes):
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    for process in processes:
+        try:
+            process.wait(15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def printResults(results, baseline=None):
+    """
+    :param results: dictionary returned by Benchmark.run
+    :param baseline: results of a previous run to compare with or None
+    :no return:
+    """
+    print('{operations} operations in {elapsed}s: {throughput} ops/s, {errors} errors'.format(**results))
+    if results['hitRatio'] is not None:
+        print('hit ratio {}'.format(results['hitRatio']))
+    for name, percentiles in results['latencyUs'].items():
+        print('{:>4} latency us: {}'.format(name, ' '.join('{}={}'.format(key, value) for key, value in percentiles.items())))
+    if baseline is None:
+        return
+    print('compared with {} ({}):'.format(baseline.get('commit'), time.strftime('%Y-%m-%d %H:%M', time.localtime(baseline['timestamp']))))
+    print('  throughput {:+.1f}%'.format(change(baseline['throughput'], results['throughput'])))
+    for name, percentiles in results['latencyUs'].items():
+        baselinePercentiles = baseline['latencyUs'].get(name, {})
+        print('  {:>4} latency {}'.format(name, ' '.join('{} {:+.1f}%'.format(key, change(baselinePercentiles[key], value))
+                                                         for key, value in percentiles.items() if key in baselinePercentiles)))
+
+def change(before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the memcached server')
+    parser.add_argument('--server', type=str,
+                        help='host:port of a running memcached server, a local server is started if omitted')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes of the local server')
+    parser.add_argument('--server-args', dest='serverArgs', type=str, default='',
+                        help='extra arguments of the local memcachedserver.py, e.g. "db.sqlite --durability none"')
+    parser.add_argument('-c', '--connections', type=int, default=50, help='number of concurrent connections')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='seconds the load runs for')
+    parser.add_argument('--get-ratio', dest='getRatio', type=float, default=0.9,
+                        help='fraction of the commands that are gets, the others are sets')
+    parser.add_argument('--value-size', dest='valueSize', type=int, default=100, help='bytes of the values')
+    parser.add_argument('--keys', dest='keyCount', type=int, default=10000, help='number of distinct keys')
+    parser.add_argument('--distribution', choices=KeySampler.DISTRIBUTIONS, default='uniform',
+                        help='distribution of the requested keys')
+    parser.add_argument('--zipf-exponent', dest='exponent', type=float, default=0.99,
+                        help='exponent of the zipf distribution, larger is more skewed')
+    parser.add_argument('--pipeline', dest='pipelineDepth', type=int, default=1,
+                        help='commands sent in each write of a connection')
+    parser.add_argument('--scan-ratio', dest='scanRatio', type=float, default=0,
+                        help='fraction of the commands that read and set a key never requested again, '
+                             'to compare the eviction policies with a small memory limit')
+    parser.add_argument('--seed', type=int, help='seed of the random generators for repeatable runs')
+    parser.add_argument('-o', '--output', type=str,
+                        help='JSON file the results are written to')
+    parser.add_argument('--compare', type=str,
+                        help='JSON results file of a previous run to compare with')
+
+    args = parser.parse_args()
+
+    processes = []
+    if args.server is None:
+        host, port = '127.0.0.1', freePort()
+        processes = startServers(port, args.workers, args.serverArgs.split())
+    else:
+        host, port = args.server.rsplit(':', 1)
+        port = int(port)
+
+    benchmark = Benchmark(host, port, args.connections, args.duration, args.getRatio, args.valueSize, args.keyCount,
+                          args.distribution, args.exponent, args.pipelineDepth, args.seed, args.scanRatio)
+    try:
+        results = asyncio.run(benchmark.run())
+    finally:
+        stopServers(processes)
+    results['config']['workers'] = args.workers if processes else None
+    results['config']['serverArgs'] = args.serverArgs if processes else None
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+    printResults(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as outputFile:
+            json.dump(results, outputFile, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+# Fixed size headers of the binary protocol packets
+import struct
+
+# Requests for keys owned by another worker are forwarded as meta commands with base64 keys
+import base64
+
+REQUEST_MAGIC = 0x80
+RESPONSE_MAGIC = 0x81
+
+# magic, opcode, key length, extras length, data type, vbucket id or status, total body length, opaque, cas
+HEADER = struct.Struct('>BBHBBHIIQ')
+HEADER_SIZE = HEADER.size
+# Extras of the set requests and of the get responses
+SET_EXTRAS = struct.Struct('>II') # flags, expiration
+GET_EXTRAS = struct.Struct('>I') # flags
+
+OPCODE_GET = 0x00
+OPCODE_SET = 0x01
+OPCODE_DELETE = 0x04
+OPCODE_QUIT = 0x07
+OPCODE_GETQ = 0x09
+OPCODE_NOOP = 0x0a
+OPCODE_GETK = 0x0c
+OPCODE_GETKQ = 0x0d
+OPCODE_QUITQ = 0x17
+OPCODE_SETQ = 0x11
+OPCODE_DELETEQ = 0x14
+
+GET_OPCODES = frozenset((OPCODE_GET, OPCODE_GETQ, OPCODE_GETK, OPCODE_GETKQ))
+SET_OPCODES = frozenset((OPCODE_SET, OPCODE_SETQ))
+DELETE_OPCODES = frozenset((OPCODE_DELETE, OPCODE_DELETEQ))
+# Quiet requests don't get the replies a pipelining client doesn't need: get misses and successful sets and deletes
+QUIET_OPCODES = frozenset((OPCODE_GETQ, OPCODE_GETKQ, OPCODE_SETQ, OPCODE_DELETEQ, OPCODE_QUITQ))
+# Command names the latencies of the requests are recorded under, shared with the text protocol
+COMMAND_NAMES = dict([(opcode, b'get') for opcode in GET_OPCODES] + [(opcode, b'set') for opcode in SET_OPCODES]
+                     + [(opcode, b'delete') for opcode in DELETE_OPCODES])
+
+STATUS_OK = 0x0000
+STATUS_KEY_NOT_FOUND = 0x0001
+STATUS_KEY_EXISTS = 0x0002
+STATUS_VALUE_TOO_LARGE = 0x0003
+STATUS_INVALID_ARGUMENTS = 0x0004
+STATUS_ITEM_NOT_STORED = 0x0005
+STATUS_UNKNOWN_COMMAND = 0x0081
+STATUS_INTERNAL_ERROR = 0x0084
+
+STATUS_MESSAGES = {
+    STATUS_KEY_NOT_FOUND: b'Not found',
+    STATUS_KEY_EXISTS: b'Data exists for key.',
+    STATUS_VALUE_TOO_LARGE: b'Too large.',
+    STATUS_INVALID_ARGUMENTS: b'Invalid arguments',
+    STATUS_ITEM_NOT_STORED: b'Not stored.',
+    STATUS_UNKNOWN_COMMAND: b'Unknown command',
+    STATUS_INTERNAL_ERROR: b'Internal error',
+}
+
+class BinaryRequest:
+    """A request packet of the binary protocol: a 24 byte header followed by the extras, the key and the value
+    """
+    def __init__(self, header, body):
+        """
+        :param header: tuple unpacked from the request header with HEADER
+        :param body: bytestring of the extras, key and value
+        :no return:
+        """
+        magic, self.opcode, keyLength, extrasLength, dataType, vbucket, bodyLength, self.opaque, self.cas = header
+        self.extras = body[:extrasLength]
+        self.key = body[extrasLength:extrasLength + keyLength]
+        self.value = body[extrasLength + keyLength:]
+        self.quiet = self.opcode in QUIET_OPCODES
+        self.returnsKey = self.opcode in (OPCODE_GETK, OPCODE_GETKQ)
+        self.wellFormed = extrasLength + keyLength <= bodyLength
+
+    def response(self, status=STATUS_OK, extras=b'', key=b'', value=b'', cas=0):
+        """
+        :param status: 16 bit status of the response
+        :param extras: bytestring extras
+        :param key: bytestring key, returned by GETK and GETKQ only
+        :param value: bytestring value
+        :param cas: cas unique of the item
+        :return: bytestring response packet
+        """
+        header = HEADER.pack(RESPONSE_MAGIC, self.opcode, len(key), len(extras), 0, status,
+                             len(extras) + len(key) + len(value), self.opaque, cas)
+        return header + extras + key + value
+
+    def errorResponse(self, status):
+        """
+        :param status: 16 bit error status
+        :return: bytestring response packet whose value is the message of the status
+        """
+        return self.response(status, key=self.key if self.returnsKey else b'', value=STATUS_MESSAGES[status])
+
+    def itemResponse(self, flags, value, cas):
+        """Response of a get request hit, GETK and GETKQ return the key as well
+        :param flags: integer client flags of the item
+        :param value: bytestring value of the item
+        :param cas: cas unique of the item
+        :return: bytestring response packet
+        """
+        key = self.key if self.returnsKey else b''
+        return self.response(extras=GET_EXTRAS.pack(flags), key=key, value=value, cas=cas)
+
+    def metaCommand(self):
+        """The meta command doing the same as a get, set or delete request, to forward it to the worker owning its key
+        :return: bytestring of the command line and the data block of ms
+        """
+        key = base64.b64encode(self.key)
+        casFlag = b' C%d' % self.cas if self.cas else b''
+        if self.opcode in GET_OPCODES:
+            return b'mg ' + key + b' b f c v\r\n'
+        if self.opcode in SET_OPCODES:
+            flags, expiration = SET_EXTRAS.unpack(self.extras)
+            return b'ms %s %d b F%d T%d c%s\r\n' % (key, len(self.value), flags, expiration, casFlag) + self.value + b'\r\n'
+        return b'md ' + key + b' b' + casFlag + b'\r\n'
+
+    def metaResponse(self, reply):
+        """Convert the reply of the meta command returned by metaCommand
+        :param reply: bytestring of the meta reply
+        :return: bytestring response packet, empty if a quiet request gets no response
+        """
+        lineEnd = reply.find(b'\r\n')
+        tokens = reply[:lineEnd].split()
+        code = tokens[0] if tokens else b''
+        if code == b'VA':
+            returned = {token[:1]: token[1:] for token in tokens[2:]}
+            return self.itemResponse(int(returned[b'f']), reply[lineEnd + 2:-2], int(returned[b'c']))
+        if code == b'HD':
+            if self.quiet:
+                return b''
+            returned = {token[:1]: token[1:] for token in tokens[1:]}
+            return self.response(cas=int(returned.get(b'c', 0)))
+        if code in (b'EN', b'NF'):
+            if self.quiet and self.opcode in GET_OPCODES:
+                return b''
+            return self.errorResponse(STATUS_KEY_NOT_FOUND)
+        if code == b'EX':
+            return self.errorResponse(STATUS_KEY_EXISTS)
+        if code == b'NS':
+            return self.errorResponse(STATUS_ITEM_NOT_STORED)
+        if reply.startswith(b'SERVER_ERROR object too large'):
+            return self.errorResponse(STATUS_VALUE_TOO_LARGE)
+        return self.errorResponse(STATUS_INTERNAL_ERROR)
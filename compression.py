@@ -0,0 +1,95 @@
+# Stdlib codec of the compressed values
+import zlib
+
+# Length of the value before compression, in front of the zlib stream
+import struct
+
+# CPU time spent compressing and decompressing, reported by the stats command
+import time
+
+# Persisted alongside the client flags of a compressed value, client flags are 16 bit so this bit is never a client's
+COMPRESSED_FLAG = 1 << 16
+
+LENGTH = struct.Struct('>I')
+
+def uncompressedLength(compressed):
+    """Read from the front of the compressed value, so the length of a persisted value is known without decompressing it
+    :param compressed: bytestring or memoryview returned by ValueCompressor.compress
+    :return: bytes of the value before compression
+    """
+    return LENGTH.unpack_from(compressed)[0]
+
+def decompressValue(compressed):
+    """
+    :param compressed: bytestring returned by ValueCompressor.compress
+    :return: bytestring value
+    """
+    return zlib.decompress(memoryview(compressed)[LENGTH.size:])
+
+class ValueCompressor:
+    """Compresses the values of the items above a size threshold with zlib
+    Values are kept compressed in memory, in the database and in the snapshots, and decompressed when they're read.
+    A value that doesn't get smaller is stored as it is
+    """
+    LEVEL = 1 # Fastest zlib level, values are compressed on the event loop
+    MIN_SAVING = 0.1 # Fraction of the size a compressed value has to save to be kept compressed
+
+    def __init__(self, threshold=0, level=LEVEL):
+        """
+        :param threshold: bytes from which the values are compressed, 0 to never compress them
+        :param level: zlib compression level
+        :no return:
+        """
+        self.threshold = threshold
+        self.level = level
+        self.compressedValues = 0
+        self.uncompressedBytes = 0 # Size of the compressed values before compression
+        self.compressedBytes = 0
+        self.compressionTime = 0 # Nanoseconds
+        self.decompressions = 0
+        self.decompressionTime = 0 # Nanoseconds
+
+    def compress(self, value):
+        """
+        :param value: bytestring value
+        :return: compressed bytestring, the length of the value followed by its zlib stream, or None if the value
+                 is below the threshold or doesn't compress well
+        """
+        if not self.threshold or len(value) < self.threshold:
+            return None
+        start = time.perf_counter_ns()
+        compressed = LENGTH.pack(len(value)) + zlib.compress(value, self.level)
+        self.compressionTime += time.perf_counter_ns() - start
+        if len(compressed) > len(value) * (1 - self.MIN_SAVING):
+            return None
+        self.compressedValues += 1
+        self.uncompressedBytes += len(value)
+        self.compressedBytes += len(compressed)
+        return compressed
+
+    def decompress(self, compressed):
+        """
+        :param compressed: bytestring returned by compress
+        :return: bytestring value
+        """
+        start = time.perf_counter_ns()
+        value = decompressValue(compressed)
+        self.decompressionTime += time.perf_counter_ns() - start
+        self.decompressions += 1
+        return value
+
+    def stats(self):
+        """
+        :return: list of (name, value) of the compression stats
+        """
+        ratio = self.uncompressedBytes / self.compressedBytes if self.compressedBytes else 1
+        return [
+            ('compression_threshold', self.threshold),
+            ('compressed_values', self.compressedValues),
+            ('compression_bytes_in', self.uncompressedBytes),
+            ('compression_bytes_out', self.compressedBytes),
+            ('compression_ratio', '{:.2f}'.format(ratio)),
+            ('compression_time_us', self.compressionTime // 1000),
+            ('decompressions', self.decompressions),
+            ('decompression_time_us', self.decompressionTime // 1000),
+        ]
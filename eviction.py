@@ -0,0 +1,236 @@
+# Keys of each segment from the least to the most recently used
+from collections import OrderedDict
+
+# Fixed size counters of the frequency sketch
+from array import array
+
+# Eviction order of the segments
+from itertools import chain
+
+class LRUPolicy:
+    """Evicts the least recently used key
+    The keys are kept in order by the OrderedDict of the ItemStore itself, from the least to the most recently used
+    """
+    NAME = 'lru'
+    KEY_OVERHEAD = 0 # Bytes of bookkeeping per key on top of the ItemStore's
+
+    def __init__(self, items, memoryLimit):
+        """
+        :param items: OrderedDict of the items of the ItemStore
+        :param memoryLimit: bytes the items can use
+        :no return:
+        """
+        self.items = items
+
+    def accessed(self, key):
+        """
+        :param key: bytestring key of an item that was hit
+        :no return:
+        """
+        self.items.move_to_end(key)
+
+    def added(self, key, item):
+        """
+        :param key: bytestring key of an item just added at the end of the items
+        :param item: Item object
+        :no return:
+        """
+
+    def removed(self, key, item):
+        """
+        :param key: bytestring key of an item deleted, replaced, expired or evicted
+        :param item: Item object
+        :no return:
+        """
+
+    def victim(self):
+        """
+        :return: bytestring key of the next item to evict
+        """
+        return next(iter(self.items))
+
+    def victims(self):
+        """
+        :return: iterator of the keys from the next one to evict
+        """
+        return iter(self.items)
+
+    def stats(self):
+        """
+        :return: list of (name, value) of the policy stats
+        """
+        return []
+
+class FrequencySketch:
+    """Count-min sketch of the recent access frequency of the keys, for admission decisions
+    The 4 rows of byte counters saturate at MAX_COUNT and are all halved once the sketch counted
+    10 accesses per counter of a row, so the frequencies follow the recent accesses
+    """
+    DEPTH = 4
+    MAX_COUNT = 15
+    HALVED = bytes(count >> 1 for count in range(256))
+
+    def __init__(self, width):
+        """
+        :param width: counters per row, a power of 2
+        :no return:
+        """
+        self.mask = width - 1
+        self.rows = [array('B', bytes(width)) for _ in range(self.DEPTH)]
+        self.resetAfter = 10 * width
+        self.additions = 0
+
+    def indexes(self, key):
+        """
+        :param key: bytestring key
+        :return: list of the index of the key's counter in each row
+        """
+        keyHash = hash(key)
+        step = (keyHash >> 32) | 1
+        mask = self.mask
+        return [(keyHash + row * step) & mask for row in range(self.DEPTH)]
+
+    def increment(self, key):
+        """Count an access, only the smallest counters of the key are incremented
+        :param key: bytestring key
+        :no return:
+        """
+        counters = list(zip(self.rows, self.indexes(key)))
+        frequency = min(row[index] for row, index in counters)
+        if frequency < self.MAX_COUNT:
+            for row, index in counters:
+                if row[index] == frequency:
+                    row[index] = frequency + 1
+        self.additions += 1
+        if self.additions >= self.resetAfter:
+            self.halve()
+
+    def frequency(self, key):
+        """
+        :param key: bytestring key
+        :return: estimated recent accesses of the key, at most MAX_COUNT
+        """
+        return min(row[index] for row, index in zip(self.rows, self.indexes(key)))
+
+    def halve(self):
+        """Age every counter
+        :no return:
+        """
+        self.rows = [array('B', row.tobytes().translate(self.HALVED)) for row in self.rows]
+        self.additions //= 2
+
+class TinyLFUPolicy:
+    """W-TinyLFU: new keys enter a small LRU window, and a key leaving the window is only admitted
+    into the main space if it was accessed more often recently than the key it would evict
+    The main space is a segmented LRU: keys are admitted to the probation segment and promoted to the
+    protected segment when they're hit again. A scan of keys read once never gets past the window and
+    the probation segment, so it doesn't flush the keys that are hit repeatedly
+    """
+    NAME = 'tinylfu'
+    KEY_OVERHEAD = 120 # Bytes of the entry of a key and of its size in a segment
+    WINDOW = 0.01 # Fraction of the memory limit for the window
+    PROTECTED = 0.8 # Fraction of the main space for the protected segment
+    AVERAGE_ITEM_SIZE = 256 # Bytes, sizes the frequency sketch to about one counter per item
+
+    def __init__(self, items, memoryLimit):
+        """
+        :param items: OrderedDict of the items of the ItemStore
+        :param memoryLimit: bytes the items can use
+        :no return:
+        """
+        self.windowLimit = max(int(memoryLimit * self.WINDOW), 1)
+        self.protectedLimit = int((memoryLimit - self.windowLimit) * self.PROTECTED)
+        self.window = OrderedDict() # key -> item size, from the least to the most recently used
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+        self.windowSize = 0
+        self.protectedSize = 0
+        width = 1 << max(8, min(24, (memoryLimit // self.AVERAGE_ITEM_SIZE).bit_length()))
+        self.sketch = FrequencySketch(width)
+        self.admissions = 0
+        self.rejections = 0
+
+    def accessed(self, key):
+        """
+        :param key: bytestring key of an item that was hit
+        :no return:
+        """
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.probation:
+            size = self.probation.pop(key)
+            self.protected[key] = size
+            self.protectedSize += size
+            # The least recently used protected keys go back to probation
+            while self.protectedSize > self.protectedLimit:
+                demotedKey, demotedSize = self.protected.popitem(last=False)
+                self.protectedSize -= demotedSize
+                self.probation[demotedKey] = demotedSize
+        else:
+            self.protected.move_to_end(key)
+
+    def added(self, key, item):
+        """
+        :param key: bytestring key of an item just added
+        :param item: Item object
+        :no return:
+        """
+        self.sketch.increment(key)
+        self.window[key] = item.size
+        self.windowSize += item.size
+        # Keys leaving the window become the candidates at the end of the probation segment
+        while self.windowSize > self.windowLimit:
+            candidateKey, candidateSize = self.window.popitem(last=False)
+            self.windowSize -= candidateSize
+            self.probation[candidateKey] = candidateSize
+
+    def removed(self, key, item):
+        """
+        :param key: bytestring key of an item deleted, replaced, expired or evicted
+        :param item: Item object
+        :no return:
+        """
+        size = self.window.pop(key, None)
+        if size is not None:
+            self.windowSize -= size
+        elif self.probation.pop(key, None) is None:
+            self.protectedSize -= self.protected.pop(key)
+
+    def victim(self):
+        """The latest candidate is evicted unless it's more frequent than the least recently used probation key
+        :return: bytestring key of the next item to evict
+        """
+        if self.probation:
+            victimKey = next(iter(self.probation))
+            candidateKey = next(reversed(self.probation))
+            if candidateKey == victimKey:
+                return victimKey
+            if self.sketch.frequency(candidateKey) > self.sketch.frequency(victimKey):
+                self.admissions += 1
+                return victimKey
+            self.rejections += 1
+            return candidateKey
+        if self.protected:
+            return next(iter(self.protected))
+        return next(iter(self.window))
+
+    def victims(self):
+        """The admission decisions of victim aren't made, the candidate is evicted in its probation order
+        :return: iterator of the keys from the next one to evict
+        """
+        return chain(self.probation, self.protected, self.window)
+
+    def stats(self):
+        """
+        :return: list of (name, value) of the policy stats
+        """
+        return [
+            ('tinylfu_window_bytes', self.windowSize),
+            ('tinylfu_protected_bytes', self.protectedSize),
+            ('tinylfu_probation_items', len(self.probation)),
+            ('tinylfu_admissions', self.admissions),
+            ('tinylfu_rejections', self.rejections),
+        ]
+
+EVICTION_POLICIES = {policy.NAME: policy for policy in (LRUPolicy, TinyLFUPolicy)}
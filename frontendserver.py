@@ -6,27 +6,118 @@ import os.path
 # Handle command line arguments
 import argparse
 
+# Leave out the expired keys
+import time
+
+# Values persisted compressed by the memcached server are decompressed to be shown
+from compression import COMPRESSED_FLAG, decompressValue
+
+# Relay the metrics feed of the memcached server
+import socket
+
 # Sqlite
 import sqlite3
 from sqlite3 import Error
 
+# The keys of a sharded database are listed from every shard file
+from sqlitestorage import keyShard, shardFiles
+
 # Use flask to serve the static html file instead of using the python simple server.
 # Gives control of what is actually served from the server, and allows us to do some
 # preprocessing to the html file if we chose choose before it's delivered.
 from flask import Flask
+from flask import Response
+from flask import jsonify
 from flask import render_template
+from flask import request
 
 # creates a Flask application, named app
 app = Flask(__name__)
 app.config['ENV'] = 'development'
 
-# Route to serve the HTML file with inserted keyValue pairs to be used by the React Javascript
+DEFAULT_PAGE_SIZE = 100 # Keys per page of the keys API
+MAX_PAGE_SIZE = 1000
+MAX_VALUE_PREVIEW = 64 * 1024 # Bytes of a value returned by the value API
+METRICS_TIMEOUT = 10 # Seconds without a sample before the metrics stream is ended, the browser reconnects it
+METRICS_RETRY = 3000 # Milliseconds the browser waits before reconnecting the metrics stream
+
+# Route to serve the HTML file, the React Javascript loads the keys page by page from the keys API
 @app.route("/")
 def hello():
-    databaseRows = getAllKeys(app.config['DATABASE_FILE'])
-    keys = [{ 'keyName': row[0], 'value': row[3]} for row in databaseRows]
-    return render_template('monitoring_page.html', keys=keys)
-
+    return render_template('monitoring_page.html')
+
+# Route returning a page of keys in key order, without their values
+# ?after=<key> continues after the last key of the previous page, ?prefix=<prefix> only returns keys starting with it
+@app.route("/api/keys")
+def keysPage():
+    prefix = request.args.get('prefix', '')
+    after = request.args.get('after', '')
+    limit = min(max(request.args.get('limit', DEFAULT_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    # Every shard returns its first keys after the cursor, the first ones of them all make the page
+    databaseRows = []
+    for shardFile in app.config['DATABASE_FILES']:
+        databaseRows += getKeysPage(shardFile, prefix, after, limit)
+    databaseRows = sorted(databaseRows)[:limit]
+    keys = [{ 'keyName': row[0], 'bytes': row[1], 'exptime': row[2]} for row in databaseRows]
+    nextCursor = databaseRows[-1][0] if len(databaseRows) == limit else None
+    return jsonify(keys=keys, next=nextCursor)
+
+# Route returning the value of a single key, fetched when the key is expanded in the list
+@app.route("/api/value")
+def keyValue():
+    key = request.args.get('key', '')
+    databaseFiles = app.config['DATABASE_FILES']
+    row = getKeyRow(databaseFiles[keyShard(key.encode(), len(databaseFiles))], key)
+    if row is None:
+        return jsonify(error='key not found'), 404
+    value = persistedValue(row)
+    # The values are stored as raw bytes, binary values are shown with replacement characters
+    return jsonify(keyName=key, flags=row[1] & ~COMPRESSED_FLAG, bytes=len(value),
+                   value=value[:MAX_VALUE_PREVIEW].decode('utf-8', 'replace'), truncated=len(value) > MAX_VALUE_PREVIEW)
+
+
+# Route streaming the metrics of the memcached server as Server-Sent Events, one event per sample
+# The samples are pushed by the memcached server, so watching them never touches the database
+@app.route("/api/metrics")
+def metricsStream():
+    return Response(relayMetrics(app.config['MEMCACHED_ADDRESS']), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+def relayMetrics(address):
+    """ relay the samples of the watch metrics command of the memcached server as Server-Sent Events,
+        the connection is closed when the browser goes away and the next sample can't be sent
+    :param address: host:port of the memcached server
+    :return: generator of the event strings
+    """
+    yield 'retry: {}\n\n'.format(METRICS_RETRY)
+    host, port = address.rsplit(':', 1)
+    try:
+        connection = socket.create_connection((host, int(port)), timeout=METRICS_TIMEOUT)
+    except OSError as error:
+        print(error)
+        return
+    try:
+        connection.sendall(b'watch metrics\r\n')
+        lines = connection.makefile('rb')
+        if lines.readline() != b'OK\r\n':
+            return
+        for line in lines:
+            if line.startswith(b'METRICS '):
+                yield 'data: {}\n\n'.format(line[len(b'METRICS '):].decode().rstrip())
+    except OSError as error:
+        print(error)
+    finally:
+        connection.close()
+
+def persistedValue(row):
+    """ the value of a keysTable row, decompressed if the memcached server compressed it
+    :param row: keysTable row
+    :return: bytes of the value
+    """
+    if row[1] & COMPRESSED_FLAG:
+        return decompressValue(row[3])
+    return bytes(row[3])
 
 def create_connection(db_file):
     """ create a database connection to the SQLite database
@@ -43,37 +134,84 @@ def create_connection(db_file):
 
     return conn
 
-def getAllKeys(db_file):
-    """ get all rows from the keysTable in the SQLite database
-        specified by db_file
+def prefixEnd(prefix):
+    """ the smallest string greater than every string starting with prefix, so a prefix
+        search is a range of the primary key index instead of a LIKE scan of the table
+    :param prefix: string prefix
+    :return: string or None if there is no such string
+    """
+    while prefix and ord(prefix[-1]) == 0x10ffff:
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    nextCharacter = ord(prefix[-1]) + 1
+    # Surrogates can't be encoded in the UTF-8 keys, the next encodable character follows them
+    if nextCharacter == 0xd800:
+        nextCharacter = 0xe000
+    return prefix[:-1] + chr(nextCharacter)
+
+def getKeysPage(db_file, prefix, after, limit):
+    """ get a page of the keys that aren't expired from the keysTable in the SQLite database
+        specified by db_file, in key order, seeking the primary key index past the cursor
     :param db_file: database file
+    :param prefix: string the keys start with, empty for every key
+    :param after: string key the page starts after, empty for the first page
+    :param limit: maximum number of keys
+    :return: list of (key, bytes, exptime) rows
     """
-    connection = create_connection(db_file)
-    with connection:
-        selectAllQuery = """ SELECT * FROM keysTable """
-
-        cursor = connection.cursor()
-        try:
-            cursor.execute(selectAllQuery)
-        except Exception as error:
-            print(error)
+    query = """ SELECT key, bytes, exptime FROM keysTable WHERE key > ? AND key >= ? """
+    parameters = [after, prefix]
+    end = prefixEnd(prefix)
+    if end is not None:
+        query += """ AND key < ? """
+        parameters.append(end)
+    query += """ AND (exptime = 0 OR exptime > ?) ORDER BY key LIMIT ? """
+    parameters += [time.time(), limit]
 
-        rows = cursor.fetchall()
+    connection = create_connection(db_file)
+    try:
+        return connection.execute(query, parameters).fetchall()
+    except Error as error:
+        print(error)
+        return []
+    finally:
+        connection.close()
+
+def getKeyRow(db_file, key):
+    """ get the row of a key that isn't expired from the keysTable in the SQLite database
+        specified by db_file
+    :param db_file: database file
+    :param key: string key
+    :return: keysTable row or None
+    """
+    selectKeyQuery = """ SELECT key, flags, bytes, dataBlock, exptime FROM keysTable WHERE key = ? AND (exptime = 0 OR exptime > ?) """
 
-        return rows
+    connection = create_connection(db_file)
+    try:
+        return connection.execute(selectKeyQuery, (key, time.time())).fetchone()
+    except Error as error:
+        print(error)
+        return None
+    finally:
+        connection.close()
 
 
 def main():
     parser = argparse.ArgumentParser(description='Start the memcached and front end servers')
     parser.add_argument('databaseFile', metavar='databaseFile', type=str,
                         help='the database for the memcached server')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of database files the keys are split in')
+    parser.add_argument('--memcached', type=str, default='127.0.0.1:11211',
+                        help='host:port of the memcached server whose metrics are streamed')
 
     args = parser.parse_args()
 
     cwd = os.path.abspath(os.path.join(os.path.dirname(__file__)))
     databaseFile = cwd+'/'+args.databaseFile
 
-    app.config['DATABASE_FILE'] = databaseFile
+    app.config['DATABASE_FILES'] = shardFiles(databaseFile, args.shards)
+    app.config['MEMCACHED_ADDRESS'] = args.memcached
     app.run(debug=False, host='0.0.0.0', port=8000)
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+# Fixed size counters of the count-min sketch
+from array import array
+
+# Min heap of the hottest keys
+import heapq
+
+# Decay of the counts over time
+import time
+
+class HotKeys:
+    """Estimates the access rate of the keys in a count-min sketch and keeps the hottest ones in a Top-K heap
+    The sketch is DEPTH rows of WIDTH counters whatever the number of distinct keys, a key increments one counter
+    per row and its count is the smallest of them, which can only overestimate it. Counters are only raised up to
+    the new estimate (conservative update) to keep the overestimation low.
+    Every count is halved each DECAY_INTERVAL, so keys that cool down leave the Top-K. At a steady rate r a count
+    is r * (DECAY_INTERVAL + seconds since the last halving), which gives the reported rates
+    """
+    SIZE = 20 # Hottest keys kept
+    WIDTH = 4096 # Counters per row, a power of 2
+    DEPTH = 4 # Rows, record is unrolled over them
+    DECAY_INTERVAL = 10 # Seconds between two halvings of the counts
+    DECAY_CHECK = 1024 # Accesses between two checks of the clock
+
+    def __init__(self, size=SIZE, width=WIDTH, decayInterval=DECAY_INTERVAL):
+        """
+        :param size: number of hottest keys kept
+        :param width: counters per row of the sketch, a power of 2
+        :param decayInterval: seconds between two halvings of the counts
+        :no return:
+        """
+        self.size = size
+        self.mask = width - 1
+        self.rows = [array('L', bytes(array('L').itemsize * width)) for _ in range(self.DEPTH)]
+        self.decayInterval = decayInterval
+        self.counts = {} # key -> estimated count of the keys in the Top-K
+        self.heap = [] # (count, key) of every key of the Top-K, the count can lag behind counts until it reaches the top
+        self.accesses = 0
+        self.lastDecay = time.monotonic()
+
+    def record(self, key):
+        """Count an access to a key
+        :param key: bytestring key
+        :no return:
+        """
+        # One counter per row from two halves of the hash of the key
+        keyHash = hash(key)
+        step = (keyHash >> 32) | 1
+        mask = self.mask
+        row0, row1, row2, row3 = self.rows
+        index0 = keyHash & mask
+        index1 = (keyHash + step) & mask
+        index2 = (keyHash + 2 * step) & mask
+        index3 = (keyHash + 3 * step) & mask
+        count0 = row0[index0]
+        count1 = row1[index1]
+        count2 = row2[index2]
+        count3 = row3[index3]
+        estimate = min(count0, count1, count2, count3) + 1
+        if count0 < estimate:
+            row0[index0] = estimate
+        if count1 < estimate:
+            row1[index1] = estimate
+        if count2 < estimate:
+            row2[index2] = estimate
+        if count3 < estimate:
+            row3[index3] = estimate
+
+        counts = self.counts
+        if key in counts:
+            counts[key] = estimate
+        elif len(counts) < self.size:
+            counts[key] = estimate
+            heapq.heappush(self.heap, (estimate, key))
+        elif self.heap and estimate > self.heap[0][0]:
+            self.replaceColdest(key, estimate)
+
+        self.accesses += 1
+        if not self.accesses % self.DECAY_CHECK:
+            self.decay()
+
+    def replaceColdest(self, key, estimate):
+        """Replace the coldest key of the Top-K if the key is hotter
+        The counts in the heap are never above the current ones, stale ones are refreshed until the top is current
+        :param key: bytestring key not in the Top-K
+        :param estimate: estimated count of the key
+        :no return:
+        """
+        heap = self.heap
+        counts = self.counts
+        while heap[0][0] != counts[heap[0][1]]:
+            coldestKey = heap[0][1]
+            heapq.heapreplace(heap, (counts[coldestKey], coldestKey))
+        if estimate > heap[0][0]:
+            del counts[heapq.heapreplace(heap, (estimate, key))[1]]
+            counts[key] = estimate
+
+    def decay(self):
+        """Halve every count once per decay interval elapsed since the last halving
+        :no return:
+        """
+        now = time.monotonic()
+        periods = int((now - self.lastDecay) / self.decayInterval)
+        if periods < 1:
+            return
+        self.lastDecay += periods * self.decayInterval
+        shift = min(periods, 63)
+        for index, counters in enumerate(self.rows):
+            self.rows[index] = array('L', (counter >> shift for counter in counters))
+        self.counts = {key: count >> shift for key, count in self.counts.items() if count >> shift}
+        self.heap = [(count, key) for key, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def hottest(self):
+        """
+        :return: list of (bytestring key, estimated accesses per second) of the Top-K from the hottest
+        """
+        self.decay()
+        window = self.decayInterval + time.monotonic() - self.lastDecay
+        return [(key, count / window) for key, count in sorted(self.counts.items(), key=lambda entry: -entry[1])]
+
+    def reset(self):
+        """Forget every count
+        :no return:
+        """
+        for counters in self.rows:
+            counters[:] = array('L', bytes(len(counters) * counters.itemsize))
+        self.counts.clear()
+        self.heap.clear()
+        self.lastDecay = time.monotonic()
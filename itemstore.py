@@ -0,0 +1,414 @@
+# Ordered dictionary keeps the keys sorted from least to most recently used
+from collections import OrderedDict
+
+# Heap of expiration times to find the expired items without scanning every item
+import heapq
+
+# Only the first keys of the eviction order are searched for a key of a slab class
+from itertools import islice
+
+# Expire the items and sweep them on the event loop of the memcached server
+import asyncio
+import time
+
+# Values above a size threshold are kept compressed
+from compression import COMPRESSED_FLAG, ValueCompressor, uncompressedLength
+
+# Which keys are evicted once the memory limit is reached
+from eviction import EVICTION_POLICIES, LRUPolicy
+
+# The records of the items are stored in size classed pages
+from slabs import SlabAllocator, SlabPage
+
+class ItemTooLarge(Exception):
+    """A value that can't fit in the memory limit even once every other key is evicted"""
+
+class Item:
+    """A single value held by the ItemStore
+    The VALUE line of the get reply is stored right before the data block and its CRLF, so a hit is answered
+    with a single buffer. This record lives in a chunk of a slab page while the item is stored and in its own
+    bytestring before and after, and the attributes are slots so an item costs a fixed few machine words
+    """
+    __slots__ = ('flags', 'exptime', 'casUnique', 'length', 'compressor', 'page', 'offset', 'headerLength',
+                 'recordLength')
+
+    def __init__(self, key, flags, dataBlock, exptime=0, casUnique=0, compressor=None, length=None):
+        """
+        :param key: bytestring key
+        :param flags: 16 bit unsigned integer stored alongside the data block
+        :param dataBlock: bytestring value of the item, compressed if a compressor is given
+        :param exptime: unix time the item expires at, 0 if it never expires
+        :param casUnique: unique 64 bit integer that changes every time the value is stored
+        :param compressor: ValueCompressor the data block is compressed with or None if it isn't compressed
+        :param length: number of bytes of the uncompressed value
+        :no return:
+        """
+        self.flags = flags
+        self.compressor = compressor
+        self.length = len(dataBlock) if length is None else length
+        self.exptime = exptime
+        self.casUnique = casUnique
+        header = b'VALUE ' + key + b' ' + str(flags).encode() + b' ' + str(self.length).encode() + b'\r\n'
+        self.page = SlabPage(header + dataBlock + b'\r\n')
+        self.offset = 0
+        self.headerLength = len(header)
+        self.recordLength = len(self.page.memory)
+
+    @property
+    def size(self):
+        """The VALUE line stands for the key, which is about as long
+        :return: bytes of the chunk of the item, or of its record outside the slabs, and of its bookkeeping
+        """
+        slabClass = self.page.slabClass
+        chunkSize = self.recordLength if slabClass is None else slabClass.chunkSize
+        return chunkSize + self.headerLength + ItemStore.ITEM_OVERHEAD
+
+    def slice(self, start, end):
+        """
+        :param start: offset in the record
+        :param end: offset in the record
+        :return: bytestring copy of the part of the record
+        """
+        offset = self.offset
+        return bytes(memoryview(self.page.memory)[offset + start:offset + end])
+
+    @property
+    def header(self):
+        """
+        :return: bytestring VALUE line of the get reply
+        """
+        return self.slice(0, self.headerLength)
+
+    @property
+    def storedBlock(self):
+        """
+        :return: bytestring data block as it's stored, compressed if the item is compressed
+        """
+        return self.slice(self.headerLength, self.recordLength - 2)
+
+    @property
+    def dataBlock(self):
+        """
+        :return: bytestring value of the item, decompressed if it's stored compressed
+        """
+        if self.compressor is None:
+            return self.storedBlock
+        return self.compressor.decompress(self.storedBlock)
+
+    def reply(self):
+        """The VALUE line, the data block and its CRLF of a get reply, a record in a slab is written without
+        copying it, a caller keeping it after the chunk can be reused copies it
+        :return: bytestring, or memoryview of the chunk of the item
+        """
+        if self.compressor is not None:
+            return self.header + self.dataBlock + b'\r\n'
+        # A record in its own bytestring is immutable and sent without copying it
+        if self.page.slabClass is None:
+            return self.page.memory
+        offset = self.offset
+        return memoryview(self.page.memory)[offset:offset + self.recordLength]
+
+    def dataReply(self):
+        """The data block and its CRLF of a gets reply, whose VALUE line carries the cas unique
+        :return: bytestring, or memoryview of the record of the item
+        """
+        if self.compressor is not None:
+            return self.dataBlock + b'\r\n'
+        offset = self.offset
+        return memoryview(self.page.memory)[offset + self.headerLength:offset + self.recordLength]
+
+    def persistedValue(self, memory=None, offset=0):
+        """The value as it's persisted, compressed values are marked with COMPRESSED_FLAG
+        :param memory: copy of the memory of the item's page to read the value from off the event loop,
+                       None to copy the value out of the current page
+        :param offset: offset of the item in the copy of the memory
+        :return: (flags, bytestring data block, or memoryview of the copy of the memory)
+        """
+        if memory is None:
+            storedBlock = self.storedBlock
+        else:
+            storedBlock = memoryview(memory)[offset + self.headerLength:offset + self.recordLength - 2]
+        if self.compressor is None:
+            return self.flags, storedBlock
+        return self.flags | COMPRESSED_FLAG, storedBlock
+
+class ItemStore:
+    """In memory storage engine for the memcached server
+    Keys are kept in an OrderedDict, the eviction policy chooses which keys are evicted once the configured
+    memory limit is reached: the least recently used one, which is always the first one of the OrderedDict,
+    or a W-TinyLFU policy that keeps the frequently used keys when many keys are only read once
+
+    The records of the items are stored in the pages of a SlabAllocator. The memory used is the memory of
+    the pages plus the VALUE line, standing for the key, and the fixed bookkeeping cost of each item, so it's
+    what the process actually holds for the items. When a value would exceed the limit, a key of its class is evicted
+    first, the first one in the eviction order, like memcached's per class LRU, so the value doesn't need a new page
+    the other classes would have to evict a page worth of keys for. Otherwise keys are evicted until a page is released, either because its last chunk was freed or because
+    the class of an evicted key had a whole page of free chunks to compact. A single set evicts at most
+    MAX_EVICTIONS_PER_SET keys, past that the new value is evicted and the chunks freed make room for the next sets
+
+    Expired items are dropped when they're read and by a sweeper that runs on the event loop,
+    removing a bounded number of expired items per loop iteration so the loop never stalls
+    """
+    # Bytes of a slotted Item, its cas unique, its entries in the OrderedDict and in its page, and its key
+    # beyond the length of its VALUE line, measured with tracemalloc
+    ITEM_OVERHEAD = 272
+    PAGES = 64 # Pages of the memory limit at least, smaller limits get smaller pages
+    SWEEP_INTERVAL = 1 # Seconds
+    SWEEP_BATCH_SIZE = 1000 # Expired items removed per loop iteration
+    CLASS_VICTIM_SEARCH = 100 # Keys of the eviction order searched for a key of the class of a new value
+    MAX_EVICTIONS_PER_SET = 100
+
+    def __init__(self, memoryLimit, compressor=None, evictionPolicy=LRUPolicy.NAME):
+        """
+        :param memoryLimit: maximum number of bytes the stored items are allowed to use
+        :param compressor: ValueCompressor of the values, None to never compress them
+        :param evictionPolicy: name of one of the EVICTION_POLICIES
+        :no return:
+        """
+        self.memoryLimit = memoryLimit
+        # Values persisted compressed are decompressed even when compression is off
+        self.compressor = compressor if compressor is not None else ValueCompressor()
+        self.slabs = SlabAllocator(min(SlabAllocator.PAGE_SIZE, memoryLimit // self.PAGES))
+        self.itemsOverhead = 0 # Bytes of the keys and the bookkeeping of the items
+        self.evictions = 0
+        self.expiredItems = 0
+        self.lastCasUnique = 0
+        self.items = OrderedDict()
+        self.policy = EVICTION_POLICIES[evictionPolicy](self.items, memoryLimit)
+        self.itemOverhead = self.ITEM_OVERHEAD + self.policy.KEY_OVERHEAD
+        self.expirations = [] # heap of (exptime, key), entries of replaced items are skipped when popped
+        self.expiringItems = 0 # Items with an expiration time, the other entries of the heap are stale
+        self.sweepHandle = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    @property
+    def memoryUsed(self):
+        """
+        :return: bytes held for the items
+        """
+        return self.slabs.totalMalloced + self.itemsOverhead
+
+    def get(self, key):
+        """Look up a key and tell the eviction policy it was used
+        :param key: bytestring key
+        :return: Item object or None if the key isn't stored or expired
+        """
+        item = self.items.get(key)
+        if item is not None:
+            if item.exptime and item.exptime <= time.time():
+                self.expire(key)
+                return None
+            self.policy.accessed(key)
+        return item
+
+    def newItem(self, key, flags, dataBlock, exptime=0, casUnique=0):
+        """Values above the compression threshold are compressed, a persisted value marked with
+        COMPRESSED_FLAG in its flags is kept compressed as it is
+        :param key: bytestring key
+        :param flags: 16 bit unsigned integer, or the persisted flags of a compressed value
+        :param dataBlock: bytestring value
+        :param exptime: unix time the item expires at, 0 if it never expires
+        :param casUnique: unique 64 bit integer of the item
+        :return: Item object of the value, not stored yet
+        """
+        compressor = None
+        length = None
+        if flags & COMPRESSED_FLAG:
+            flags &= ~COMPRESSED_FLAG
+            compressor = self.compressor
+            length = uncompressedLength(dataBlock)
+        else:
+            compressed = self.compressor.compress(dataBlock)
+            if compressed is not None:
+                compressor = self.compressor
+                length = len(dataBlock)
+                dataBlock = compressed
+        return Item(key, flags, dataBlock, exptime, casUnique, compressor, length)
+
+    def peek(self, key):
+        """Look up a key without telling the eviction policy, for the replies of the commands storing it
+        :param key: bytestring key
+        :return: Item object or None if the key isn't stored
+        """
+        return self.items.get(key)
+
+    def classVictim(self, slabClass):
+        """
+        :param slabClass: SlabClass of a new value
+        :return: bytestring key of the first key of the class in the eviction order, None if it isn't
+                 among the first CLASS_VICTIM_SEARCH keys
+        """
+        for key in islice(self.policy.victims(), self.CLASS_VICTIM_SEARCH):
+            if self.items[key].page.slabClass is slabClass:
+                return key
+        return None
+
+    def evict(self, key):
+        """Evict a key and compact its class if it has a whole page of free chunks
+        :param key: bytestring key of a stored item
+        :no return:
+        """
+        slabClass = self.items[key].page.slabClass
+        self.delete(key)
+        self.evictions += 1
+        if slabClass is not None:
+            slabClass.evictions += 1
+        self.slabs.reclaim(slabClass)
+
+    def expire(self, key):
+        """Remove a key whose expiration time passed
+        :param key: bytestring key of a stored item
+        :no return:
+        """
+        slabClass = self.items[key].page.slabClass
+        self.delete(key)
+        self.expiredItems += 1
+        if slabClass is not None:
+            slabClass.expiredItems += 1
+
+    def set(self, key, flags, dataBlock, exptime=0):
+        """Store a value, evicting the keys chosen by the eviction policy if the memory limit is exceeded
+        The eviction policy can choose the new key itself, a W-TinyLFU policy rejects a key that isn't
+        accessed as often as the key it would replace
+        :param key: bytestring key
+        :param flags: 16 bit unsigned integer, or the persisted flags of a compressed value
+        :param dataBlock: bytestring value
+        :param exptime: unix time the item expires at, 0 if it never expires
+        :raise ItemTooLarge: if the value can never fit in the memory limit
+        :return: the stored Item object, or None if it was evicted right away, by the eviction policy
+                 or after MAX_EVICTIONS_PER_SET keys
+        """
+        return self.setItem(key, self.newItem(key, flags, dataBlock, exptime))
+
+    def setItem(self, key, item):
+        """Store an item built by newItem, so a caller that still needs the item if it isn't kept in memory
+        doesn't compress its value again
+        :param key: bytestring key
+        :param item: Item object returned by newItem, it's given the next cas unique
+        :raise ItemTooLarge: if the value can never fit in the memory limit
+        :return: the stored Item object, or None if it was evicted right away
+        """
+        overhead = item.headerLength + self.itemOverhead
+        if self.slabs.footprint(item.recordLength) + overhead > self.memoryLimit:
+            raise ItemTooLarge('{} bytes can never fit in {} bytes'.format(item.recordLength + overhead, self.memoryLimit))
+
+        self.lastCasUnique += 1
+        item.casUnique = self.lastCasUnique
+        self.delete(key)
+        slabClass = self.slabs.slabClass(item.recordLength)
+        if slabClass is not None and slabClass.pages:
+            footprint = overhead if slabClass.partialPages else self.slabs.pageSize + overhead
+            if self.memoryUsed + footprint > self.memoryLimit:
+                victimKey = self.classVictim(slabClass)
+                if victimKey is not None:
+                    self.evict(victimKey)
+        self.slabs.allocate(item)
+        self.items[key] = item
+        self.itemsOverhead += overhead
+        self.policy.added(key, item)
+        if item.exptime:
+            self.expiringItems += 1
+            self.pushExpiration(item.exptime, key)
+
+        evictions = 0
+        while self.memoryUsed > self.memoryLimit:
+            if evictions == self.MAX_EVICTIONS_PER_SET:
+                if slabClass is not None:
+                    slabClass.outOfMemory += 1
+                self.evict(key)
+                break
+            self.evict(self.policy.victim())
+            evictions += 1
+
+        if key not in self.items:
+            return None
+        return item
+
+    def touch(self, key, exptime):
+        """Change the expiration time of a stored item without changing its value
+        :param key: bytestring key
+        :param exptime: unix time the item expires at, 0 if it never expires
+        :return: True if the key was stored, False otherwise
+        """
+        item = self.get(key)
+        if item is None:
+            return False
+        if exptime == item.exptime:
+            return True
+        self.expiringItems += bool(exptime) - bool(item.exptime)
+        item.exptime = exptime
+        if exptime:
+            self.pushExpiration(exptime, key)
+        return True
+
+    def pushExpiration(self, exptime, key):
+        """Add the expiration entry of an item, the heap is rebuilt from the items once its stale entries
+        outnumber the items, so it holds at most about two entries per item
+        :param exptime: unix time the item expires at
+        :param key: bytestring key
+        :no return:
+        """
+        heapq.heappush(self.expirations, (exptime, key))
+        if len(self.expirations) - self.expiringItems > len(self.items):
+            self.expirations = [(item.exptime, key) for key, item in self.items.items() if item.exptime]
+            heapq.heapify(self.expirations)
+
+    def delete(self, key):
+        """Remove a key from the store
+        :param key: bytestring key
+        :return: True if the key was stored, False otherwise
+        """
+        item = self.items.pop(key, None)
+        if item is None:
+            return False
+        self.itemsOverhead -= item.headerLength + self.itemOverhead
+        if item.exptime:
+            self.expiringItems -= 1
+        self.policy.removed(key, item)
+        self.slabs.free(item)
+        return True
+
+    def snapshotItems(self):
+        """The items as they are now, for a snapshot written off the event loop while the items keep changing
+        The slab pages are copied once, the records kept outside the slabs are immutable
+        :return: list of (key, Item, memory of its page, offset in the memory) from the least to the most recently used
+        """
+        copies = {page: bytes(page.memory) for page in self.slabs.pages()}
+        return [(key, item, copies.get(item.page, item.page.memory), item.offset) for key, item in self.items.items()]
+
+    def removeExpired(self, limit):
+        """Remove the items whose expiration time passed, oldest expiration first
+        :param limit: maximum number of expiration entries to look at
+        :return: True if there are expired items left to remove
+        """
+        now = time.time()
+        expirations = self.expirations
+        while expirations and limit > 0 and expirations[0][0] <= now:
+            exptime, key = heapq.heappop(expirations)
+            item = self.items.get(key)
+            if item is not None and item.exptime == exptime:
+                self.expire(key)
+            limit -= 1
+        return bool(expirations) and expirations[0][0] <= now
+
+    def sweep(self):
+        """Remove a batch of expired items, then schedule the next sweep on the next loop
+        iteration if expired items are left or after the sweep interval otherwise
+        """
+        loop = asyncio.get_running_loop()
+        if self.removeExpired(self.SWEEP_BATCH_SIZE):
+            self.sweepHandle = loop.call_soon(self.sweep)
+        else:
+            self.sweepHandle = loop.call_later(self.SWEEP_INTERVAL, self.sweep)
+
+    def stopSweeping(self):
+        """Cancel the next sweep
+        """
+        if self.sweepHandle is not None:
+            self.sweepHandle.cancel()
+            self.sweepHandle = None
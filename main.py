@@ -2,6 +2,12 @@
 
 # Running both servers in the same process
 import subprocess
+import signal
+import sys
+import time
+
+# Readiness check of the memcached server
+import socket
 
 # Handle the task of getting the absolute path for the current working directory
 import os.path
@@ -13,6 +19,9 @@ import argparse
 import sqlite3
 from sqlite3 import Error
 
+# Keys persisted in several database files
+from sqlitestorage import keyShard, shardFiles
+
 def create_connection(db_file):
     """ create a database connection to the SQLite database
         specified by db_file
@@ -40,13 +49,282 @@ def create_table(conn, create_table_sql):
     except Error as e:
         print(e)
 
+def migrate_keys_table(conn):
+    """ bring a keysTable created by an earlier version up to date:
+        convert a text dataBlock column to a BLOB column so the memcached server can store
+        binary values without decoding them, and add the exptime column of the expiring items
+    :param conn: Connection object
+    :return:
+    """
+    try:
+        columns = conn.execute(""" PRAGMA table_info(keysTable) """).fetchall()
+        dataBlockTypes = [column[2].lower() for column in columns if column[1] == 'dataBlock']
+        if dataBlockTypes == ['text']:
+            with conn:
+                conn.execute(""" CREATE TABLE keysTableMigration (
+                                    key text PRIMARY KEY,
+                                    flags integer NOT NULL,
+                                    bytes integer,
+                                    dataBlock blob
+                                ); """)
+                conn.execute(""" INSERT INTO keysTableMigration(key, flags, bytes, dataBlock)
+                                 SELECT key, flags, length(CAST(dataBlock AS BLOB)), CAST(dataBlock AS BLOB) FROM keysTable """)
+                conn.execute(""" DROP TABLE keysTable """)
+                conn.execute(""" ALTER TABLE keysTableMigration RENAME TO keysTable """)
+
+        columns = conn.execute(""" PRAGMA table_info(keysTable) """).fetchall()
+        if 'exptime' not in [column[1] for column in columns]:
+            with conn:
+                conn.execute(""" ALTER TABLE keysTable ADD COLUMN exptime integer NOT NULL DEFAULT 0 """)
+    except Error as e:
+        print(e)
+
+def rebalance_shards(databaseFile, shardCount):
+    """ move the persisted keys to the shard files they belong to when the number of shards changed
+        the number of shards the keys are split in is kept in the user_version of the first shard
+    :param databaseFile: full path to the database file, the first shard
+    :param shardCount: number of shards the keys are split in from now on
+    :return:
+    """
+    conn = create_connection(databaseFile)
+    previousCount = conn.execute(""" PRAGMA user_version """).fetchone()[0] or 1
+    conn.close()
+    if previousCount == shardCount:
+        return
+
+    previousFiles = shardFiles(databaseFile, previousCount)
+    files = shardFiles(databaseFile, shardCount)
+    connections = [create_connection(shardFile) for shardFile in files]
+    for previousIndex, previousFile in enumerate(previousFiles):
+        if not os.path.exists(previousFile):
+            continue
+        previousConn = create_connection(previousFile)
+        movedKeys = []
+        cursor = previousConn.execute(""" SELECT key, flags, bytes, dataBlock, exptime FROM keysTable """)
+        for rows in iter(lambda: cursor.fetchmany(1000), []):
+            for row in rows:
+                index = keyShard(row[0].encode(), shardCount)
+                if index != previousIndex:
+                    connections[index].execute(""" INSERT OR REPLACE INTO keysTable VALUES (?, ?, ?, ?, ?) """, row)
+                    movedKeys.append((row[0],))
+        # the moved rows are committed to their new shards before they're deleted from the previous one
+        for connection in connections:
+            connection.commit()
+        with previousConn:
+            previousConn.executemany(""" DELETE FROM keysTable WHERE key=? """, movedKeys)
+        previousConn.close()
+        if previousIndex >= shardCount:
+            # A -wal file left by a crash would be replayed into a shard file created again with the same name
+            for path in (previousFile, previousFile + '-wal', previousFile + '-shm'):
+                if os.path.exists(path):
+                    os.remove(path)
+    with connections[0]:
+        connections[0].execute(""" PRAGMA user_version = {} """.format(shardCount))
+    for connection in connections:
+        connection.close()
+
+def isReady(host='127.0.0.1', port=11211, timeout=1):
+    """ check that the memcached server accepts connections and answers commands
+    :param host: host the memcached server listens on
+    :param port: port the memcached server listens on
+    :param timeout: seconds to wait for the connection and the reply
+    :return: True if the server answered a get command
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as connection:
+            connection.sendall(b'get readiness-check\r\n')
+            reply = b''
+            while not reply.endswith(b'END\r\n'):
+                data = connection.recv(1024)
+                if not data:
+                    return False
+                reply += data
+            return True
+    except OSError:
+        return False
+
+class Supervisor:
+    """ start the server processes and restart the ones that exit
+        the supervisor sleeps until a child exits, a signal arrives or a restart is due
+        instead of polling, restarts back off exponentially while a child keeps crashing
+    """
+    RESTART_DELAY = 1 # Seconds before the first restart of a child that exited
+    MAX_RESTART_DELAY = 30 # Seconds
+    STABLE_TIME = 10 # Seconds a child has to run before its restart delay is reset
+    STOP_TIMEOUT = 15 # Seconds the children are given to drain before they're killed
+    READY_CHECK_INTERVAL = 0.5 # Seconds between the readiness checks while the memcached server isn't ready
+    SIGNALS = (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, commands, cwd, readyFile=None, readyCheck=isReady):
+        """
+        :param commands: dictionary of child name to its command line tuple, memcached children are named memcached*
+        :param cwd: directory the children run in
+        :param readyFile: path of a file that exists while every memcached server is running and the port is served
+        :param readyCheck: function returning True once the memcached port is served
+        :no return:
+        """
+        self.commands = commands
+        self.cwd = cwd
+        self.readyFile = readyFile
+        self.readyCheck = readyCheck
+        self.processes = {} # name -> Popen object of the running child
+        self.startTimes = {} # name -> monotonic time the child was started
+        self.restarts = {} # name -> monotonic time the child is restarted at
+        self.failures = {} # name -> number of consecutive crashes
+        self.ready = False
+
+    def start(self, name):
+        """ start a child process with the signals the supervisor blocks unblocked again
+        :param name: name of the child
+        :return:
+        """
+        try:
+            self.processes[name] = subprocess.Popen(self.commands[name], cwd=self.cwd,
+                preexec_fn=lambda: signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS))
+            self.startTimes[name] = time.monotonic()
+        except OSError as e:
+            print(e)
+            self.scheduleRestart(name)
+
+    def restartDelay(self, name):
+        """ seconds to wait before the next restart of a child, doubled for every consecutive crash
+        :param name: name of the child
+        :return: seconds
+        """
+        return min(self.MAX_RESTART_DELAY, self.RESTART_DELAY * 2 ** self.failures.get(name, 0))
+
+    def scheduleRestart(self, name):
+        delay = self.restartDelay(name)
+        self.failures[name] = self.failures.get(name, 0) + 1
+        self.restarts[name] = time.monotonic() + delay
+        print('restarting {} in {} seconds'.format(name, delay))
+
+    def reapChildren(self):
+        """ schedule the restart of the children that exited
+        :return:
+        """
+        for name, process in list(self.processes.items()):
+            returnCode = process.poll()
+            if returnCode is None:
+                continue
+            print('{} exited with code {}'.format(name, returnCode))
+            del self.processes[name]
+            if time.monotonic() - self.startTimes[name] >= self.STABLE_TIME:
+                self.failures[name] = 0
+            self.scheduleRestart(name)
+            if name.startswith('memcached'):
+                self.setReady(False)
+
+    def restartDueChildren(self):
+        now = time.monotonic()
+        for name, restartTime in list(self.restarts.items()):
+            if restartTime <= now:
+                del self.restarts[name]
+                self.start(name)
+
+    def checkReady(self):
+        """ mark the servers ready once every memcached child runs and the port is served
+        :return:
+        """
+        memcachedRunning = all(name in self.processes for name in self.commands if name.startswith('memcached'))
+        if not self.ready and memcachedRunning and self.readyCheck():
+            self.setReady(True)
+
+    def setReady(self, ready):
+        if ready == self.ready:
+            return
+        self.ready = ready
+        print('memcached server ready' if ready else 'memcached server not ready')
+        if self.readyFile is None:
+            return
+        if ready:
+            with open(self.readyFile, 'w'):
+                pass
+        elif os.path.exists(self.readyFile):
+            os.remove(self.readyFile)
+
+    def waitTimeout(self):
+        """ seconds until the supervisor has to act without being woken up by a signal
+        :return: seconds or None to wait for the next signal
+        """
+        timeouts = [max(0, restartTime - time.monotonic()) for restartTime in self.restarts.values()]
+        if not self.ready:
+            timeouts.append(self.READY_CHECK_INTERVAL)
+        return min(timeouts) if timeouts else None
+
+    def run(self):
+        """ start every child and supervise them until SIGTERM or SIGINT
+        :return:
+        """
+        # The signals are blocked and received synchronously so the supervisor sleeps in sigtimedwait
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.SIGNALS)
+        for name in self.commands:
+            self.start(name)
+        try:
+            while True:
+                timeout = self.waitTimeout()
+                if timeout is None:
+                    received = signal.sigwaitinfo(self.SIGNALS)
+                else:
+                    received = signal.sigtimedwait(self.SIGNALS, timeout)
+                if received is not None and received.si_signo != signal.SIGCHLD:
+                    break
+                self.reapChildren()
+                self.restartDueChildren()
+                self.checkReady()
+        finally:
+            self.stop()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, self.SIGNALS)
+
+    def stop(self):
+        """ forward SIGTERM so the children drain their connections and flush the storage,
+            then kill the ones still running after the stop timeout
+        :return:
+        """
+        self.setReady(False)
+        self.restarts.clear()
+        for process in self.processes.values():
+            process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        for process in self.processes.values():
+            try:
+                process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.processes.clear()
+
 def main():
     parser = argparse.ArgumentParser(description='Start the memcached and front end servers')
-    parser.add_argument('databaseFile', metavar='databaseFile', type=str,
+    parser.add_argument('databaseFile', metavar='databaseFile', type=str, nargs='?',
                         help='the database file for the memcached server')
+    parser.add_argument('-m', '--memory-limit', dest='memoryLimit', type=int, default=64,
+                        help='megabytes of memory the memcached server uses for items before evicting keys')
+    parser.add_argument('-I', '--max-item-size', dest='maxItemSize', type=str, default='1m',
+                        help='largest value a client can store in the memcached server, in bytes or with a k or m suffix')
+    parser.add_argument('--eviction-policy', dest='evictionPolicy', choices=('lru', 'tinylfu'), default='lru',
+                        help='which keys the memcached server evicts at the memory limit')
+    parser.add_argument('--compress-threshold', dest='compressThreshold', type=int, default=0,
+                        help='bytes from which the memcached server keeps the values compressed, 0 to never compress them')
+    parser.add_argument('--durability', choices=('none', 'batched', 'per-write'), default='batched',
+                        help='when the memcached server commits persisted writes to the database file')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of database files the persisted keys are split in, so their writes run in parallel')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of memcached server processes sharing the port, each owning a share of the keys')
+    parser.add_argument('--snapshot-file', dest='snapshotFile', type=str,
+                        help='file the memcached server snapshots its items to for a warm restart, one per worker')
+    parser.add_argument('--ready-file', dest='readyFile', type=str,
+                        help='file created once the memcached server is serving and removed while it is not')
+    parser.add_argument('--check-ready', dest='checkReady', action='store_true',
+                        help='exit with status 0 if the memcached server is serving on port 11211, 1 otherwise')
 
     args = parser.parse_args()
 
+    if args.checkReady:
+        sys.exit(0 if isReady() else 1)
+    if args.databaseFile is None:
+        parser.error('the databaseFile argument is required')
     cwd = os.path.abspath(os.path.join(os.path.dirname(__file__)))
     databaseFile = cwd+'/'+args.databaseFile
 
@@ -54,40 +332,43 @@ def main():
                                     key text PRIMARY KEY,
                                     flags integer NOT NULL,
                                     bytes integer,
-                                    dataBlock text
+                                    dataBlock blob,
+                                    exptime integer NOT NULL DEFAULT 0
                                 ); """
 
-    # create a database connection
-    conn = create_connection(databaseFile)
+    sql_create_expiration_index = """ CREATE INDEX IF NOT EXISTS keysTableExptime ON keysTable (exptime); """
 
-    # create tables
-    if conn is not None:
-        # create keys table
-        create_table(conn, sql_create_keys_table)
-    else:
-        print("Error! cannot create the database connection.")
+    for shardFile in shardFiles(databaseFile, args.shards):
+        # create a database connection
+        conn = create_connection(shardFile)
 
+        # create tables
+        if conn is not None:
+            # create keys table
+            create_table(conn, sql_create_keys_table)
+            # databases created before the values were stored as BLOBs or could expire
+            migrate_keys_table(conn)
+            create_table(conn, sql_create_expiration_index)
+            conn.close()
+        else:
+            print("Error! cannot create the database connection.")
+    rebalance_shards(databaseFile, args.shards)
 
-    try:
-        subprocess.Popen(('python3',
-            'frontendserver.py', args.databaseFile), cwd=cwd)
-    except IndexError:
-        print('Cannot find frontendserver.py')
-        sys.exit(1)
-
-    try:
-        subprocess.Popen(('python3',
-            'memcachedserver.py', args.databaseFile), cwd=cwd)
-    except IndexError:
-        print('Cannot find memcachedserver.py')
-        sys.exit(1)
 
+    commands = {'frontendserver': ('python3', 'frontendserver.py', args.databaseFile, '--shards', str(args.shards))}
+    # the memory limit is split between the workers since each one holds its own share of the keys
+    workerMemoryLimit = max(1, args.memoryLimit // args.workers)
+    snapshotArgs = ('--snapshot-file', args.snapshotFile) if args.snapshotFile is not None else ()
+    for workerIndex in range(args.workers):
+        commands['memcached-{}'.format(workerIndex)] = ('python3',
+            'memcachedserver.py', args.databaseFile, '-m', str(workerMemoryLimit),
+            '--durability', args.durability, '--shards', str(args.shards),
+            '--compress-threshold', str(args.compressThreshold), '--max-item-size', args.maxItemSize,
+            '--eviction-policy', args.evictionPolicy,
+            '--worker-index', str(workerIndex), '--worker-count', str(args.workers)) + snapshotArgs
 
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        print('All servers terminated')
+    Supervisor(commands, cwd, args.readyFile).run()
+    print('All servers terminated')
 
 if __name__ == '__main__':
     main()
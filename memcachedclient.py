@@ -0,0 +1,605 @@
+# Connections of the blocking and the asyncio clients
+import asyncio
+import socket
+import threading
+from contextlib import contextmanager, asynccontextmanager
+
+# Ketama consistent hashing of the keys to the nodes
+import bisect
+import hashlib
+
+# Replies are framed the same way the workers frame the replies of each other
+from workerpeers import replyEnd
+
+class MemcachedClientError(Exception):
+    """ERROR, CLIENT_ERROR or SERVER_ERROR reply of a memcached server, the message is the reply line"""
+
+class HashRing:
+    """Ketama consistent hashing of the keys to the nodes
+    Every node is placed on a ring of 32 bit points at the hashes of its name, a key belongs to the first node point
+    at or after its own hash, so adding or removing one of N nodes only moves about 1/N of the keys
+    """
+    HASHES_PER_NODE = 40 # Each md5 hash gives 4 points, 160 points per node
+
+    def __init__(self, nodes=()):
+        """
+        :param nodes: iterable of node name strings
+        :no return:
+        """
+        self.nodes = []
+        self.points = [] # sorted 32 bit points
+        self.pointNodes = [] # node name of each point
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        """
+        :param node: node name string, e.g. host:port
+        :no return:
+        """
+        if node not in self.nodes:
+            self.nodes.append(node)
+            self.rebuild()
+
+    def remove(self, node):
+        """
+        :param node: node name string
+        :no return:
+        """
+        self.nodes.remove(node)
+        self.rebuild()
+
+    def rebuild(self):
+        ring = []
+        for node in self.nodes:
+            for index in range(self.HASHES_PER_NODE):
+                digest = hashlib.md5('{}-{}'.format(node, index).encode()).digest()
+                for offset in range(0, 16, 4):
+                    ring.append((int.from_bytes(digest[offset:offset + 4], 'little'), node))
+        ring.sort()
+        self.points = [point for point, node in ring]
+        self.pointNodes = [node for point, node in ring]
+
+    def node(self, key):
+        """
+        :param key: bytestring key
+        :return: name of the node the key belongs to
+        """
+        if not self.points:
+            raise MemcachedClientError('no memcached server to send the key to')
+        point = int.from_bytes(hashlib.md5(key).digest()[:4], 'little')
+        return self.pointNodes[bisect.bisect_left(self.points, point) % len(self.points)]
+
+def nodeName(server):
+    """
+    :param server: 'host:port' string or (host, port) tuple
+    :return: 'host:port' node name
+    """
+    if isinstance(server, str):
+        return server
+    return '{}:{}'.format(*server)
+
+def nodeAddress(node):
+    """
+    :param node: 'host:port' node name
+    :return: (host, port) tuple
+    """
+    host, port = node.rsplit(':', 1)
+    return host, int(port)
+
+def encodeKey(key):
+    """
+    :param key: string or bytestring key
+    :raise ValueError: if the key can't be sent in a text protocol command line
+    :return: bytestring key
+    """
+    if isinstance(key, str):
+        key = key.encode()
+    if not key or len(key) > ClientBase.MAX_KEY_LENGTH or any(byte <= 32 or byte == 127 for byte in key):
+        raise ValueError('memcached keys are 1 to 250 bytes without whitespace or control characters: {!r}'.format(key))
+    return key
+
+def encodeValue(value):
+    """
+    :param value: string or bytestring value
+    :return: bytestring value
+    """
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+def checkReply(reply):
+    """
+    :param reply: bytestring reply
+    :raise MemcachedClientError: if the reply is an error
+    :return: the reply
+    """
+    if reply.startswith((b'ERROR', b'CLIENT_ERROR', b'SERVER_ERROR')):
+        raise MemcachedClientError(reply.strip().decode(errors='replace'))
+    return reply
+
+def parseValues(reply):
+    """Parse the VALUE lines of a retrieval reply
+    :param reply: bytestring reply terminated by END
+    :return: dictionary of bytestring key to (flags, value, cas unique or None)
+    """
+    checkReply(reply)
+    values = {}
+    position = 0
+    while reply.startswith(b'VALUE ', position):
+        lineEnd = reply.find(b'\r\n', position)
+        params = reply[position:lineEnd].split()
+        valueEnd = lineEnd + 2 + int(params[3])
+        values[params[1]] = (int(params[2]), reply[lineEnd + 2:valueEnd], int(params[4]) if len(params) > 4 else None)
+        position = valueEnd + 2
+    return values
+
+class ClientBase:
+    """Commands of the memcached clients, independent of how the replies are read
+    Every command is planned as the command lines to send to each node and a function turning the replies
+    of every node into the result, so the blocking and the asyncio clients only differ in how they send them.
+    The commands sent to one node are pipelined in a single write
+    """
+    MAX_KEY_LENGTH = 250
+    MAX_LINE_LENGTH = 2048 # Bytes, retrieval commands for more keys are split in several lines
+    DEFAULT_POOL_SIZE = 8 # Connections per node
+    DEFAULT_TIMEOUT = 5 # Seconds
+
+    def __init__(self, servers):
+        """
+        :param servers: list of 'host:port' strings or (host, port) tuples
+        :no return:
+        """
+        self.ring = HashRing(nodeName(server) for server in servers)
+
+    def keysByNode(self, keys):
+        """
+        :param keys: iterable of string or bytestring keys
+        :return: dictionary of node name to dictionary of bytestring key to the key as it was given
+        """
+        nodes = {}
+        for key in keys:
+            encodedKey = encodeKey(key)
+            nodes.setdefault(self.ring.node(encodedKey), {})[encodedKey] = key
+        return nodes
+
+    def singleCommand(self, key, line, finish, multiLine=False):
+        """Plan a command for a single key
+        :param key: bytestring key
+        :param line: bytestring command to send
+        :param finish: function turning the reply into the result
+        :param multiLine: whether the reply is terminated by END
+        :return: (dictionary of node name to list of (bytestring command, multiLine), function of the replies)
+        """
+        node = self.ring.node(key)
+        return {node: [(line, multiLine)]}, lambda replies: finish(replies[node][0])
+
+    def getManyPlan(self, keys, withCas=False):
+        """Plan a retrieval of keys stored on several nodes, with as few get lines per node as the line length allows
+        :param keys: iterable of string or bytestring keys
+        :param withCas: whether to send gets and return the cas uniques
+        :return: plan as returned by singleCommand, resulting in a dictionary of the given key to value
+                 or to (value, cas unique) with withCas
+        """
+        command = b'gets' if withCas else b'get'
+        nodeKeys = self.keysByNode(keys)
+        commands = {}
+        for node, encodedKeys in nodeKeys.items():
+            lines = []
+            line = command
+            for key in encodedKeys:
+                if len(line) + len(key) + 3 > self.MAX_LINE_LENGTH:
+                    lines.append((line + b'\r\n', True))
+                    line = command
+                line += b' ' + key
+            lines.append((line + b'\r\n', True))
+            commands[node] = lines
+
+        def finish(replies):
+            results = {}
+            for node, nodeReplies in replies.items():
+                for reply in nodeReplies:
+                    for key, (flags, value, casUnique) in parseValues(reply).items():
+                        if key in nodeKeys[node]:
+                            results[nodeKeys[node][key]] = (value, casUnique) if withCas else value
+            return results
+
+        return commands, finish
+
+    def storePlan(self, command, key, value, exptime=0, flags=0, casUnique=None):
+        """
+        :param command: bytestring storage command name
+        :param key: string or bytestring key
+        :param value: string or bytestring value
+        :param exptime: <exptime> of the item
+        :param flags: 16 bit unsigned client flags
+        :param casUnique: cas unique of the cas command
+        :return: plan resulting in True if the value was stored
+        """
+        key = encodeKey(key)
+        return self.singleCommand(key, self.storageLine(command, key, value, exptime, flags, casUnique), self.stored)
+
+    def storageLine(self, command, key, value, exptime=0, flags=0, casUnique=None):
+        """
+        :return: bytestring of the command line and the data block of a storage command
+        """
+        value = encodeValue(value)
+        line = b'%s %s %d %d %d' % (command, key, flags, exptime, len(value))
+        if casUnique is not None:
+            line += b' %d' % casUnique
+        return line + b'\r\n' + value + b'\r\n'
+
+    def stored(self, reply):
+        return checkReply(reply) == b'STORED\r\n'
+
+    def setManyPlan(self, values, exptime=0, flags=0):
+        """Plan a set of many keys, pipelined in a single write per node
+        :param values: dictionary of string or bytestring key to value
+        :param exptime: <exptime> of the items
+        :param flags: 16 bit unsigned client flags of the items
+        :return: plan resulting in the list of keys that weren't stored
+        """
+        nodeKeys = self.keysByNode(values)
+        commands = {node: [(self.storageLine(b'set', key, values[givenKey], exptime, flags), False) for key, givenKey in encodedKeys.items()]
+                    for node, encodedKeys in nodeKeys.items()}
+
+        def finish(replies):
+            return [givenKey for node, encodedKeys in nodeKeys.items()
+                    for givenKey, reply in zip(encodedKeys.values(), replies[node]) if not self.stored(reply)]
+
+        return commands, finish
+
+    def deletePlan(self, key):
+        """
+        :return: plan resulting in True if the key was deleted
+        """
+        key = encodeKey(key)
+        return self.singleCommand(key, b'delete ' + key + b'\r\n', self.deleted)
+
+    def deleted(self, reply):
+        return checkReply(reply) == b'DELETED\r\n'
+
+    def deleteManyPlan(self, keys):
+        """Plan a delete of many keys, pipelined in a single write per node
+        :return: plan resulting in the number of keys that were deleted
+        """
+        nodeKeys = self.keysByNode(keys)
+        commands = {node: [(b'delete ' + key + b'\r\n', False) for key in encodedKeys] for node, encodedKeys in nodeKeys.items()}
+        return commands, lambda replies: sum(self.deleted(reply) for nodeReplies in replies.values() for reply in nodeReplies)
+
+    def counterPlan(self, command, key, delta):
+        """
+        :param command: b'incr' or b'decr'
+        :param delta: non negative integer
+        :return: plan resulting in the new value or None if the key isn't stored
+        """
+        key = encodeKey(key)
+        return self.singleCommand(key, b'%s %s %d\r\n' % (command, key, delta), self.counterValue)
+
+    def counterValue(self, reply):
+        if checkReply(reply) == b'NOT_FOUND\r\n':
+            return None
+        return int(reply)
+
+    def touchPlan(self, key, exptime):
+        """
+        :return: plan resulting in True if the key was touched
+        """
+        key = encodeKey(key)
+        return self.singleCommand(key, b'touch %s %d\r\n' % (key, exptime), lambda reply: checkReply(reply) == b'TOUCHED\r\n')
+
+class Connection:
+    """Blocking connection to a memcached server"""
+    def __init__(self, host, port, timeout):
+        self.socket = socket.create_connection((host, port), timeout=timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.receiveBuffer = bytearray()
+
+    def request(self, commands):
+        """Send pipelined commands in a single write and read their replies
+        :param commands: list of (bytestring command, multiLine)
+        :return: list of bytestring replies
+        """
+        self.socket.sendall(b''.join(command for command, multiLine in commands))
+        return [self.readReply(multiLine) for command, multiLine in commands]
+
+    def readReply(self, multiLine):
+        while True:
+            end = replyEnd(self.receiveBuffer, 0, multiLine)
+            if end != -1:
+                reply = bytes(self.receiveBuffer[:end])
+                del self.receiveBuffer[:end]
+                return reply
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionError('connection closed by the memcached server')
+            self.receiveBuffer += data
+
+    def close(self):
+        self.socket.close()
+
+class ConnectionPool:
+    """Connections to one node shared by the threads of a Client
+    A connection is only reused once its replies were read, one that failed is closed
+    """
+    def __init__(self, node, size, timeout):
+        """
+        :param node: 'host:port' node name
+        :param size: maximum number of connections, further requests wait for one to be released
+        :param timeout: seconds to wait for a connection or a reply
+        :no return:
+        """
+        self.address = nodeAddress(node)
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError('no free connection to {}:{}'.format(*self.address))
+        try:
+            with self.lock:
+                connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                connection = Connection(*self.address, self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            with self.lock:
+                self.idle.append(connection)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for connection in self.idle:
+                connection.close()
+            self.idle.clear()
+
+class Client(ClientBase):
+    """Blocking memcached client for several servers, safe to share between threads
+    Keys are spread over the servers by consistent hashing, see HashRing
+    """
+    def __init__(self, servers, poolSize=ClientBase.DEFAULT_POOL_SIZE, timeout=ClientBase.DEFAULT_TIMEOUT):
+        """
+        :param servers: list of 'host:port' strings or (host, port) tuples
+        :param poolSize: maximum number of connections per server
+        :param timeout: seconds to wait for a connection or a reply
+        :no return:
+        """
+        super().__init__(servers)
+        self.pools = {node: ConnectionPool(node, poolSize, timeout) for node in self.ring.nodes}
+
+    def run(self, commands, finish):
+        """
+        :param commands: dictionary of node name to list of (bytestring command, multiLine)
+        :param finish: function turning the dictionary of node name to list of replies into the result
+        :return: result of the command
+        """
+        replies = {}
+        for node, nodeCommands in commands.items():
+            with self.pools[node].connection() as connection:
+                replies[node] = connection.request(nodeCommands)
+        return finish(replies)
+
+    def get(self, key):
+        return self.run(*self.getManyPlan([key])).get(key)
+
+    def gets(self, key):
+        """
+        :return: (value, cas unique) or None if the key isn't stored
+        """
+        return self.run(*self.getManyPlan([key], withCas=True)).get(key)
+
+    def getMany(self, keys):
+        """
+        :return: dictionary of the stored keys to their values
+        """
+        return self.run(*self.getManyPlan(keys))
+
+    def set(self, key, value, exptime=0, flags=0):
+        return self.run(*self.storePlan(b'set', key, value, exptime, flags))
+
+    def add(self, key, value, exptime=0, flags=0):
+        return self.run(*self.storePlan(b'add', key, value, exptime, flags))
+
+    def replace(self, key, value, exptime=0, flags=0):
+        return self.run(*self.storePlan(b'replace', key, value, exptime, flags))
+
+    def append(self, key, value):
+        return self.run(*self.storePlan(b'append', key, value))
+
+    def prepend(self, key, value):
+        return self.run(*self.storePlan(b'prepend', key, value))
+
+    def cas(self, key, value, casUnique, exptime=0, flags=0):
+        return self.run(*self.storePlan(b'cas', key, value, exptime, flags, casUnique))
+
+    def setMany(self, values, exptime=0, flags=0):
+        """
+        :return: list of the keys that weren't stored
+        """
+        return self.run(*self.setManyPlan(values, exptime, flags))
+
+    def delete(self, key):
+        return self.run(*self.deletePlan(key))
+
+    def deleteMany(self, keys):
+        """
+        :return: number of keys that were deleted
+        """
+        return self.run(*self.deleteManyPlan(keys))
+
+    def incr(self, key, delta=1):
+        return self.run(*self.counterPlan(b'incr', key, delta))
+
+    def decr(self, key, delta=1):
+        return self.run(*self.counterPlan(b'decr', key, delta))
+
+    def touch(self, key, exptime):
+        return self.run(*self.touchPlan(key, exptime))
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+class AsyncConnection:
+    """asyncio stream connection to a memcached server"""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.receiveBuffer = bytearray()
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, commands):
+        """Send pipelined commands in a single write and read their replies
+        :param commands: list of (bytestring command, multiLine)
+        :return: list of bytestring replies
+        """
+        self.writer.write(b''.join(command for command, multiLine in commands))
+        return [await self.readReply(multiLine) for command, multiLine in commands]
+
+    async def readReply(self, multiLine):
+        while True:
+            end = replyEnd(self.receiveBuffer, 0, multiLine)
+            if end != -1:
+                reply = bytes(self.receiveBuffer[:end])
+                del self.receiveBuffer[:end]
+                return reply
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError('connection closed by the memcached server')
+            self.receiveBuffer += data
+
+    def close(self):
+        self.writer.close()
+
+class AsyncConnectionPool:
+    """Connections to one node shared by the tasks of an AsyncClient"""
+    def __init__(self, node, size, timeout):
+        """
+        :param node: 'host:port' node name
+        :param size: maximum number of connections, further requests wait for one to be released
+        :param timeout: seconds to wait for a connection or a reply
+        :no return:
+        """
+        self.address = nodeAddress(node)
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self.slots:
+            connection = self.idle.pop() if self.idle else None
+            if connection is None:
+                connection = await asyncio.wait_for(AsyncConnection.open(*self.address), self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self.idle.append(connection)
+
+    def close(self):
+        for connection in self.idle:
+            connection.close()
+        self.idle.clear()
+
+class AsyncClient(ClientBase):
+    """asyncio memcached client for several servers, the commands for different servers are sent concurrently
+    Keys are spread over the servers by consistent hashing, see HashRing
+    """
+    def __init__(self, servers, poolSize=ClientBase.DEFAULT_POOL_SIZE, timeout=ClientBase.DEFAULT_TIMEOUT):
+        """
+        :param servers: list of 'host:port' strings or (host, port) tuples
+        :param poolSize: maximum number of connections per server
+        :param timeout: seconds to wait for a connection or a reply
+        :no return:
+        """
+        super().__init__(servers)
+        self.timeout = timeout
+        self.pools = {node: AsyncConnectionPool(node, poolSize, timeout) for node in self.ring.nodes}
+
+    async def request(self, node, commands):
+        async with self.pools[node].connection() as connection:
+            return await asyncio.wait_for(connection.request(commands), self.timeout)
+
+    async def run(self, commands, finish):
+        """
+        :param commands: dictionary of node name to list of (bytestring command, multiLine)
+        :param finish: function turning the dictionary of node name to list of replies into the result
+        :return: result of the command
+        """
+        nodes = list(commands)
+        replies = await asyncio.gather(*(self.request(node, commands[node]) for node in nodes))
+        return finish(dict(zip(nodes, replies)))
+
+    async def get(self, key):
+        return (await self.run(*self.getManyPlan([key]))).get(key)
+
+    async def gets(self, key):
+        """
+        :return: (value, cas unique) or None if the key isn't stored
+        """
+        return (await self.run(*self.getManyPlan([key], withCas=True))).get(key)
+
+    async def getMany(self, keys):
+        """
+        :return: dictionary of the stored keys to their values
+        """
+        return await self.run(*self.getManyPlan(keys))
+
+    async def set(self, key, value, exptime=0, flags=0):
+        return await self.run(*self.storePlan(b'set', key, value, exptime, flags))
+
+    async def add(self, key, value, exptime=0, flags=0):
+        return await self.run(*self.storePlan(b'add', key, value, exptime, flags))
+
+    async def replace(self, key, value, exptime=0, flags=0):
+        return await self.run(*self.storePlan(b'replace', key, value, exptime, flags))
+
+    async def append(self, key, value):
+        return await self.run(*self.storePlan(b'append', key, value))
+
+    async def prepend(self, key, value):
+        return await self.run(*self.storePlan(b'prepend', key, value))
+
+    async def cas(self, key, value, casUnique, exptime=0, flags=0):
+        return await self.run(*self.storePlan(b'cas', key, value, exptime, flags, casUnique))
+
+    async def setMany(self, values, exptime=0, flags=0):
+        """
+        :return: list of the keys that weren't stored
+        """
+        return await self.run(*self.setManyPlan(values, exptime, flags))
+
+    async def delete(self, key):
+        return await self.run(*self.deletePlan(key))
+
+    async def deleteMany(self, keys):
+        """
+        :return: number of keys that were deleted
+        """
+        return await self.run(*self.deleteManyPlan(keys))
+
+    async def incr(self, key, delta=1):
+        return await self.run(*self.counterPlan(b'incr', key, delta))
+
+    async def decr(self, key, delta=1):
+        return await self.run(*self.counterPlan(b'decr', key, delta))
+
+    async def touch(self, key, exptime):
+        return await self.run(*self.touchPlan(key, exptime))
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
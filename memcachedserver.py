@@ -4,20 +4,64 @@
 import asyncio
 
 # Handle the task of getting the absolute path for the current working directory
-import os.path
+import os
+
+# Chunks of the large replies waiting for the transport to drain, produced as it drains
+from collections import deque
+from itertools import chain
 
 # Handle command line arguments
 import argparse
 
-# Sqlite
-import sqlite3
-from sqlite3 import Error
+# Flush the persisted writes when the server is terminated
+import signal
+
+# Convert the <exptime> of the storage commands to unix times
+import time
+
+# Tell whether the transport keeps the replies it couldn't send without copying them
+import sys
+
+# In memory storage engine that serves every hit without touching the database
+from itemstore import ItemStore, ItemTooLarge
+from compression import ValueCompressor
+from eviction import EVICTION_POLICIES, LRUPolicy
+from serverstats import MetricsFeed, ServerStats
+from hotkeys import HotKeys
+
+# Meta commands: mg, ms, md and ma with their single letter flags
+from metaprotocol import MetaCommand, MetaCommandError
+
+# Binary protocol, chosen by the magic byte a connection starts with
+import binaryprotocol
+from binaryprotocol import BinaryRequest
+
+# Write-behind persistence of the items in a sqlite database
+from sqlitestorage import ShardedSqliteStorage, SqliteStorage, shardFiles
+from workerpeers import WorkerPeers, peerSocketPath
+
+# Warm restarts from a snapshot of the items
+from snapshot import Snapshotter, SnapshotError, loadSnapshot
 
 class MemcachedServer(asyncio.Protocol):
     """Implementation of the Memcached Protocol with Asyncio
     Static variables are for constants
     """
-    TIMEOUT = 60 # Seconds
+    TIMEOUT = 60 # Seconds a client connection can stay idle
+    MAX_CONNECTIONS = 1024
+    WRITE_BUFFER_HIGH = 256 * 1024 # Bytes of unsent replies that stop the processing of the client's commands
+    WRITE_BUFFER_LOW = 64 * 1024 # Bytes of unsent replies the processing resumes at
+    MAX_RECEIVE_BUFFER = 256 * 1024 # Bytes of unprocessed commands buffered while a command waits
+    MAX_LINE_LENGTH = 2048 # Bytes
+    MAX_ITEM_SIZE = 1024 * 1024 # Bytes, the largest value a client can store, like memcached's -I
+    STREAMED_DATA_BLOCK = 64 * 1024 # Bytes from which a data block is copied straight into a buffer of its size
+    WRITE_CHUNK_SIZE = 64 * 1024 # Bytes of a large reply handed to the transport at a time
+    TRANSPORT_KEEPS_VIEWS = sys.version_info >= (3, 12) # Earlier transports copy the buffers they couldn't send
+    MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30 # Seconds, larger <exptime> values are unix times
+    DEFAULT_MEMORY_LIMIT = 64 # Megabytes
+    DRAIN_TIMEOUT = 10 # Seconds the commands in flight are given to finish when the server is stopped
+    # Replies the q flag suppresses for each meta command, the reply of a forwarded command starts with one of them
+    QUIET_REPLIES = {b'mg': (b'EN',), b'ms': (b'HD',), b'md': (b'HD', b'NF'), b'ma': (b'HD',)}
     CLIENT_ERROR_FORMATTING_SET = b'CLIENT_ERROR incorrect # of arguments for set command\r\n'
     CLIENT_ERROR_FORMATTING_SET_NOREPLY = b'CLIENT_ERROR incorrect 6th argument to set command. Expected \'noreply\'\r\n'
     CLIENT_ERROR_FORMATTING_SET_KEY_LENGTH_TOO_LONG = b'CLIENT_ERROR key length of set command exceeds 250 characters\r\n'
@@ -25,6 +69,12 @@ class MemcachedServer(asyncio.Protocol):
     CLIENT_ERROR_FORMATTING_SET_NOT_NUMERIC_VALUES = b'CLIENT_ERROR at least one of the <flags> <exptime> <bytes> parameters contained one or more non-digit character\r\n'
     CLIENT_ERROR_FORMATTING_SET_FLAGS_VALUE = b'CLIENT_ERROR the <flags> parameter is greater than the 16 bit unsigned maximum of 65535\r\n'
 
+    CLIENT_ERROR_LINE_TOO_LONG = b'CLIENT_ERROR line too long\r\n'
+    CLIENT_ERROR_BAD_COMMAND_LINE = b'CLIENT_ERROR bad command line format\r\n'
+    CLIENT_ERROR_INVALID_DELTA = b'CLIENT_ERROR invalid numeric delta argument\r\n'
+    CLIENT_ERROR_NON_NUMERIC_VALUE = b'CLIENT_ERROR cannot increment or decrement non-numeric value\r\n'
+    CLIENT_ERROR_BAD_DATA_CHUNK = b'CLIENT_ERROR bad data chunk\r\n'
+
     CLIENT_ERROR_FORMATTING_GET = b'CLIENT_ERROR incorrect # of arguments for get command\r\n'
 
     CLIENT_ERROR_FORMATTING_DELETE = b'CLIENT_ERROR incorrect # of arguments for delete command\r\n'
@@ -33,202 +83,1634 @@ class MemcachedServer(asyncio.Protocol):
     SERVER_ERROR_SET_FAILURE = b'SERVER_ERROR error storing data\r\n'
     SERVER_ERROR_GET_FAILURE = b'SERVER_ERROR error retrieving stored data\r\n'
     SERVER_ERROR_DELETE_FAILURE = b'SERVER_ERROR error deleting stored data\r\n'
+    SERVER_ERROR_OBJECT_TOO_LARGE = b'SERVER_ERROR object too large for cache\r\n'
+    SERVER_ERROR_TOO_MANY_CONNECTIONS = b'SERVER_ERROR too many open connections\r\n'
 
     SET_SUCCESS = b'STORED\r\n'
     DELETE_SUCCESS = b'DELETED\r\n'
+    TOUCH_SUCCESS = b'TOUCHED\r\n'
 
     DELETE_NOT_FOUND = b'NOT FOUND\r\n'
+    NOT_STORED = b'NOT_STORED\r\n'
+    NOT_FOUND = b'NOT_FOUND\r\n'
+    EXISTS = b'EXISTS\r\n'
+
+    STORAGE_COMMANDS = (b'set', b'add', b'replace', b'append', b'prepend', b'cas')
+    RETRIEVAL_COMMANDS = (b'get', b'gets', b'gat', b'gats')
+    META_COMMANDS = (b'mg', b'ms', b'md', b'ma')
+    MAX_COUNTER_VALUE = 2 ** 64 - 1
+    TIMED_COMMANDS = frozenset(STORAGE_COMMANDS + RETRIEVAL_COMMANDS + META_COMMANDS + (b'delete', b'incr', b'decr', b'touch', b'stats'))
 
     END = b'END\r\n'
+    CRLF = b'\r\n'
 
-    def __init__(self, databaseFile):
-        """Timeout implementation to limit client connections that are not going to provide input
+    def __init__(self, storage=None, itemStore=None, peers=None, connections=None, stats=None,
+                 idleTimeout=TIMEOUT, maxConnections=None, maxItemSize=MAX_ITEM_SIZE, metricsFeed=None, isPeer=False):
+        """Timeout implementation to limit client connections that stop sending commands
         Also sets a flag that will be usec to receive data blocks on set commands
-        :param databaseFile: full path to a sqlite database file
+        and the buffer that holds received bytes until a full command line or data block has arrived
+        or until the storage finished the command in progress
+        :param storage: SqliteStorage or ShardedSqliteStorage shared by every client connection or None to run without persistence
+        :param itemStore: ItemStore shared by every client connection
+        :param peers: WorkerPeers owning the keys when the server runs as one of several worker processes
+        :param connections: set of the open connections the server drains when it's stopped
+        :param stats: ServerStats shared by every client connection
+        :param idleTimeout: seconds without receiving anything after which the connection is closed, 0 to never close it
+        :param maxConnections: number of open connections above which new clients are turned away, None for no limit
+        :param maxItemSize: bytes of the largest value a client can store
+        :param metricsFeed: MetricsFeed shared by every client connection, sending the metrics to the watch metrics command
+        :param isPeer: whether the connections are the ones the other workers forward their clients' commands over,
+                       they aren't client connections in the stats and in the connection limit
         :no return:
         """
-        self.databaseFile = databaseFile
+        self.storage = storage
+        self.peers = peers
+        self.connections = connections
+        if itemStore is None:
+            itemStore = ItemStore(self.DEFAULT_MEMORY_LIMIT * 1024 * 1024)
+        self.itemStore = itemStore
+        if stats is None:
+            stats = ServerStats()
+        self.stats = stats
+        if metricsFeed is None:
+            metricsFeed = MetricsFeed(stats, itemStore)
+        self.metricsFeed = metricsFeed
+        self.watchingMetrics = False
         self.expectingDataBlock = None
+        self.expectingMetaCommand = None # MetaCommand of an ms command waiting for its data block
+        self.receiveBuffer = bytearray()
+        # A large data block is received in a buffer of its final size, a rejected one is discarded as it arrives
+        self.maxItemSize = maxItemSize
+        self.dataBlock = None
+        self.dataBlockReceived = 0
+        self.swallowBytes = 0
+        self.unsentBuffers = deque() # generators of the chunks of large replies waiting for the transport to drain
+        self.binaryProtocol = None # whether the client speaks the binary protocol, known once it sent a byte
+        self.closing = False
+        self.draining = False
+        self.pendingTask = None
+        self.accepted = False
+        self.maxConnections = maxConnections
+        self.isPeer = isPeer
+        # Flow control: the commands aren't processed while the replies can't be written,
+        # and the client isn't read while its commands can't be processed
+        self.writingPaused = False
+        self.readingPaused = False
+        # The idle timer isn't re-armed on every read, it checks the time of the last read when it fires
+        self.idleTimeout = idleTimeout
+        self.lastActivity = time.monotonic()
+        self.timeout_handle = None
         try:
             loop = asyncio.get_running_loop()
-            self.timeout_handle = loop.call_later(self.TIMEOUT, self._timeout)
+            if idleTimeout:
+                self.timeout_handle = loop.call_later(idleTimeout, self._timeout)
         except RuntimeError:
             print(self.__class__.__name__, ' is being instantiated without a running event loop')
 
-    def create_sqlite_connection(self):
-        """ create a database connection to the SQLite database
-            specified by the class's self.databaseFile variable
-        :return: Connection object or None
-        """
-        connection = None
-        try:
-            connection = sqlite3.connect(self.databaseFile)
-        except Error as error:
-            print(error)
-
-        return connection
-
     def connection_made(self, transport):
         """Method called when a client connection is made
         :param transport: object representing the connection to the client
         :no return:
         """
         self.transport = transport
-        self.sqliteConnection = self.create_sqlite_connection()
+        if not self.isPeer:
+            if self.maxConnections is not None and self.stats.currConnections >= self.maxConnections:
+                self.stats.rejectedConnections += 1
+                transport.write(self.SERVER_ERROR_TOO_MANY_CONNECTIONS)
+                self.closeConnection()
+                return
+            self.accepted = True
+            self.stats.currConnections += 1
+            self.stats.totalConnections += 1
+        transport.set_write_buffer_limits(self.WRITE_BUFFER_HIGH, self.WRITE_BUFFER_LOW)
+        if self.connections is not None:
+            self.connections.add(self)
 
     def connection_lost(self, exc):
         """Method called when connection with client is closed
         :param exc: Python exception or None if connection closed by server
         :no return:
         """
+        self.closing = True
+        if self.timeout_handle is not None:
+            self.timeout_handle.cancel()
+        if self.accepted:
+            self.stats.currConnections -= 1
+        if self.watchingMetrics:
+            self.metricsFeed.unwatch(self)
+        if self.connections is not None:
+            self.connections.discard(self)
         if exc is not None:
             self.transport.close()
 
+    def pause_writing(self):
+        """Method called when the unsent replies reach the high water mark of the transport
+        The buffered commands wait until the client read its replies
+        :no return:
+        """
+        self.writingPaused = True
+        self.updateReading()
+
+    def resume_writing(self):
+        """Method called when the unsent replies drained below the low water mark of the transport
+        :no return:
+        """
+        self.writingPaused = False
+        self.writeUnsentBuffers()
+        self.updateReading()
+        if self.pendingTask is None and not self.closing and not self.writingPaused:
+            self.handleReceivedData(b'')
+
+    def updateReading(self):
+        """Pause reading from the client while its replies can't be written or while its commands pile up
+        behind a command waiting on the storage, so the buffers of a connection stay bounded
+        :no return:
+        """
+        pause = self.draining or self.writingPaused or \
+            (self.pendingTask is not None and len(self.receiveBuffer) > self.MAX_RECEIVE_BUFFER)
+        if pause != self.readingPaused and not self.closing:
+            self.readingPaused = pause
+            if pause:
+                self.transport.pause_reading()
+            else:
+                self.transport.resume_reading()
+
     def data_received(self, data):
         """Method called when data received from client
         :param data: bytestring from client
         :no return:
         """
-        self.timeout_handle.cancel()
+        self.lastActivity = time.monotonic()
+        self.stats.bytesRead += len(data)
         self.handleReceivedData(data)
 
-    def handleReceivedData(self, data):
-        """Decisioning method for deciphering commands and client errors
-        :param data: bytestring of input
+    def write(self, data):
+        """Write a reply to the client
+        :param data: bytestring
         :no return:
         """
-
-        if self.expectingDataBlock:
-            self.setKeyData(data)
+        if self.unsentBuffers or len(data) > self.WRITE_CHUNK_SIZE:
+            self.writeChunks([data])
         else:
-            commandParams = data.split()
-            if len(commandParams) == 0:
-                self.transport.write(b'ERROR\r\n')
+            self.stats.bytesWritten += len(data)
+            self.transport.write(data)
+
+    def writelines(self, buffers):
+        """Write a reply made of several buffers to the client, only a reply that fits in a chunk is
+        produced whole, a larger one is produced a chunk at a time as the transport drains
+        :param buffers: iterable of bytestrings or memoryviews, a generator produces them lazily
+        :no return:
+        """
+        buffers = iter(buffers)
+        if not self.unsentBuffers:
+            head = []
+            length = 0
+            for buffer in buffers:
+                head.append(buffer)
+                length += len(buffer)
+                if length > self.WRITE_CHUNK_SIZE:
+                    buffers = chain(head, buffers)
+                    break
+            else:
+                self.stats.bytesWritten += length
+                self.transport.writelines(head)
+                self.retainUnsent(head)
                 return
+        self.writeChunks(buffers)
 
-            if commandParams[0] == b'quit':
-                self.transport.close()
-            elif commandParams[0] == b'set':
-                if len(commandParams) < 5 or len(commandParams) > 6:
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_SET)
-                elif len(commandParams) == 6 and commandParams[5] != b'noreply':
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_SET_NOREPLY)
-                elif len(commandParams[1]) > 250:
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_SET_KEY_LENGTH_TOO_LONG)
+    def writeChunks(self, buffers):
+        """Write a large reply a chunk at a time, the rest of the reply once the transport reached its high
+        water mark is produced and written when it drained, so neither a large value nor a large multi-get
+        is copied whole into the transport
+        Replies written in the meantime are queued behind it to stay in order
+        :param buffers: iterable of bytestrings or memoryviews
+        :no return:
+        """
+        self.unsentBuffers.append(self.chunks(buffers))
+        self.writeUnsentBuffers()
+
+    def chunks(self, buffers):
+        """
+        :param buffers: iterable of bytestrings or memoryviews
+        :return: generator of lists of at most WRITE_CHUNK_SIZE bytes of the buffers, a larger buffer is
+                 split in memoryviews and the smaller ones are grouped
+        """
+        chunk = []
+        chunkLength = 0
+        for buffer in buffers:
+            if chunkLength + len(buffer) > self.WRITE_CHUNK_SIZE:
+                if chunk:
+                    yield chunk
+                    chunk = []
+                    chunkLength = 0
+                if len(buffer) > self.WRITE_CHUNK_SIZE:
+                    view = memoryview(buffer)
+                    for start in range(0, len(view), self.WRITE_CHUNK_SIZE):
+                        yield [view[start:start + self.WRITE_CHUNK_SIZE]]
+                    continue
+            chunk.append(buffer)
+            chunkLength += len(buffer)
+        if chunk:
+            yield chunk
+
+    def writeUnsentBuffers(self):
+        """Hand the queued chunks to the transport until it asks to pause writing
+        :no return:
+        """
+        unsentBuffers = self.unsentBuffers
+        while unsentBuffers and not self.writingPaused and not self.closing:
+            chunk = next(unsentBuffers[0], None)
+            if chunk is None:
+                unsentBuffers.popleft()
+            else:
+                if len(chunk) == 1:
+                    self.stats.bytesWritten += len(chunk[0])
+                    self.transport.write(chunk[0])
                 else:
-                    try:
-                        flags = int(commandParams[2].decode())
-                        if flags > 65535:
-                            self.transport.write(self.CLIENT_ERROR_FORMATTING_SET_FLAGS_VALUE)
-                            return
-                        expTime = int(commandParams[3].decode())
-                        dataBlockBytes = int(commandParams[4].decode())
-                        if flags < 0 or expTime < 0 or dataBlockBytes < 0:
-                            raise ValueError('Negative numbers not allowed')
-                        self.expectingDataBlock = commandParams
-                    except Exception as error:
-                        print(error)
-                        self.transport.write(self.CLIENT_ERROR_FORMATTING_SET_NOT_NUMERIC_VALUES)
-            elif commandParams[0] == b'get':
-                if len(commandParams) < 2:
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_GET)
+                    self.stats.bytesWritten += sum(map(len, chunk))
+                    self.transport.writelines(chunk)
+                self.retainUnsent(chunk)
+
+    def retainUnsent(self, buffers):
+        """Replies are views of the slab pages, the pages of the buffers the transport couldn't send yet are
+        copied before they're written again instead of copying every reply
+        :param buffers: list of bytestrings or memoryviews just handed to the transport
+        :no return:
+        """
+        if self.TRANSPORT_KEEPS_VIEWS and self.transport.get_write_buffer_size():
+            self.itemStore.slabs.retain(buffers)
+
+    def handleReceivedData(self, data):
+        """Buffers the received bytes and consumes every complete command line and data block in them
+        Pipelined commands can arrive merged into one chunk and large data blocks can be split across
+        several chunks, so data blocks are read by the <bytes> count of their set command instead of by line.
+        Processing stops while a command waits on the storage so the replies stay in order
+        :param data: bytestring of input
+        :no return:
+        """
+        self.receiveBuffer += data
+        receiveBuffer = self.receiveBuffer
+        if self.binaryProtocol is None:
+            if not receiveBuffer:
+                return
+            self.binaryProtocol = receiveBuffer[0] == binaryprotocol.REQUEST_MAGIC
+        if self.binaryProtocol:
+            self.handleBinaryData()
+            return
+
+        offset = 0
+        while not self.closing and self.pendingTask is None and not self.writingPaused:
+            if self.swallowBytes:
+                offset = self.swallowData(offset)
+                if self.swallowBytes:
+                    break
+            elif self.expectingDataBlock:
+                command = self.expectingDataBlock[0]
+                # <bytes> follows the key of an ms command
+                dataBlockLength = int(self.expectingDataBlock[2 if command == b'ms' else 4]) + 2
+                if dataBlockLength > self.STREAMED_DATA_BLOCK:
+                    offset = self.streamDataBlock(offset, dataBlockLength)
+                    if self.dataBlockReceived < dataBlockLength:
+                        break
+                    dataBlock = self.dataBlock
+                    self.dataBlock = None
                 else:
-                    self.getKeyData(commandParams)
-            elif commandParams[0] == b'delete':
-                if len(commandParams) < 2 or len(commandParams) > 3:
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_DELETE)
-                elif len(commandParams) == 3 and commandParams[2] != b'noreply':
-                    self.transport.write(self.CLIENT_ERROR_FORMATTING_DELETE_NOREPLY)
+                    dataBlockEnd = offset + dataBlockLength
+                    if len(receiveBuffer) < dataBlockEnd:
+                        break
+                    dataBlock = bytes(receiveBuffer[offset:dataBlockEnd])
+                    offset = dataBlockEnd
+                started = time.perf_counter_ns()
+                if command == b'ms':
+                    self.metaSetKeyData(dataBlock)
                 else:
-                    self.deleteKeyData(commandParams)
+                    self.setKeyData(dataBlock)
+                self.commandFinished(command, started)
             else:
-                self.transport.write(b'ERROR\r\n')
+                lineEnd = receiveBuffer.find(b'\n', offset)
+                if lineEnd == -1:
+                    if len(receiveBuffer) - offset > self.MAX_LINE_LENGTH:
+                        self.write(self.CLIENT_ERROR_LINE_TOO_LONG)
+                        self.closeConnection()
+                    break
+                line = bytes(receiveBuffer[offset:lineEnd + 1])
+                offset = lineEnd + 1
+                self.handleCommandLine(line)
+
+        if self.closing:
+            receiveBuffer.clear()
+        else:
+            del receiveBuffer[:offset]
+            self.updateReading()
+
+    def swallowData(self, offset):
+        """Discard the received bytes of a data block that was rejected before it arrived
+        :param offset: offset in the receive buffer the data block continues at
+        :return: offset in the receive buffer after the discarded bytes
+        """
+        swallowed = min(self.swallowBytes, len(self.receiveBuffer) - offset)
+        self.swallowBytes -= swallowed
+        return offset + swallowed
+
+    def streamDataBlock(self, offset, length):
+        """Copy the received bytes of a large data block into a buffer allocated at its final size,
+        so the receive buffer only ever holds the last chunk read from the socket instead of the whole value
+        :param offset: offset in the receive buffer the data block continues at
+        :param length: number of bytes of the data block, including its \r\n
+        :return: offset in the receive buffer after the copied bytes
+        """
+        if self.dataBlock is None:
+            self.dataBlock = bytearray(length)
+            self.dataBlockReceived = 0
+        copied = min(len(self.receiveBuffer) - offset, length - self.dataBlockReceived)
+        with memoryview(self.dataBlock) as dataBlockView, memoryview(self.receiveBuffer) as receivedView:
+            dataBlockView[self.dataBlockReceived:self.dataBlockReceived + copied] = receivedView[offset:offset + copied]
+        self.dataBlockReceived += copied
+        return offset + copied
+
+    def rejectDataBlock(self, length, reply):
+        """Reject a value larger than the max item size before its data block is received
+        :param length: <bytes> of the command, its data block and \r\n are discarded as they arrive
+        :param reply: bytestring error reply
+        :no return:
+        """
+        self.write(reply)
+        self.swallowBytes = length + 2
+
+    def dataBlockValue(self, dataBlock):
+        """
+        :param dataBlock: bytestring or bytearray of a data block followed by \r\n
+        :return: the value without the \r\n, a streamed bytearray is truncated in place instead of copied
+        """
+        if type(dataBlock) is bytearray:
+            del dataBlock[-2:]
+            return dataBlock
+        return dataBlock[:-2]
+
+    def handleBinaryData(self):
+        """Consume every complete request packet buffered on a binary protocol connection
+        The fixed size header gives the length of the packet, so nothing is split or parsed as text
+        :no return:
+        """
+        receiveBuffer = self.receiveBuffer
+        offset = 0
+        while not self.closing and self.pendingTask is None and not self.writingPaused:
+            if self.swallowBytes:
+                offset = self.swallowData(offset)
+                if self.swallowBytes:
+                    break
+                continue
+            if len(receiveBuffer) - offset < binaryprotocol.HEADER_SIZE:
+                break
+            header = binaryprotocol.HEADER.unpack_from(receiveBuffer, offset)
+            if header[0] != binaryprotocol.REQUEST_MAGIC:
+                self.closeConnection()
+                break
+            # body length minus the key and extras lengths
+            if header[6] - header[2] - header[3] > self.maxItemSize:
+                offset += binaryprotocol.HEADER_SIZE
+                self.write(BinaryRequest(header, b'').errorResponse(binaryprotocol.STATUS_VALUE_TOO_LARGE))
+                self.swallowBytes = header[6]
+                continue
+            packetEnd = offset + binaryprotocol.HEADER_SIZE + header[6]
+            if len(receiveBuffer) < packetEnd:
+                break
+            request = BinaryRequest(header, bytes(receiveBuffer[offset + binaryprotocol.HEADER_SIZE:packetEnd]))
+            offset = packetEnd
+            started = time.perf_counter_ns()
+            self.binaryRequestData(request)
+            command = binaryprotocol.COMMAND_NAMES.get(request.opcode)
+            if command is not None:
+                self.commandFinished(command, started)
+
+        if self.closing:
+            receiveBuffer.clear()
+        else:
+            del receiveBuffer[:offset]
+            self.updateReading()
+
+    def binaryRequestData(self, request):
+        """Decisioning method for the binary protocol requests
+        :param request: BinaryRequest
+        :no return:
+        """
+        opcode = request.opcode
+        if opcode == binaryprotocol.OPCODE_NOOP:
+            self.write(request.response())
+            return
+        if opcode in (binaryprotocol.OPCODE_QUIT, binaryprotocol.OPCODE_QUITQ):
+            if not request.quiet:
+                self.write(request.response())
+            self.closeConnection()
+            return
+        if opcode in binaryprotocol.SET_OPCODES:
+            valid = len(request.extras) == binaryprotocol.SET_EXTRAS.size \
+                and binaryprotocol.SET_EXTRAS.unpack(request.extras)[0] <= MetaCommand.MAX_FLAGS
+        elif opcode in binaryprotocol.GET_OPCODES or opcode in binaryprotocol.DELETE_OPCODES:
+            valid = not request.extras and not request.value
+        else:
+            self.write(request.errorResponse(binaryprotocol.STATUS_UNKNOWN_COMMAND))
+            return
+        if not (valid and request.wellFormed and 0 < len(request.key) <= 250):
+            self.write(request.errorResponse(binaryprotocol.STATUS_INVALID_ARGUMENTS))
+            return
+
+        if self.peers is not None and not self.peers.isLocal(request.key):
+            self.waitFor(self.forwardBinaryRequest(request))
+        elif opcode in binaryprotocol.GET_OPCODES:
+            self.binaryGetKeyData(request)
+        elif opcode in binaryprotocol.SET_OPCODES:
+            self.binarySetKeyData(request)
+        else:
+            self.binaryDeleteKeyData(request)
+
+    def binaryGetKeyData(self, request):
+        """Return an item to a GET, GETQ, GETK or GETKQ request
+        :param request: BinaryRequest
+        :no return:
+        """
+        def get(item):
+            self.stats.cmdGet += 1
+            if item is None:
+                return (b'' if request.quiet else request.errorResponse(binaryprotocol.STATUS_KEY_NOT_FOUND)), None
+            self.stats.getHits += 1
+            return request.itemResponse(item.flags, item.dataBlock, item.casUnique), None
+
+        self.runCommand(request.key, get, False, request.errorResponse(binaryprotocol.STATUS_INTERNAL_ERROR))
+
+    def binarySetKeyData(self, request):
+        """Store the value of a SET or SETQ request, a non zero cas only replaces the item it was read from
+        :param request: BinaryRequest
+        :no return:
+        """
+        key = request.key
+        flags, expiration = binaryprotocol.SET_EXTRAS.unpack(request.extras)
+        exptime = self.expirationTime(expiration)
+        self.stats.cmdSet += 1
+
+        def store(item):
+            if request.cas:
+                if item is None:
+                    self.stats.casMisses += 1
+                    return request.errorResponse(binaryprotocol.STATUS_KEY_NOT_FOUND), None
+                if item.casUnique != request.cas:
+                    self.stats.casBadval += 1
+                    return request.errorResponse(binaryprotocol.STATUS_KEY_EXISTS), None
+                self.stats.casHits += 1
+            reply, pendingWrite = self.storeItem(key, flags, request.value, exptime, None)
+            if reply is not None:
+                return request.errorResponse(binaryprotocol.STATUS_VALUE_TOO_LARGE), None
+            if request.quiet:
+                return b'', pendingWrite
+            # A value the eviction policy didn't keep has no cas unique
+            item = self.itemStore.peek(key)
+            return request.response(cas=item.casUnique if item is not None else 0), pendingWrite
+
+        self.runCommand(key, store, False, request.errorResponse(binaryprotocol.STATUS_INTERNAL_ERROR), readsItem=request.cas != 0)
+
+    def binaryDeleteKeyData(self, request):
+        """Remove the key of a DELETE or DELETEQ request, a non zero cas only deletes the item it was read from
+        :param request: BinaryRequest
+        :no return:
+        """
+        key = request.key
+
+        def delete(item):
+            if item is None:
+                self.stats.deleteMisses += 1
+                return request.errorResponse(binaryprotocol.STATUS_KEY_NOT_FOUND), None
+            if request.cas and item.casUnique != request.cas:
+                return request.errorResponse(binaryprotocol.STATUS_KEY_EXISTS), None
+            self.stats.deleteHits += 1
+            self.itemStore.delete(key)
+            pendingDelete = None
+            if self.storage is not None:
+                pendingDelete = self.storage.delete(key, checkExists=False)
+            return (b'' if request.quiet else request.response()), pendingDelete
+
+        self.runCommand(key, delete, False, request.errorResponse(binaryprotocol.STATUS_INTERNAL_ERROR))
+
+    async def forwardBinaryRequest(self, request):
+        """Forward a request to the worker that owns its key as the equivalent meta command
+        and convert the reply back to a response packet
+        :param request: BinaryRequest of a get, set or delete
+        :no return:
+        """
+        try:
+            reply = await self.peers.forward(self.peers.owner(request.key), request.metaCommand())
+        except Exception as error:
+            print(error)
+            self.write(request.errorResponse(binaryprotocol.STATUS_INTERNAL_ERROR))
+            return
+
+        response = request.metaResponse(reply)
+        if response:
+            self.write(response)
+
+    def handleCommandLine(self, line):
+        """Decisioning method for deciphering commands and client errors
+        :param line: bytestring of a single command line
+        :no return:
+        """
+        started = time.perf_counter_ns()
+        commandParams = line.split()
+        if len(commandParams) == 0:
+            self.write(b'ERROR\r\n')
+            return
+
+        if commandParams[0] == b'quit':
+            self.closeConnection()
+        elif commandParams[0] in self.STORAGE_COMMANDS:
+            error = self.storageCommandError(commandParams)
+            if error is None and int(commandParams[4]) > self.maxItemSize:
+                self.rejectDataBlock(int(commandParams[4]), self.SERVER_ERROR_OBJECT_TOO_LARGE)
+            elif error is None:
+                self.expectingDataBlock = commandParams
+            elif commandParams[0] == b'set':
+                self.write(error)
+            else:
+                self.write(self.CLIENT_ERROR_BAD_COMMAND_LINE)
+        elif commandParams[0] in self.RETRIEVAL_COMMANDS:
+            if len(commandParams) < 2:
+                self.write(self.CLIENT_ERROR_FORMATTING_GET)
+            elif commandParams[0] in (b'gat', b'gats') and (len(commandParams) < 3 or not self.isInteger(commandParams[1])):
+                self.write(self.CLIENT_ERROR_BAD_COMMAND_LINE)
+            else:
+                self.getKeyData(commandParams)
+        elif commandParams[0] == b'delete':
+            if len(commandParams) < 2 or len(commandParams) > 3:
+                self.write(self.CLIENT_ERROR_FORMATTING_DELETE)
+            elif len(commandParams) == 3 and commandParams[2] != b'noreply':
+                self.write(self.CLIENT_ERROR_FORMATTING_DELETE_NOREPLY)
+            else:
+                self.deleteKeyData(commandParams)
+        elif commandParams[0] in (b'incr', b'decr'):
+            if len(commandParams) < 3 or len(commandParams) > 4 or (len(commandParams) == 4 and commandParams[3] != b'noreply'):
+                self.write(self.CLIENT_ERROR_BAD_COMMAND_LINE)
+            elif not commandParams[2].isdigit() or int(commandParams[2]) > self.MAX_COUNTER_VALUE:
+                self.write(self.CLIENT_ERROR_INVALID_DELTA)
+            else:
+                self.counterKeyData(commandParams)
+        elif commandParams[0] == b'touch':
+            if len(commandParams) < 3 or len(commandParams) > 4 or (len(commandParams) == 4 and commandParams[3] != b'noreply') \
+                    or not self.isInteger(commandParams[2]):
+                self.write(self.CLIENT_ERROR_BAD_COMMAND_LINE)
+            else:
+                self.touchKeyData(commandParams)
+        elif commandParams[0] == b'stats':
+            self.statsData(commandParams)
+        elif commandParams[0] in self.META_COMMANDS:
+            self.metaCommandData(commandParams)
+        elif commandParams[0] == b'watch':
+            if commandParams[1:] != [b'metrics']:
+                self.write(self.CLIENT_ERROR_BAD_COMMAND_LINE)
+            else:
+                # The samples of the metrics feed follow as METRICS <json> lines until the connection is closed
+                self.write(b'OK\r\n')
+                self.watchingMetrics = True
+                self.metricsFeed.watch(self)
+        elif commandParams[0] == b'mn':
+            # Meta no-op, a quiet pipeline ends with it so the client knows every reply was received
+            self.write(b'MN\r\n')
+        else:
+            self.write(b'ERROR\r\n')
+
+        # The latency of a storage command is recorded once its data block is handled
+        if commandParams[0] in self.TIMED_COMMANDS and self.expectingDataBlock is None:
+            self.commandFinished(commandParams[0], started)
+
+    def commandFinished(self, command, started):
+        """Record the latency of a command, once the storage finished it if it's waiting on the storage
+        :param command: bytestring command name
+        :param started: time.perf_counter_ns() when the command was received
+        :no return:
+        """
+        if self.pendingTask is None:
+            self.stats.recordLatency(command, time.perf_counter_ns() - started)
+        else:
+            self.pendingTask.add_done_callback(lambda task: self.stats.recordLatency(command, time.perf_counter_ns() - started))
+
+    def statsData(self, commandParams):
+        """Write the counters of the server
+        :param commandParams: list of bytestrings of the stats command
+        :no return:
+        """
+        if len(commandParams) == 1:
+            stats = self.stats.general(self.itemStore, self.storage)
+        elif commandParams[1] == b'items':
+            stats = self.stats.items(self.itemStore)
+        elif commandParams[1] == b'slabs':
+            stats = self.stats.slabs(self.itemStore)
+        elif commandParams[1] == b'latency':
+            stats = self.stats.latency()
+        elif commandParams[1] == b'hotkeys':
+            stats = self.stats.hotkeys()
+        elif commandParams[1] == b'reset':
+            self.stats.reset()
+            self.write(b'RESET\r\n')
+            return
+        else:
+            self.write(b'ERROR\r\n')
+            return
+
+        reply = [b'STAT %s %s\r\n' % (name.encode(), str(value).encode()) for name, value in stats]
+        reply.append(self.END)
+        self.writelines(reply)
+
+    def storageCommandError(self, commandParams):
+        """Validate the command line of a storage command
+        :param commandParams: list of bytestrings of the set, add, replace, append, prepend or cas command
+        :return: the CLIENT_ERROR reply of the first problem found or None if the command line is valid
+        """
+        paramCount = 6 if commandParams[0] == b'cas' else 5
+        if len(commandParams) < paramCount or len(commandParams) > paramCount + 1:
+            return self.CLIENT_ERROR_FORMATTING_SET
+        if len(commandParams) == paramCount + 1 and commandParams[paramCount] != b'noreply':
+            return self.CLIENT_ERROR_FORMATTING_SET_NOREPLY
+        if len(commandParams[1]) > 250:
+            return self.CLIENT_ERROR_FORMATTING_SET_KEY_LENGTH_TOO_LONG
+        try:
+            flags = int(commandParams[2].decode())
+            if flags > 65535:
+                return self.CLIENT_ERROR_FORMATTING_SET_FLAGS_VALUE
+            # A negative <exptime> is allowed, the item expires immediately
+            int(commandParams[3].decode())
+            dataBlockBytes = int(commandParams[4].decode())
+            casUnique = int(commandParams[5].decode()) if paramCount == 6 else 0
+            if flags < 0 or dataBlockBytes < 0 or casUnique < 0:
+                raise ValueError('Negative numbers not allowed')
+        except Exception as error:
+            print(error)
+            return self.CLIENT_ERROR_FORMATTING_SET_NOT_NUMERIC_VALUES
+        return None
+
+    def isInteger(self, param):
+        """Check an <exptime> parameter, which may be negative
+        :param param: bytestring parameter
+        :return: True if it's a decimal integer
+        """
+        return param.lstrip(b'-').isdigit()
 
     def setKeyData(self, dataBlock):
-        if len(dataBlock)-2 != int(self.expectingDataBlock[4].decode()):
-            self.transport.write(self.CLIENT_ERROR_FORMATTING_SET_DATA_BLOCK)
-        else:
-            values = (
-                        self.expectingDataBlock[1].decode(),
-                        self.expectingDataBlock[2].decode(),
-                        self.expectingDataBlock[4].decode(),
-                        dataBlock.strip().decode()
-                    )
-            insertOrReplace = """ INSERT OR REPLACE INTO keysTable(key, flags, bytes, dataBlock) VALUES (?, ?, ?, ?) """
+        """Store the data block received for the pending storage command in memory
+        and journal it for persistence when persistence is enabled
+        :param dataBlock: bytestring of the data block followed by \r\n
+        :no return:
+        """
+        commandParams = self.expectingDataBlock
+        self.expectingDataBlock = None
+        if len(dataBlock)-2 != int(commandParams[4].decode()) or not dataBlock.endswith(b'\r\n'):
+            self.write(self.CLIENT_ERROR_FORMATTING_SET_DATA_BLOCK)
+            return
+
+        command = commandParams[0]
+        key = commandParams[1]
+        noreply = len(commandParams) == (7 if command == b'cas' else 6)
+        if self.peers is not None and not self.peers.isLocal(key):
+            self.waitFor(self.forwardCommand(key, commandParams, noreply, self.SERVER_ERROR_SET_FAILURE, dataBlock))
+            return
+
+        self.stats.cmdSet += 1
+        flags = int(commandParams[2].decode())
+        exptime = self.expirationTime(int(commandParams[3].decode()))
+        value = self.dataBlockValue(dataBlock)
+        if command == b'set':
+            self.runCommand(key, lambda item: self.storeItem(key, flags, value, exptime, self.SET_SUCCESS),
+                            noreply, self.SERVER_ERROR_SET_FAILURE, readsItem=False)
+        elif command == b'cas':
+            casUnique = int(commandParams[5].decode())
+            self.runCommand(key, lambda item: self.compareAndSwap(key, item, flags, value, exptime, casUnique),
+                            noreply, self.SERVER_ERROR_SET_FAILURE)
+        else:
+            self.runCommand(key, lambda item: self.conditionalStore(command, key, item, flags, value, exptime),
+                            noreply, self.SERVER_ERROR_SET_FAILURE)
+
+    def conditionalStore(self, command, key, item, flags, value, exptime):
+        """Apply an add, replace, append or prepend command to the current item of its key
+        :param command: bytestring command name
+        :param key: bytestring key
+        :param item: current Item object of the key or None if it isn't stored
+        :param flags: 16 bit unsigned integer of the command
+        :param value: bytestring data block of the command
+        :param exptime: unix time the item expires at
+        :return: (reply, pending write) as returned by storeItem
+        """
+        if command == b'add':
+            if item is not None:
+                return self.NOT_STORED, None
+            return self.storeItem(key, flags, value, exptime, self.SET_SUCCESS)
+        if item is None:
+            return self.NOT_STORED, None
+        if command == b'replace':
+            return self.storeItem(key, flags, value, exptime, self.SET_SUCCESS)
+        # append and prepend keep the flags and expiration time of the stored item
+        if command == b'append':
+            value = item.dataBlock + value
+        else:
+            value = value + item.dataBlock
+        return self.storeItem(key, item.flags, value, item.exptime, self.SET_SUCCESS)
+
+    def compareAndSwap(self, key, item, flags, value, exptime, casUnique):
+        """Store the value of a cas command if the item wasn't stored again since the client read it
+        :param key: bytestring key
+        :param item: current Item object of the key or None if it isn't stored
+        :param flags: 16 bit unsigned integer of the command
+        :param value: bytestring data block of the command
+        :param exptime: unix time the item expires at
+        :param casUnique: integer the gets command returned for the item
+        :return: (reply, pending write) as returned by storeItem
+        """
+        if item is None:
+            self.stats.casMisses += 1
+            return self.NOT_FOUND, None
+        if item.casUnique != casUnique:
+            self.stats.casBadval += 1
+            return self.EXISTS, None
+        self.stats.casHits += 1
+        return self.storeItem(key, flags, value, exptime, self.SET_SUCCESS)
+
+    def storeItem(self, key, flags, value, exptime, reply):
+        """Store a value in memory and journal it for persistence when persistence is enabled
+        :param key: bytestring key
+        :param flags: 16 bit unsigned integer
+        :param value: bytestring value
+        :param exptime: unix time the item expires at, -1 if it's already expired
+        :param reply: reply of the command once the value is stored
+        :return: (reply, awaitable of the storage write or None if there's nothing to wait for)
+        """
+        pendingWrite = None
+        if exptime < 0:
+            # Already expired, storing only removes the current value
+            self.itemStore.delete(key)
+            if self.storage is not None:
+                pendingWrite = self.storage.delete(key, checkExists=False)
+        else:
             try:
-                sqliteCursor = self.sqliteConnection.cursor()
-                sqliteCursor.execute(insertOrReplace, values)
-                self.sqliteConnection.commit()
-                if len(self.expectingDataBlock) < 6:
-                    self.transport.write(self.SET_SUCCESS)
-            except Exception as error:
-                print(error)
-                self.transport.write(self.SERVER_ERROR_SET_FAILURE)
+                item = self.itemStore.set(key, flags, value, exptime)
+            except ItemTooLarge:
+                return self.SERVER_ERROR_OBJECT_TOO_LARGE, None
+            if item is None:
+                # The eviction policy evicted the value right away, like any evicted value it's still persisted
+                if self.storage is not None:
+                    pendingWrite = self.storage.set(key, flags, value, exptime)
+            elif self.storage is not None:
+                try:
+                    # A compressed value is persisted as it's kept in memory, without compressing it again
+                    pendingWrite = self.storage.set(key, *item.persistedValue(), exptime)
+                except Exception:
+                    self.itemStore.delete(key)
+                    raise
+        return reply, pendingWrite
 
-        self.expectingDataBlock = None
+    def runCommand(self, key, command, noreply, serverError, readsItem=True):
+        """Run a command against the current item of its key and reply
+        A key that missed in memory is read through from the storage first, the command itself runs
+        without yielding to the event loop between reading the item and storing the new value so
+        concurrent clients can't interleave with it
+        :param key: bytestring key
+        :param command: function taking the current Item object or None and returning (reply, pending write)
+        :param noreply: whether the client asked for no reply
+        :param serverError: reply written if the command fails
+        :param readsItem: whether the command depends on the current item
+        :no return:
+        """
+        if self.stats.hotKeys is not None:
+            self.stats.hotKeys.record(key)
+        try:
+            item = None
+            if readsItem:
+                item = self.itemStore.get(key)
+                if item is None and self.storage is not None:
+                    self.waitFor(self.readThroughCommand(key, command, noreply, serverError))
+                    return
+            reply, pendingWrite = command(item)
+        except Exception as error:
+            print(error)
+            self.write(serverError)
+            return
+
+        if pendingWrite is not None:
+            self.waitFor(self.replyWhenStored(pendingWrite, noreply, reply, serverError))
+        else:
+            self.writeReply(reply, noreply)
+
+    async def readThroughCommand(self, key, command, noreply, serverError):
+        """Read a key that missed in memory from the storage, then run the command against it
+        :param key: bytestring key
+        :param command: function taking the current Item object or None and returning (reply, pending write)
+        :param noreply: whether the client asked for no reply
+        :param serverError: reply written if the command fails
+        :no return:
+        """
+        try:
+            await self.readThroughItems({}, [key])
+            # The memory store holds the most recent value, including one set while the storage was read
+            reply, pendingWrite = command(self.itemStore.get(key))
+            if pendingWrite is not None:
+                await pendingWrite
+        except Exception as error:
+            print(error)
+            self.write(serverError)
+            return
+
+        self.writeReply(reply, noreply)
+
+    def writeReply(self, reply, noreply):
+        """Write the reply of a command, server errors are written even if the client asked for no reply
+        :param reply: bytestring reply, empty if a quiet meta command has nothing to say
+        :param noreply: whether the client asked for no reply
+        :no return:
+        """
+        if reply and (not noreply or reply.startswith(b'SERVER_ERROR')):
+            self.write(reply)
+
+    def expirationTime(self, expTime):
+        """Convert the <exptime> of a storage command to the unix time the item expires at
+        Values up to 30 days are a number of seconds from now, larger values are a unix time
+        :param expTime: integer <exptime> of the command
+        :return: unix time, 0 if the item never expires or -1 if it's already expired
+        """
+        if expTime == 0:
+            return 0
+        if expTime < 0:
+            return -1
+        if expTime <= self.MAX_RELATIVE_EXPTIME:
+            return int(time.time()) + expTime
+        if expTime <= time.time():
+            return -1
+        return expTime
+
+    async def replyWhenStored(self, pendingWrite, noreply, reply=SET_SUCCESS, serverError=SERVER_ERROR_SET_FAILURE):
+        """Reply to a command once the storage committed it
+        :param pendingWrite: awaitable of the storage write
+        :param noreply: whether the client asked for no reply
+        :param reply: reply of the command once it's committed
+        :param serverError: reply written if the write fails
+        :no return:
+        """
+        try:
+            await pendingWrite
+        except Exception as error:
+            print(error)
+            self.write(serverError)
+            return
+
+        self.writeReply(reply, noreply)
+
+    def counterKeyData(self, commandParams):
+        """Increment or decrement a stored decimal number in place
+        Increments wrap around at 64 bits and decrements stop at 0
+        :param commandParams: list of bytestrings of the incr or decr command
+        :no return:
+        """
+        key = commandParams[1]
+        noreply = len(commandParams) == 4
+        if self.peers is not None and not self.peers.isLocal(key):
+            self.waitFor(self.forwardCommand(key, commandParams, noreply, self.SERVER_ERROR_SET_FAILURE))
+            return
+
+        delta = int(commandParams[2])
+        if commandParams[0] == b'decr':
+            delta = -delta
+
+        def applyDelta(item):
+            if item is None:
+                if delta < 0:
+                    self.stats.decrMisses += 1
+                else:
+                    self.stats.incrMisses += 1
+                return self.NOT_FOUND, None
+            if delta < 0:
+                self.stats.decrHits += 1
+            else:
+                self.stats.incrHits += 1
+            value = self.counterValue(item.dataBlock, delta)
+            if value is None:
+                return self.CLIENT_ERROR_NON_NUMERIC_VALUE, None
+            return self.storeItem(key, item.flags, value, item.exptime, value + self.CRLF)
+
+        self.runCommand(key, applyDelta, noreply, self.SERVER_ERROR_SET_FAILURE)
+
+    def counterValue(self, dataBlock, delta):
+        """Apply a delta to a stored decimal number
+        Increments wrap around at 64 bits and decrements stop at 0
+        :param dataBlock: bytestring value of the item
+        :param delta: integer added to the number
+        :return: bytestring of the new number or None if the value isn't a 64 bit unsigned number
+        """
+        value = dataBlock.strip()
+        if not value.isdigit() or int(value) > self.MAX_COUNTER_VALUE:
+            return None
+        return str(max(0, int(value) + delta) & self.MAX_COUNTER_VALUE).encode()
+
+    def touchKeyData(self, commandParams):
+        """Change the expiration time of a stored item
+        :param commandParams: list of bytestrings of the touch command
+        :no return:
+        """
+        key = commandParams[1]
+        noreply = len(commandParams) == 4
+        if self.peers is not None and not self.peers.isLocal(key):
+            self.waitFor(self.forwardCommand(key, commandParams, noreply, self.SERVER_ERROR_SET_FAILURE))
+            return
+
+        exptime = self.expirationTime(int(commandParams[2].decode()))
+        self.stats.cmdTouch += 1
+
+        def touch(item):
+            if item is None:
+                self.stats.touchMisses += 1
+                return self.NOT_FOUND, None
+            self.stats.touchHits += 1
+            return self.TOUCH_SUCCESS, self.touchItem(key, item, exptime)
+
+        self.runCommand(key, touch, noreply, self.SERVER_ERROR_SET_FAILURE)
+
+    def touchItem(self, key, item, exptime):
+        """Change the expiration time of a stored item in memory and in the persisted items
+        :param key: bytestring key
+        :param item: Item object of the key
+        :param exptime: unix time the item expires at, -1 if it's already expired
+        :return: awaitable of the storage write or None if there's nothing to wait for
+        """
+        if exptime < 0:
+            self.itemStore.delete(key)
+            if self.storage is not None:
+                return self.storage.delete(key, checkExists=False)
+            return None
+        self.itemStore.touch(key, exptime)
+        if self.storage is not None:
+            return self.storage.set(key, *item.persistedValue(), exptime)
+        return None
 
     def getKeyData(self, commandParams):
-        interpolationCount = len(commandParams) - 1
-        interpolationString = "?," * (len(commandParams) - 2) + "?"
-        selectQuery = """ SELECT * FROM keysTable WHERE key IN ({}) """.format(interpolationString)
+        """Write every stored key out of the memory store, reading the misses through from
+        the persisted items when persistence is enabled
+        gets and gats also write the cas unique of the items, gat and gats touch the items they return
+        :param commandParams: list of bytestrings of the get, gets, gat or gats command
+        :no return:
+        """
+        command = commandParams[0]
+        withCas = command in (b'gets', b'gats')
+        exptime = None
+        keysStart = 1
+        if command in (b'gat', b'gats'):
+            exptime = self.expirationTime(int(commandParams[1].decode()))
+            keysStart = 2
+        keys = commandParams[keysStart:]
+        if self.peers is not None and not all(self.peers.isLocal(key) for key in keys):
+            self.waitFor(self.forwardKeyData(commandParams[:keysStart], keys, withCas, exptime))
+            return
+
+        items, missedKeys = self.memoryKeyData(keys)
+        if exptime is None and (not missedKeys or self.storage is None):
+            self.writeKeyData(keys, items, withCas)
+        else:
+            self.waitFor(self.readThroughKeyData(keys, items, missedKeys, withCas, exptime))
 
-        keys = tuple(commandParams[i].decode() for i in range(1, len(commandParams)))
+    def memoryKeyData(self, keys):
+        """Look up keys in the memory store
+        :param keys: list of bytestring keys
+        :return: dictionary of bytestring key to Item object for the keys found and list of the missed keys
+        """
+        items = {}
+        missedKeys = []
+        hotKeys = self.stats.hotKeys
+        for key in keys:
+            if hotKeys is not None:
+                hotKeys.record(key)
+            item = self.itemStore.get(key)
+            if item is None:
+                missedKeys.append(key)
+            else:
+                items[key] = item
+        return items, missedKeys
+
+    async def readThroughKeyData(self, keys, items, missedKeys, withCas=False, exptime=None):
+        """Read the keys that missed in memory from the storage, then write every stored key
+        :param keys: list of bytestring keys of the get command
+        :param items: dictionary of bytestring key to Item object for the keys found in memory
+        :param missedKeys: list of bytestring keys that missed in memory
+        :param withCas: whether to write the cas unique of the items
+        :param exptime: unix time the items are touched to or None to leave them unchanged
+        :no return:
+        """
         try:
-            sqliteCursor = self.sqliteConnection.cursor()
-            sqliteCursor.execute(selectQuery, keys)
+            await self.completeKeyData(items, missedKeys, exptime)
+        except Exception as error:
+            print(error)
+            self.write(self.SERVER_ERROR_GET_FAILURE)
+            return
+
+        self.writeKeyData(keys, items, withCas)
+
+    async def completeKeyData(self, items, missedKeys, exptime):
+        """Read the keys that missed in memory through from the storage and touch the items
+        :param items: dictionary of bytestring key to Item object the stored keys are added to
+        :param missedKeys: list of bytestring keys that missed in memory
+        :param exptime: unix time the items are touched to or None to leave them unchanged
+        :no return:
+        """
+        if missedKeys and self.storage is not None:
+            await self.readThroughItems(items, missedKeys)
+        if exptime is not None:
+            pendingWrites = [self.touchItem(key, item, exptime) for key, item in items.items()]
+            pendingWrites = [pendingWrite for pendingWrite in pendingWrites if pendingWrite is not None]
+            if pendingWrites:
+                await asyncio.gather(*pendingWrites)
+
+    async def readThroughItems(self, items, missedKeys):
+        """Read the keys that missed in memory from the storage and keep them in memory
+        :param items: dictionary of bytestring key to Item object the stored keys are added to
+        :param missedKeys: list of bytestring keys that missed in memory
+        :no return:
+        """
+        storedItems = await self.storage.get_many(missedKeys)
+        for key, (flags, dataBlock, exptime) in storedItems.items():
+            # Another client may have set the key in memory while the storage was read,
+            # values persisted compressed are kept compressed in memory
+            item = self.itemStore.get(key)
+            if item is None:
+                item = self.itemStore.newItem(key, flags, dataBlock, exptime)
+                try:
+                    stored = self.itemStore.setItem(key, item)
+                except ItemTooLarge:
+                    stored = None
+                if stored is None:
+                    # A value the memory doesn't keep is still answered from the same item, without a cas unique
+                    item.casUnique = 0
+            items[key] = item
+
+    async def forwardKeyData(self, commandPrefix, keys, withCas=False, exptime=None):
+        """Answer a retrieval command for keys owned by several workers, the keys of the other
+        workers are fetched from them with one command per worker
+        :param commandPrefix: list of bytestrings of the command before its keys
+        :param keys: list of bytestring keys of the command
+        :param withCas: whether to write the cas unique of the items
+        :param exptime: unix time the items are touched to or None to leave them unchanged
+        :no return:
+        """
+        localKeys = []
+        remoteKeys = {}
+        for key in keys:
+            if self.peers.isLocal(key):
+                localKeys.append(key)
+            else:
+                remoteKeys.setdefault(self.peers.owner(key), []).append(key)
+
+        localItems, missedKeys = self.memoryKeyData(localKeys)
+        lookups = [self.completeKeyData(localItems, missedKeys, exptime)]
+        for workerIndex, workerKeys in remoteKeys.items():
+            lookups.append(self.peers.forward(workerIndex, b' '.join(commandPrefix + workerKeys) + self.CRLF, multiLine=True))
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+
+        remoteReplies = results[1:]
+        for result in results:
+            if isinstance(result, Exception) or (isinstance(result, bytes) and not result.endswith(self.END)):
+                print(result)
+                self.write(self.SERVER_ERROR_GET_FAILURE)
+                return
 
-            rows = sqliteCursor.fetchall()
-            for row in rows:
-                self.transport.write(b'VALUE ' + row[0].encode('utf-8') + b' ' + str(row[1]).encode('utf-8') + b' ' + str(row[2]).encode('utf-8') + b'\r\n')
-                self.transport.write(row[3].encode('utf-8') + b'\r\n')
+        remoteBuffers = [memoryview(remoteReply)[:-len(self.END)] for remoteReply in remoteReplies]
+        self.writelines(chain(self.itemBuffers(localKeys, localItems, withCas), remoteBuffers, [self.END]))
 
-            self.transport.write(self.END)
+    async def forwardCommand(self, key, commandParams, noreply, serverError, dataBlock=b''):
+        """Forward a command to the worker that owns its key and relay the reply
+        The command is always forwarded expecting a reply so the replies on the
+        connection to the worker stay in step with the commands
+        :param key: bytestring key of the command
+        :param commandParams: list of bytestrings of the command line
+        :param noreply: whether the client asked for no reply
+        :param serverError: reply written if the worker can't be reached
+        :param dataBlock: bytestring of the data block and its \r\n for the storage commands
+        :no return:
+        """
+        if noreply:
+            commandParams = commandParams[:-1]
+        try:
+            reply = await self.peers.forward(self.peers.owner(key), b' '.join(commandParams) + self.CRLF + dataBlock)
         except Exception as error:
             print(error)
-            self.transport.write(self.SERVER_ERROR_GET_FAILURE)
+            self.write(serverError)
+            return
 
+        self.writeReply(reply, noreply)
 
-    def deleteKeyData(self, commandParams):
-        deleteQuery = """ DELETE FROM keysTable WHERE key=? """
+    def metaCommandData(self, commandParams):
+        """Parse a meta command and run it, an ms command first waits for its data block
+        :param commandParams: list of bytestrings of the mg, ms, md or ma command
+        :no return:
+        """
+        try:
+            request = MetaCommand(commandParams)
+        except MetaCommandError as error:
+            self.write(b'CLIENT_ERROR ' + str(error).encode() + self.CRLF)
+            return
+
+        if request.command == b'ms' and request.dataLength > self.maxItemSize:
+            self.rejectDataBlock(request.dataLength, self.SERVER_ERROR_OBJECT_TOO_LARGE)
+        elif request.command == b'ms':
+            self.expectingDataBlock = commandParams
+            self.expectingMetaCommand = request
+        elif self.peers is not None and not self.peers.isLocal(request.key):
+            self.waitFor(self.forwardMetaCommand(request))
+        elif request.command == b'mg':
+            self.metaGetKeyData(request)
+        elif request.command == b'md':
+            self.metaDeleteKeyData(request)
+        else:
+            self.metaCounterKeyData(request)
+
+    def metaGetKeyData(self, request):
+        """Return the value or the flags of an item, touching it if T is set
+        :param request: MetaCommand of the mg command
+        :no return:
+        """
+        key = request.key
+        exptime = None
+        if b'T' in request.flags:
+            exptime = self.expirationTime(request.numericFlag(b'T'))
+            self.stats.cmdTouch += 1
+
+        def get(item):
+            self.stats.cmdGet += 1
+            if item is None:
+                if exptime is not None:
+                    self.stats.touchMisses += 1
+                return (b'' if request.quiet else request.reply(b'EN')), None
+            self.stats.getHits += 1
+            pendingWrite = None
+            if exptime is not None:
+                self.stats.touchHits += 1
+                pendingWrite = self.touchItem(key, item, exptime)
+            if b'v' in request.flags:
+                return request.reply(b'VA', item, item.dataBlock), pendingWrite
+            return request.reply(b'HD', item), pendingWrite
+
+        self.runCommand(key, get, False, self.SERVER_ERROR_GET_FAILURE)
+
+    def metaSetKeyData(self, dataBlock):
+        """Store the data block received for the pending ms command, in the mode of its M flag
+        :param dataBlock: bytestring of the data block followed by \r\n
+        :no return:
+        """
+        request = self.expectingMetaCommand
+        self.expectingDataBlock = None
+        self.expectingMetaCommand = None
+        if len(dataBlock) - 2 != request.dataLength or not dataBlock.endswith(self.CRLF):
+            self.write(self.CLIENT_ERROR_BAD_DATA_CHUNK)
+            return
 
-        key = (commandParams[1].decode(),)
+        key = request.key
+        if self.peers is not None and not self.peers.isLocal(key):
+            self.waitFor(self.forwardMetaCommand(request, dataBlock))
+            return
+
+        self.stats.cmdSet += 1
+        flags = request.numericFlag(b'F', 0)
+        exptime = self.expirationTime(request.numericFlag(b'T', 0))
+        casUnique = request.numericFlag(b'C')
+        value = self.dataBlockValue(dataBlock)
+
+        def store(item):
+            if casUnique is not None:
+                if item is None:
+                    self.stats.casMisses += 1
+                    return request.reply(b'NF'), None
+                if item.casUnique != casUnique:
+                    self.stats.casBadval += 1
+                    return request.reply(b'EX'), None
+                self.stats.casHits += 1
+            if request.mode == b'set':
+                reply, pendingWrite = self.storeItem(key, flags, value, exptime, self.SET_SUCCESS)
+            else:
+                reply, pendingWrite = self.conditionalStore(request.mode, key, item, flags, value, exptime)
+            if reply is self.NOT_STORED:
+                return request.reply(b'NS'), None
+            if reply is self.SET_SUCCESS:
+                # Only the flags of a value the eviction policy kept are returned
+                reply = b'' if request.quiet else request.reply(b'HD', self.itemStore.peek(key))
+            return reply, pendingWrite
+
+        self.runCommand(key, store, False, self.SERVER_ERROR_SET_FAILURE,
+                        readsItem=request.mode != b'set' or casUnique is not None)
+
+    def metaDeleteKeyData(self, request):
+        """Remove a key from memory and from the persisted items, if its cas unique matches the C flag
+        :param request: MetaCommand of the md command
+        :no return:
+        """
+        key = request.key
+        casUnique = request.numericFlag(b'C')
+
+        def delete(item):
+            if item is None:
+                self.stats.deleteMisses += 1
+                # Like memcached, a quiet delete of a missing key has nothing to say either
+                return (b'' if request.quiet else request.reply(b'NF')), None
+            if casUnique is not None and item.casUnique != casUnique:
+                return request.reply(b'EX'), None
+            self.stats.deleteHits += 1
+            self.itemStore.delete(key)
+            pendingDelete = None
+            if self.storage is not None:
+                pendingDelete = self.storage.delete(key, checkExists=False)
+            return (b'' if request.quiet else request.reply(b'HD')), pendingDelete
+
+        self.runCommand(key, delete, False, self.SERVER_ERROR_DELETE_FAILURE)
+
+    def metaCounterKeyData(self, request):
+        """Increment or decrement a stored decimal number by the D flag, a missing key is
+        created with the J initial value when the N flag gives its TTL
+        :param request: MetaCommand of the ma command
+        :no return:
+        """
+        key = request.key
+        delta = request.numericFlag(b'D', 1)
+        if delta > self.MAX_COUNTER_VALUE:
+            self.write(self.CLIENT_ERROR_INVALID_DELTA)
+            return
+        decrement = request.mode == b'decr'
+        if decrement:
+            delta = -delta
+        casUnique = request.numericFlag(b'C')
+        exptime = None
+        if b'T' in request.flags:
+            exptime = self.expirationTime(request.numericFlag(b'T'))
+
+        def applyDelta(item):
+            if item is None:
+                if decrement:
+                    self.stats.decrMisses += 1
+                else:
+                    self.stats.incrMisses += 1
+                if b'N' not in request.flags:
+                    return request.reply(b'NF'), None
+                flags = 0
+                value = str(min(request.numericFlag(b'J', 0), self.MAX_COUNTER_VALUE)).encode()
+                itemExptime = self.expirationTime(request.numericFlag(b'N'))
+            else:
+                if casUnique is not None and item.casUnique != casUnique:
+                    return request.reply(b'EX'), None
+                if decrement:
+                    self.stats.decrHits += 1
+                else:
+                    self.stats.incrHits += 1
+                value = self.counterValue(item.dataBlock, delta)
+                if value is None:
+                    return self.CLIENT_ERROR_NON_NUMERIC_VALUE, None
+                flags = item.flags
+                itemExptime = item.exptime if exptime is None else exptime
+
+            reply, pendingWrite = self.storeItem(key, flags, value, itemExptime, None)
+            if reply is None:
+                if b'v' in request.flags:
+                    reply = request.reply(b'VA', self.itemStore.peek(key), value)
+                elif request.quiet:
+                    reply = b''
+                else:
+                    reply = request.reply(b'HD', self.itemStore.peek(key))
+            return reply, pendingWrite
+
+        self.runCommand(key, applyDelta, False, self.SERVER_ERROR_SET_FAILURE)
+
+    async def forwardMetaCommand(self, request, dataBlock=b''):
+        """Forward a meta command to the worker that owns its key and relay the reply
+        The command is forwarded without its q flag so every forwarded command gets a reply,
+        the replies a quiet command doesn't send are dropped here
+        :param request: MetaCommand of the command
+        :param dataBlock: bytestring of the data block and its \r\n for the ms command
+        :no return:
+        """
+        if request.command == b'mg':
+            serverError = self.SERVER_ERROR_GET_FAILURE
+        elif request.command == b'md':
+            serverError = self.SERVER_ERROR_DELETE_FAILURE
+        else:
+            serverError = self.SERVER_ERROR_SET_FAILURE
+        try:
+            reply = await self.peers.forward(self.peers.owner(request.key), b' '.join(request.forwardedParams()) + self.CRLF + dataBlock)
+        except Exception as error:
+            print(error)
+            self.write(serverError)
+            return
+
+        if request.quiet and reply.startswith(self.QUIET_REPLIES[request.command]):
+            return
+        self.write(reply)
+
+    def writeKeyData(self, keys, items, withCas=False):
+        """Write the reply of a get command made of the records built when the items were stored,
+        a reply larger than a chunk is produced as the transport drains
+        :param keys: list of bytestring keys of the get command
+        :param items: dictionary of bytestring key to Item object of the stored keys
+        :param withCas: whether to write the cas unique of the items
+        :no return:
+        """
+        self.writelines(chain(self.itemBuffers(keys, items, withCas), [self.END]))
+
+    def itemBuffers(self, keys, items, withCas):
+        """Buffers of the VALUE lines and data blocks of a retrieval reply, the hits and misses are counted here
+        :param keys: list of bytestring keys in the order of the command
+        :param items: dictionary of bytestring key to Item object of the stored keys
+        :param withCas: whether to write the cas unique of the items
+        :return: generator of bytestrings and memoryviews, producing the buffers of an item only when it's written
+        """
+        self.stats.cmdGet += len(keys)
+        self.stats.getHits += len(items)
+        return self.produceItemBuffers(keys, items, withCas)
+
+    def produceItemBuffers(self, keys, items, withCas):
+        """An item evicted or replaced before its buffers are produced keeps its own copy of its record
+        :param keys: list of bytestring keys in the order of the command
+        :param items: dictionary of bytestring key to Item object of the stored keys
+        :param withCas: whether to write the cas unique of the items
+        :return: generator of bytestrings and of memoryviews of the records in the slabs
+        """
+        for key in keys:
+            item = items.get(key)
+            if item is not None:
+                if withCas:
+                    yield item.header[:-2] + b' ' + str(item.casUnique).encode() + self.CRLF
+                    yield item.dataReply()
+                else:
+                    yield item.reply()
+
+    def deleteKeyData(self, commandParams):
+        """Remove a key from memory and from the persisted items when persistence is enabled
+        :param commandParams: list of bytestrings of the delete command
+        :no return:
+        """
+        key = commandParams[1]
+        noreply = len(commandParams) == 3
+        if self.peers is not None and not self.peers.isLocal(key):
+            self.waitFor(self.forwardCommand(key, commandParams, noreply, self.SERVER_ERROR_DELETE_FAILURE))
+            return
+        if self.stats.hotKeys is not None:
+            self.stats.hotKeys.record(key)
         try:
-            sqliteCursor = self.sqliteConnection.cursor()
-            sqliteCursor.execute(deleteQuery, key)
-            self.sqliteConnection.commit()
+            found = self.itemStore.delete(key)
+            if self.storage is not None:
+                pendingDelete = self.storage.delete(key, checkExists=not (found or noreply))
+                if pendingDelete is not None:
+                    self.waitFor(self.replyWhenDeleted(pendingDelete, found, noreply))
+                    return
 
-            if len(commandParams) < 3:
-                if sqliteCursor.rowcount > 0:
-                    self.transport.write(self.DELETE_SUCCESS)
+            self.countDelete(found)
+            if not noreply:
+                if found:
+                    self.write(self.DELETE_SUCCESS)
                 else:
-                    self.transport.write(self.DELETE_NOT_FOUND)
+                    self.write(self.DELETE_NOT_FOUND)
         except Exception as error:
             print(error)
-            self.transport.write(self.SERVER_ERROR_DELETE_FAILURE)
+            self.write(self.SERVER_ERROR_DELETE_FAILURE)
 
-    def _timeout(self):
-        """Method to close transport connection if timeout condition is met
+    def countDelete(self, found):
+        """Count a delete command as a hit or a miss
+        :param found: whether the key was stored
+        :no return:
+        """
+        if found:
+            self.stats.deleteHits += 1
+        else:
+            self.stats.deleteMisses += 1
+
+    async def replyWhenDeleted(self, pendingDelete, found, noreply):
+        """Reply to a delete command once the storage knows whether the key was persisted
+        :param pendingDelete: awaitable resolving to True if the key was persisted
+        :param found: whether the key was found in memory
+        :param noreply: whether the client asked for no reply
+        :no return:
+        """
+        try:
+            found = await pendingDelete or found
+            self.countDelete(found)
+            if not noreply:
+                if found:
+                    self.write(self.DELETE_SUCCESS)
+                else:
+                    self.write(self.DELETE_NOT_FOUND)
+        except Exception as error:
+            print(error)
+            self.write(self.SERVER_ERROR_DELETE_FAILURE)
+
+    def waitFor(self, coroutine):
+        """Run a command that waits on the storage, the following commands of this connection
+        are only processed once it finished so the replies stay in order
+        :param coroutine: coroutine finishing the command
+        :no return:
+        """
+        self.pendingTask = asyncio.ensure_future(coroutine)
+        self.pendingTask.add_done_callback(self.resumeProcessing)
+
+    def resumeProcessing(self, task):
+        """Callback run once the command waiting on the storage finished
+        :param task: task of the command
+        :no return:
+        """
+        self.pendingTask = None
+        if not self.closing:
+            self.handleReceivedData(b'')
+        if self.draining and self.pendingTask is None:
+            self.closeConnection()
+
+    def drain(self):
+        """Stop reading from the client and close the connection once the commands
+        that were already received are answered
         """
+        self.draining = True
+        self.updateReading()
+        if self.pendingTask is None:
+            self.closeConnection()
+
+    def closeConnection(self):
+        """Close the transport and stop processing any buffered commands
+        """
+        self.closing = True
         self.transport.close()
 
+    def _timeout(self):
+        """Method to close transport connection if timeout condition is met: nothing was received
+        for the idle timeout, no command is waiting on the storage and the connection doesn't watch the metrics,
+        otherwise the timer is re-armed
+        """
+        idle = time.monotonic() - self.lastActivity
+        if idle >= self.idleTimeout and self.pendingTask is None and not self.watchingMetrics:
+            self.closeConnection()
+        else:
+            remaining = self.idleTimeout if self.pendingTask is not None else self.idleTimeout - idle
+            self.timeout_handle = asyncio.get_running_loop().call_later(remaining, self._timeout)
+
+async def drainConnections(connections, timeout):
+    """Let every open connection answer the commands it already received, then close it
+    :param connections: set of MemcachedServer connections
+    :param timeout: seconds to wait for the commands waiting on the storage or another worker
+    :no return:
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    for connection in list(connections):
+        connection.drain()
+    while True:
+        # A finished command resumes the buffered commands of its connection, which can wait again
+        pendingTasks = [connection.pendingTask for connection in connections if connection.pendingTask is not None]
+        remaining = deadline - loop.time()
+        if not pendingTasks or remaining <= 0:
+            break
+        await asyncio.wait(pendingTasks, timeout=remaining)
+    for connection in list(connections):
+        connection.closeConnection()
+
+def itemSize(size):
+    """Parse the -I option like memcached does
+    :param size: string number of bytes, optionally followed by k or m
+    :return: integer number of bytes
+    """
+    units = {'k': 1024, 'm': 1024 * 1024}
+    unit = units.get(size[-1:].lower())
+    if unit is None:
+        return int(size)
+    return int(size[:-1]) * unit
+
 async def main(host, port):
     """Main method to bind Memcached asyncio.Protocol implementation to asyncio event loop and expose it to the network
     """
 
     parser = argparse.ArgumentParser(description='Start the memcached server')
-    parser.add_argument('databaseFile', metavar='databaseFile', type=str,
-                        help='the database file for the memcached server')
+    parser.add_argument('databaseFile', metavar='databaseFile', type=str, nargs='?',
+                        help='the database file used to persist the cache, omit to run purely in memory')
+    parser.add_argument('-p', '--port', type=int, default=port,
+                        help='port to serve the clients on, every node of a client\'s hash ring needs its own')
+    parser.add_argument('-m', '--memory-limit', dest='memoryLimit', type=int,
+                        default=MemcachedServer.DEFAULT_MEMORY_LIMIT,
+                        help='megabytes of memory to use for items before evicting the least recently used keys')
+    parser.add_argument('--eviction-policy', dest='evictionPolicy', choices=sorted(EVICTION_POLICIES), default=LRUPolicy.NAME,
+                        help='keys evicted at the memory limit: the least recently used ones (lru) or the least frequently '
+                             'used ones with W-TinyLFU (tinylfu), which keeps the hot keys through scans')
+    parser.add_argument('--compress-threshold', dest='compressThreshold', type=int, default=0,
+                        help='bytes from which the values are kept compressed with zlib, 0 to never compress them')
+    parser.add_argument('--durability', choices=SqliteStorage.DURABILITY_LEVELS,
+                        default=SqliteStorage.DURABILITY_BATCHED,
+                        help='when persisted writes are committed to the database file')
+    parser.add_argument('--flush-interval', dest='flushInterval', type=float,
+                        default=SqliteStorage.FLUSH_INTERVAL,
+                        help='seconds a write can wait before its batch is committed')
+    parser.add_argument('--batch-size', dest='batchSize', type=int,
+                        default=SqliteStorage.BATCH_SIZE,
+                        help='number of pending writes that are committed together right away')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of database files the persisted keys are split in, each committed by its own writer')
+    parser.add_argument('--idle-timeout', dest='idleTimeout', type=float, default=MemcachedServer.TIMEOUT,
+                        help='seconds a client connection can stay idle before it is closed, 0 to keep idle connections open')
+    parser.add_argument('-I', '--max-item-size', dest='maxItemSize', type=itemSize, default=MemcachedServer.MAX_ITEM_SIZE,
+                        help='largest value a client can store, in bytes or with a k or m suffix')
+    parser.add_argument('-c', '--max-connections', dest='maxConnections', type=int, default=MemcachedServer.MAX_CONNECTIONS,
+                        help='number of open client connections above which new clients are turned away')
+    parser.add_argument('--worker-index', dest='workerIndex', type=int, default=0,
+                        help='index of this worker among the processes sharing the port')
+    parser.add_argument('--worker-count', dest='workerCount', type=int, default=1,
+                        help='number of worker processes sharing the port')
+    parser.add_argument('--snapshot-file', dest='snapshotFile', type=str,
+                        help='file the items are periodically snapshotted to and loaded from at startup')
+    parser.add_argument('--snapshot-interval', dest='snapshotInterval', type=float, default=Snapshotter.INTERVAL,
+                        help='seconds between two snapshots, 0 to only write one when the server stops')
+    parser.add_argument('--hot-keys', dest='hotKeys', type=int, default=HotKeys.SIZE,
+                        help='number of hottest keys tracked for stats hotkeys, 0 to not track them')
+    parser.add_argument('--metrics-interval', dest='metricsInterval', type=float, default=MetricsFeed.INTERVAL,
+                        help='seconds between two samples sent to the connections watching the metrics')
 
     args = parser.parse_args()
+    port = args.port
+
+    storage = None
+    if args.databaseFile is not None:
+        cwd = os.path.abspath(os.path.join(os.path.dirname(__file__)))
+        databaseFile = cwd+'/'+args.databaseFile
+        print('memcached: ', databaseFile)
+        if args.shards > 1:
+            storage = ShardedSqliteStorage(shardFiles(databaseFile, args.shards), args.durability, args.flushInterval, args.batchSize)
+        else:
+            storage = SqliteStorage(databaseFile, args.durability, args.flushInterval, args.batchSize)
 
-    cwd = os.path.abspath(os.path.join(os.path.dirname(__file__)))
-    databaseFile = cwd+'/'+args.databaseFile
-    print('memcached: ', databaseFile)
+    itemStore = ItemStore(args.memoryLimit * 1024 * 1024, ValueCompressor(args.compressThreshold), args.evictionPolicy)
+    stats = ServerStats(args.hotKeys)
+    metricsFeed = MetricsFeed(stats, itemStore, args.metricsInterval)
 
     loop = asyncio.get_running_loop()
-    server = await loop.create_server(lambda: MemcachedServer(databaseFile), host, port)
-    async with server:
-        await server.serve_forever()
+    clientConnections = set()
+    peerConnections = set()
+    peers = None
+    peerServer = None
+    if args.workerCount > 1:
+        # Every worker owns a share of the keys, the others forward the commands for them over its unix socket
+        peers = WorkerPeers(port, args.workerIndex, args.workerCount)
+
+    snapshotter = None
+    if args.snapshotFile is not None:
+        snapshotFile = args.snapshotFile
+        if args.workerCount > 1:
+            snapshotFile = '{}.{}'.format(snapshotFile, args.workerIndex)
+        if os.path.exists(snapshotFile):
+            # A snapshot taken before a crash may be older than the writes committed to the database since,
+            # so with a database only the snapshot taken as the server stopped is loaded
+            started = time.monotonic()
+            try:
+                loaded = await loop.run_in_executor(None, loadSnapshot, snapshotFile, itemStore, storage is not None,
+                                                    peers.isLocal if peers is not None else None)
+                print('memcached: loaded {} items from {} in {:.2f}s'.format(loaded, snapshotFile, time.monotonic() - started))
+            except (OSError, SnapshotError) as error:
+                print('memcached: snapshot not loaded:', error)
+        snapshotter = Snapshotter(snapshotFile, itemStore, args.snapshotInterval)
+        snapshotter.start()
+    itemStore.sweep()
+
+    if peers is not None:
+        peerSocket = peerSocketPath(port, args.workerIndex)
+        if os.path.exists(peerSocket):
+            os.remove(peerSocket)
+        # A worker keeps its connections to the others open however long they're idle
+        peerServer = await loop.create_unix_server(lambda: MemcachedServer(storage, itemStore, None, peerConnections, stats,
+                                                                                idleTimeout=0, maxItemSize=args.maxItemSize,
+                                                                                isPeer=True), peerSocket)
+
+    server = await loop.create_server(lambda: MemcachedServer(storage, itemStore, peers, clientConnections, stats,
+                                                              args.idleTimeout, args.maxConnections, args.maxItemSize,
+                                                              metricsFeed), host, port,
+                                      reuse_port=args.workerCount > 1)
+    # The server serves the clients until it's stopped, serve_forever would wait for the open connections
+    # to close before they're drained
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    try:
+        async with server:
+            try:
+                await stopping.wait()
+                print('memcached server terminated')
+            finally:
+                # Stop accepting clients and drain the open connections, since Python 3.12.1 leaving the block
+                # waits for every connection to close
+                server.close()
+                await drainConnections(clientConnections, MemcachedServer.DRAIN_TIMEOUT)
+    finally:
+        itemStore.stopSweeping()
+        if peers is not None:
+            # The other workers may still forward the commands of their own clients while they drain
+            peerServer.close()
+            await drainConnections(peerConnections, MemcachedServer.DRAIN_TIMEOUT)
+            peers.close()
+            os.remove(peerSocket)
+        # Every command was answered, the items are snapshotted for a warm restart
+        if snapshotter is not None:
+            try:
+                written = await snapshotter.close()
+                print('memcached: snapshotted {} items to {}'.format(written, snapshotter.path))
+            except OSError as error:
+                print('memcached: snapshot failed:', error)
+        # Commit the pending writes before the server exits
+        if storage is not None:
+            await storage.close()
 
 if __name__ == '__main__':
     asyncio.run(main('127.0.0.1', 11211))
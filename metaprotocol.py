@@ -0,0 +1,142 @@
+# Keys of the meta commands can be sent base64 encoded
+import base64
+import binascii
+
+# Remaining TTL of the returned items
+import time
+
+class MetaCommandError(Exception):
+    """A meta command line that can't be parsed, the message is the CLIENT_ERROR reply"""
+
+class MetaCommand:
+    """A parsed meta command line: mg, ms, md or ma followed by a key and single letter flags
+    Flags are written as the letter followed by an optional token, e.g. T30 or Oabc
+    """
+    MAX_KEY_LENGTH = 250
+
+    # Flags accepted by each command
+    SUPPORTED_FLAGS = {
+        b'mg': b'bcfkOqstvT',
+        b'ms': b'bcCFkOqTM',
+        b'md': b'bCkOq',
+        b'ma': b'bcCNJDTMOqktv',
+    }
+    # Flags that take a numeric token
+    NUMERIC_FLAGS = b'CFTNJD'
+    # Flags echoed back on every reply, including misses and failures
+    ECHO_FLAGS = b'Okb'
+    # Modes of the M flag: add, append, prepend, replace or set for ms, increment or decrement for ma
+    MODES = {
+        b'ms': {b'E': b'add', b'A': b'append', b'P': b'prepend', b'R': b'replace', b'S': b'set'},
+        b'ma': {b'I': b'incr', b'+': b'incr', b'D': b'decr', b'-': b'decr'},
+    }
+    MAX_FLAGS = 65535
+
+    def __init__(self, commandParams):
+        """
+        :param commandParams: list of bytestrings of the command line
+        :raise MetaCommandError: if the command line is invalid
+        :no return:
+        """
+        self.command = commandParams[0]
+        if len(commandParams) < 2:
+            raise MetaCommandError('bad command line format')
+        self.commandParams = commandParams
+        self.encodedKey = commandParams[1]
+        flagsStart = 2
+        self.dataLength = None
+        if self.command == b'ms':
+            if len(commandParams) < 3 or not commandParams[2].isdigit():
+                raise MetaCommandError('bad data chunk')
+            self.dataLength = int(commandParams[2])
+            flagsStart = 3
+
+        self.flags = {} # flag letter -> token
+        self.returnFlags = [] # flag letters in the order they were sent
+        supportedFlags = self.SUPPORTED_FLAGS[self.command]
+        for param in commandParams[flagsStart:]:
+            flag = param[:1]
+            if flag not in supportedFlags:
+                raise MetaCommandError('invalid flag')
+            token = param[1:]
+            if flag in self.NUMERIC_FLAGS and not token.lstrip(b'-').isdigit():
+                raise MetaCommandError('bad token in command line format')
+            self.flags[flag] = token
+            self.returnFlags.append(flag)
+
+        self.mode = None
+        if self.command in self.MODES:
+            mode = self.flags.get(b'M', b'S' if self.command == b'ms' else b'I')[:1].upper()
+            if mode not in self.MODES[self.command]:
+                raise MetaCommandError('invalid mode for ' + self.command.decode())
+            self.mode = self.MODES[self.command][mode]
+        if not 0 <= self.numericFlag(b'F', 0) <= self.MAX_FLAGS or self.numericFlag(b'D', 0) < 0 or self.numericFlag(b'J', 0) < 0:
+            raise MetaCommandError('bad token in command line format')
+
+        self.quiet = b'q' in self.flags
+        self.key = self.encodedKey
+        if b'b' in self.flags:
+            try:
+                self.key = base64.b64decode(self.encodedKey, validate=True)
+            except binascii.Error:
+                raise MetaCommandError('error decoding key')
+        if not self.key or len(self.key) > self.MAX_KEY_LENGTH:
+            raise MetaCommandError('bad command line format')
+
+    def numericFlag(self, flag, default=None):
+        """
+        :param flag: flag letter bytestring
+        :param default: value if the flag wasn't sent
+        :return: integer token of the flag
+        """
+        token = self.flags.get(flag)
+        if token is None:
+            return default
+        return int(token)
+
+    def forwardedParams(self):
+        """The command line sent to the worker owning the key, without q so the worker always replies
+        :return: list of bytestrings
+        """
+        return [param for param in self.commandParams if param != b'q']
+
+    def reply(self, code, item=None, value=None):
+        """Build a reply line with the return flags that were asked for
+        :param code: two letter bytestring status: HD, VA, EN, NF, NS or EX
+        :param item: Item object the flags are returned for, None to only echo the opaque and the key
+        :param value: bytestring value of a VA reply
+        :return: bytestring reply
+        """
+        tokens = [code]
+        if value is not None:
+            tokens.append(str(len(value)).encode())
+        for flag in self.returnFlags:
+            if flag in self.ECHO_FLAGS:
+                if flag == b'O':
+                    tokens.append(b'O' + self.flags[b'O'])
+                elif flag == b'k':
+                    tokens.append(b'k' + self.encodedKey)
+                elif b'k' in self.flags:
+                    tokens.append(b'b')
+            elif item is not None:
+                if flag == b'c':
+                    tokens.append(b'c' + str(item.casUnique).encode())
+                elif flag == b'f':
+                    tokens.append(b'f' + str(item.flags).encode())
+                elif flag == b's':
+                    tokens.append(b's' + str(item.length).encode())
+                elif flag == b't':
+                    tokens.append(b't' + str(remainingTtl(item.exptime)).encode())
+        line = b' '.join(tokens) + b'\r\n'
+        if value is None:
+            return line
+        return line + value + b'\r\n'
+
+def remainingTtl(exptime):
+    """
+    :param exptime: unix time an item expires at, 0 if it never expires
+    :return: seconds left before the item expires or -1 if it never expires
+    """
+    if not exptime:
+        return -1
+    return max(0, int(exptime - time.time()))
@@ -0,0 +1,272 @@
+# Uptime and the clock of the stats command
+import os
+import time
+
+# Latency histograms created on the first latency of a command
+from collections import defaultdict
+
+# Samples of the metrics feed, one JSON object per line
+import json
+import asyncio
+
+# Estimated access rates of the hottest keys
+from hotkeys import HotKeys
+
+class ServerStats:
+    """Counters of the memcached server shared by every client connection
+    The counters are plain attributes incremented by the command handlers,
+    the stats command reads them together with the ItemStore
+
+    The latencies of each command are counted in a fixed bucket histogram: bucket i counts the
+    latencies below 2^i microseconds and the last bucket everything slower, so recording a latency
+    is a bit_length and a list increment
+    """
+    LATENCY_BUCKETS = 24 # The last bucket starts at 2^22 microseconds, about 4 seconds
+    PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
+    def __init__(self, hotKeysSize=HotKeys.SIZE):
+        """
+        :param hotKeysSize: number of hottest keys tracked, 0 to not track them
+        :no return:
+        """
+        self.hotKeys = HotKeys(hotKeysSize) if hotKeysSize else None
+        self.pid = os.getpid()
+        self.startTime = time.time()
+        self.currConnections = 0
+        self.latencies = defaultdict(lambda: [0] * self.LATENCY_BUCKETS) # command -> bucket counts
+        self.reset()
+
+    def reset(self):
+        """Set every counter back to 0, the current connections are kept
+        """
+        self.cmdGet = 0
+        self.cmdSet = 0
+        self.cmdTouch = 0
+        self.getHits = 0 # the misses are the keys of cmd_get that weren't hits
+        self.deleteHits = 0
+        self.deleteMisses = 0
+        self.incrHits = 0
+        self.incrMisses = 0
+        self.decrHits = 0
+        self.decrMisses = 0
+        self.casHits = 0
+        self.casMisses = 0
+        self.casBadval = 0
+        self.touchHits = 0
+        self.touchMisses = 0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.totalConnections = 0
+        self.rejectedConnections = 0
+        self.latencies.clear()
+        if self.hotKeys is not None:
+            self.hotKeys.reset()
+
+    def recordLatency(self, command, latency):
+        """
+        :param command: bytestring command name
+        :param latency: nanoseconds the command took, including the wait for the storage
+        :no return:
+        """
+        bucket = (latency // 1000).bit_length()
+        self.latencies[command][bucket if bucket < self.LATENCY_BUCKETS else self.LATENCY_BUCKETS - 1] += 1
+
+    def percentile(self, counts, fraction):
+        """Upper bound of the histogram bucket holding a percentile
+        :param counts: list of the bucket counts
+        :param fraction: percentile between 0 and 1
+        :return: microseconds, 0 if nothing was recorded
+        """
+        rank = fraction * sum(counts)
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return 2 ** bucket
+        return 0
+
+    def general(self, itemStore, storage=None):
+        """
+        :param itemStore: ItemStore of the server
+        :param storage: SqliteStorage or ShardedSqliteStorage of the server or None
+        :return: list of (name, value) of the stats command
+        """
+        now = time.time()
+        stats = [
+            ('pid', self.pid),
+            ('uptime', int(now - self.startTime)),
+            ('time', int(now)),
+            ('curr_connections', self.currConnections),
+            ('total_connections', self.totalConnections),
+            ('rejected_connections', self.rejectedConnections),
+            ('cmd_get', self.cmdGet),
+            ('cmd_set', self.cmdSet),
+            ('cmd_touch', self.cmdTouch),
+            ('get_hits', self.getHits),
+            ('get_misses', self.cmdGet - self.getHits),
+            ('delete_hits', self.deleteHits),
+            ('delete_misses', self.deleteMisses),
+            ('incr_hits', self.incrHits),
+            ('incr_misses', self.incrMisses),
+            ('decr_hits', self.decrHits),
+            ('decr_misses', self.decrMisses),
+            ('cas_hits', self.casHits),
+            ('cas_misses', self.casMisses),
+            ('cas_badval', self.casBadval),
+            ('touch_hits', self.touchHits),
+            ('touch_misses', self.touchMisses),
+            ('bytes_read', self.bytesRead),
+            ('bytes_written', self.bytesWritten),
+            ('limit_maxbytes', itemStore.memoryLimit),
+            ('bytes', itemStore.memoryUsed),
+            ('curr_items', len(itemStore)),
+            ('evictions', itemStore.evictions),
+            ('expired_items', itemStore.expiredItems),
+            ('eviction_policy', itemStore.policy.NAME),
+        ]
+        stats += itemStore.policy.stats()
+        if itemStore.compressor.threshold:
+            stats += itemStore.compressor.stats()
+        if storage is not None:
+            stats.append(('journaled_writes', storage.journaledWrites()))
+        return stats
+
+    def items(self, itemStore):
+        """
+        :param itemStore: ItemStore of the server
+        :return: list of (name, value) of the stats items command, items:<class>:<name> for each slab class
+                 that holds or held items, the values larger than a page are only in the stats slabs command
+        """
+        stats = []
+        for slabClass in itemStore.slabs.classes:
+            if not (slabClass.usedChunks or slabClass.evictions or slabClass.expiredItems or slabClass.outOfMemory):
+                continue
+            prefix = 'items:{}:'.format(slabClass.classId)
+            stats += [
+                (prefix + 'number', slabClass.usedChunks),
+                (prefix + 'evicted', slabClass.evictions),
+                (prefix + 'reclaimed', slabClass.expiredItems),
+                (prefix + 'outofmemory', slabClass.outOfMemory),
+            ]
+        return stats
+
+    def slabs(self, itemStore):
+        """
+        :param itemStore: ItemStore of the server
+        :return: list of (name, value) of the stats slabs command
+        """
+        return itemStore.slabs.stats()
+
+    def hotkeys(self):
+        """
+        :return: list of (name, value) of the stats hotkeys command, hotkey:<key> is the estimated accesses per
+                 second of one of the hottest keys, from the hottest
+        """
+        if self.hotKeys is None:
+            return []
+        return [('hotkey:' + key.decode('utf-8', 'backslashreplace'), '{:.1f}'.format(rate))
+                for key, rate in self.hotKeys.hottest()]
+
+    def latency(self):
+        """
+        :return: list of (name, value) of the stats latency command, the percentiles are bucket upper
+                 bounds in microseconds and the buckets that counted a latency are listed as le_<microseconds>
+        """
+        stats = []
+        for command, counts in sorted(self.latencies.items()):
+            name = command.decode()
+            stats.append((name + ':count', sum(counts)))
+            for percentile, fraction in self.PERCENTILES:
+                stats.append(('{}:{}_us'.format(name, percentile), self.percentile(counts, fraction)))
+            for bucket, count in enumerate(counts):
+                if count:
+                    stats.append(('{}:le_{}'.format(name, 2 ** bucket), count))
+        return stats
+
+
+class MetricsFeed:
+    """Pushes a sample of the server metrics to the connections watching them, once per interval
+    A sample is computed once for every watcher from the counters of ServerStats, only while someone watches,
+    so the feed costs nothing to the commands. Rates and latency percentiles are over the last interval
+    """
+    INTERVAL = 1 # Seconds between two samples
+
+    def __init__(self, stats, itemStore, interval=INTERVAL):
+        """
+        :param stats: ServerStats of the server
+        :param itemStore: ItemStore of the server
+        :param interval: seconds between two samples
+        :no return:
+        """
+        self.stats = stats
+        self.itemStore = itemStore
+        self.interval = interval
+        self.watchers = set()
+        self.handle = None
+        self.previous = None # counters of the previous sample
+
+    def watch(self, connection):
+        """Start sending the samples to a connection
+        :param connection: MemcachedServer connection
+        :no return:
+        """
+        self.watchers.add(connection)
+        if self.handle is None:
+            self.previous = self.counters()
+            self.handle = asyncio.get_running_loop().call_later(self.interval, self.publish)
+
+    def unwatch(self, connection):
+        """Stop sending the samples to a connection, the samples stop with the last watcher
+        :param connection: MemcachedServer connection
+        :no return:
+        """
+        self.watchers.discard(connection)
+        if not self.watchers and self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def counters(self):
+        """
+        :return: tuple of the monotonic time, the commands, gets, get hits, evictions and the latency histogram of every command
+        """
+        histogram = [sum(counts) for counts in zip(*self.stats.latencies.values())] or [0] * self.stats.LATENCY_BUCKETS
+        return (time.monotonic(), sum(histogram), self.stats.cmdGet, self.stats.getHits, self.itemStore.evictions, histogram)
+
+    def sample(self):
+        """Metrics since the previous sample
+        :return: dictionary of the metrics
+        """
+        current = self.counters()
+        previous = self.previous
+        self.previous = current
+        elapsed = current[0] - previous[0]
+        # A stats reset in between sets the counters back to 0, they're counted from there
+        ops, gets, hits, evictions = (now - before if now >= before else now for now, before in zip(current[1:5], previous[1:5]))
+        histogram = current[5] if current[1] < previous[1] else [now - before for now, before in zip(current[5], previous[5])]
+        sample = {
+            'time': time.time(),
+            'ops_per_sec': round(ops / elapsed, 1),
+            'get_hit_ratio': round(hits / gets, 4) if gets else None,
+            'bytes': self.itemStore.memoryUsed,
+            'limit_maxbytes': self.itemStore.memoryLimit,
+            'curr_items': len(self.itemStore),
+            'evictions_per_sec': round(evictions / elapsed, 1),
+            'evictions': self.itemStore.evictions,
+            'curr_connections': self.stats.currConnections,
+        }
+        for percentile, fraction in self.stats.PERCENTILES:
+            sample[percentile + '_us'] = self.stats.percentile(histogram, fraction)
+        if self.stats.hotKeys is not None:
+            sample['hot_keys'] = [[key.decode('utf-8', 'backslashreplace'), round(rate, 1)] for key, rate in self.stats.hotKeys.hottest()]
+        return sample
+
+    def publish(self):
+        """Send a sample to every watcher, a watcher that doesn't read them misses the samples
+        while its replies can't be written instead of buffering them
+        :no return:
+        """
+        self.handle = asyncio.get_running_loop().call_later(self.interval, self.publish)
+        line = b'METRICS %s\r\n' % json.dumps(self.sample(), separators=(',', ':')).encode()
+        for connection in self.watchers:
+            if not connection.writingPaused:
+                connection.write(line)
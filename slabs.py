@@ -0,0 +1,292 @@
+# Size class of a record
+from bisect import bisect_left
+
+class SlabPage:
+    """A page of memory cut into equal chunks of one slab class, or the memory of a single record kept
+    outside the slabs: a value too large for every class, an item not stored yet or an item removed from the store
+    """
+    __slots__ = ('memory', 'slabClass', 'owners', 'freeOffsets', 'retained')
+
+    def __init__(self, memory, slabClass=None):
+        """
+        :param memory: bytearray of the page or immutable bytestring of a single record
+        :param slabClass: SlabClass the page is cut for, None for a single record
+        :no return:
+        """
+        self.memory = memory
+        self.slabClass = slabClass
+        self.retained = False # whether a transport keeps unsent views of the memory
+        if slabClass is None:
+            self.owners = None
+            self.freeOffsets = None
+        else:
+            self.owners = [None] * slabClass.perPage # Item stored in each chunk
+            self.freeOffsets = list(reversed(slabClass.offsets()))
+
+class SlabClass:
+    """The pages holding the records of one chunk size"""
+
+    def __init__(self, classId, chunkSize, pageSize):
+        """
+        :param classId: number of the class in the stats, from 1
+        :param chunkSize: bytes of each chunk
+        :param pageSize: bytes of each page
+        :no return:
+        """
+        self.classId = classId
+        self.chunkSize = chunkSize
+        self.perPage = pageSize // chunkSize
+        self.chunkOffsets = None
+        self.pages = []
+        self.partialPages = {} # pages with a free chunk, oldest first, as a dictionary of page -> None
+        self.usedChunks = 0
+        self.requestedBytes = 0 # Bytes of the records in the used chunks
+        # Counted by the ItemStore for the stats items command
+        self.evictions = 0
+        self.expiredItems = 0
+        self.outOfMemory = 0 # Sets that evicted MAX_EVICTIONS_PER_SET keys without making room for their value
+
+    @property
+    def freeChunks(self):
+        """
+        :return: number of free chunks in the pages of the class
+        """
+        return len(self.pages) * self.perPage - self.usedChunks
+
+    def offsets(self):
+        """The offsets are shared by the pages and the items of the class so an item doesn't hold an int of its own
+        :return: tuple of the offset of each chunk in a page
+        """
+        if self.chunkOffsets is None:
+            self.chunkOffsets = tuple(range(0, self.perPage * self.chunkSize, self.chunkSize))
+        return self.chunkOffsets
+
+class SlabAllocator:
+    """Stores the records of the items in chunks of preallocated pages, like memcached's slab allocator
+    A record goes in a chunk of the smallest class that fits it, the chunk sizes grow by GROWTH_FACTOR from
+    MIN_CHUNK_SIZE up to a whole page, and records larger than a page are kept in their own bytestring.
+    Pages are allocated when a class has no free chunk left and released once their last chunk is freed,
+    so totalMalloced is exactly the memory held for the records. The free chunks of the partially used pages
+    are the fragmentation, a class with a whole page of them is compacted by reclaim.
+    The memory of the last page released is kept for the next page allocated, a class often grows right after
+    another one shrank, it's the only memory held outside totalMalloced.
+    Replies are views of the chunks, a page whose views a transport kept unsent is copied before it's written again
+    """
+    PAGE_SIZE = 1024 * 1024 # Bytes, the largest page, like memcached's -I
+    MIN_CHUNK_SIZE = 64 # Bytes, a VALUE line with a short key and a small value
+    GROWTH_FACTOR = 1.25
+    CHUNK_ALIGNMENT = 8
+
+    def __init__(self, pageSize=PAGE_SIZE, minChunkSize=MIN_CHUNK_SIZE, growthFactor=GROWTH_FACTOR):
+        """
+        :param pageSize: bytes of each page, also the largest chunk
+        :param minChunkSize: bytes of the chunks of the first class
+        :param growthFactor: ratio between the chunk sizes of two consecutive classes
+        :no return:
+        """
+        self.pageSize = pageSize
+        self.classes = []
+        chunkSize = minChunkSize
+        while chunkSize < pageSize:
+            self.classes.append(SlabClass(len(self.classes) + 1, chunkSize, pageSize))
+            chunkSize = max(-(-int(chunkSize * growthFactor) // self.CHUNK_ALIGNMENT) * self.CHUNK_ALIGNMENT,
+                            chunkSize + self.CHUNK_ALIGNMENT)
+        if pageSize >= minChunkSize:
+            self.classes.append(SlabClass(len(self.classes) + 1, pageSize, pageSize))
+        self.chunkSizes = [slabClass.chunkSize for slabClass in self.classes]
+        self.totalMalloced = 0 # Bytes of the pages and of the records kept outside the slabs
+        self.spareMemory = None
+        self.pagesByMemory = {} # id of the memory of each page -> SlabPage
+        self.largeRecords = 0
+        self.largeBytes = 0
+        self.chunksMoved = 0
+        self.pagesReclaimed = 0
+
+    def slabClass(self, length):
+        """
+        :param length: bytes of a record
+        :return: SlabClass of the smallest chunks the record fits in, None if it's larger than a page
+        """
+        index = bisect_left(self.chunkSizes, length)
+        if index == len(self.classes):
+            return None
+        return self.classes[index]
+
+    def footprint(self, length):
+        """
+        :param length: bytes of a record
+        :return: most bytes storing the record can add to totalMalloced, a whole page if it goes in a slab
+        """
+        return length if self.slabClass(length) is None else self.pageSize
+
+    def allocate(self, item):
+        """Move the record of an item from its own memory into a free chunk, allocating a page if there's none
+        :param item: Item object whose record is kept outside the slabs
+        :no return:
+        """
+        length = item.recordLength
+        index = bisect_left(self.chunkSizes, length)
+        if index == len(self.classes):
+            # The record is already an immutable bytestring of its own
+            self.totalMalloced += length
+            self.largeRecords += 1
+            self.largeBytes += length
+            return
+        slabClass = self.classes[index]
+        record = item.page.memory
+        if not slabClass.partialPages:
+            memory = self.spareMemory if self.spareMemory is not None else bytearray(self.pageSize)
+            self.spareMemory = None
+            page = SlabPage(memory, slabClass)
+            self.pagesByMemory[id(memory)] = page
+            slabClass.pages.append(page)
+            slabClass.partialPages[page] = None
+            self.totalMalloced += self.pageSize
+        page, offset = self.takeChunk(slabClass)
+        self.unshare(page)
+        page.memory[offset:offset + length] = record
+        page.owners[offset // slabClass.chunkSize] = item
+        item.page = page
+        item.offset = offset
+        slabClass.requestedBytes += length
+
+    def takeChunk(self, slabClass):
+        """
+        :param slabClass: SlabClass with a partially used page
+        :return: (SlabPage, byte offset) of a free chunk, now counted as used
+        """
+        page = next(iter(slabClass.partialPages))
+        offset = page.freeOffsets.pop()
+        if not page.freeOffsets:
+            del slabClass.partialPages[page]
+        slabClass.usedChunks += 1
+        return page, offset
+
+    def retain(self, buffers):
+        """Mark the pages a transport keeps views of, since Python 3.12 it keeps the buffers it couldn't send
+        without copying them
+        :param buffers: bytestrings or memoryviews handed to a transport that didn't send them all
+        :no return:
+        """
+        for buffer in buffers:
+            if isinstance(buffer, memoryview):
+                page = self.pagesByMemory.get(id(buffer.obj))
+                if page is not None:
+                    page.retained = True
+
+    def unshare(self, page):
+        """Give a page a copy of its memory before it's written if a transport may still send views of it
+        :param page: SlabPage about to be written
+        :no return:
+        """
+        if page.retained:
+            del self.pagesByMemory[id(page.memory)]
+            page.memory = bytearray(page.memory)
+            page.retained = False
+            self.pagesByMemory[id(page.memory)] = page
+
+    def free(self, item):
+        """Free the chunk of an item removed from the store
+        The item keeps a copy of its record in its own memory, the code still holding it can read it
+        after the chunk is reused
+        :param item: Item object stored by allocate
+        :no return:
+        """
+        page = item.page
+        slabClass = page.slabClass
+        length = item.recordLength
+        if slabClass is None:
+            self.totalMalloced -= length
+            self.largeRecords -= 1
+            self.largeBytes -= length
+            return
+        offset = item.offset
+        item.page = SlabPage(bytes(memoryview(page.memory)[offset:offset + length]))
+        item.offset = 0
+        page.owners[offset // slabClass.chunkSize] = None
+        page.freeOffsets.append(offset)
+        slabClass.usedChunks -= 1
+        slabClass.requestedBytes -= length
+        if len(page.freeOffsets) == slabClass.perPage:
+            self.release(page)
+        else:
+            slabClass.partialPages[page] = None
+
+    def release(self, page):
+        """
+        :param page: SlabPage without any used chunk
+        :no return:
+        """
+        slabClass = page.slabClass
+        slabClass.pages.remove(page)
+        slabClass.partialPages.pop(page, None)
+        self.totalMalloced -= self.pageSize
+        del self.pagesByMemory[id(page.memory)]
+        if not page.retained:
+            self.spareMemory = page.memory
+
+    def reclaim(self, slabClass):
+        """Release a page of a class that has a whole page of free chunks, the used chunks of its emptiest page
+        are moved into the free chunks of its other pages
+        :param slabClass: SlabClass or None for the records kept outside the slabs
+        :return: True if a page was released
+        """
+        if slabClass is None or slabClass.freeChunks < slabClass.perPage or len(slabClass.pages) < 2:
+            return False
+        source = min(slabClass.partialPages, key=lambda page: slabClass.perPage - len(page.freeOffsets))
+        del slabClass.partialPages[source]
+        chunkSize = slabClass.chunkSize
+        sourceMemory = memoryview(source.memory)
+        for item in filter(None, source.owners):
+            sourceOffset = item.offset
+            length = item.recordLength
+            page, offset = self.takeChunk(slabClass)
+            self.unshare(page)
+            page.memory[offset:offset + length] = sourceMemory[sourceOffset:sourceOffset + length]
+            page.owners[offset // chunkSize] = item
+            item.page = page
+            item.offset = offset
+            slabClass.usedChunks -= 1
+            self.chunksMoved += 1
+        sourceMemory.release()
+        self.release(source)
+        self.pagesReclaimed += 1
+        return True
+
+    def pages(self):
+        """
+        :return: list of every SlabPage allocated
+        """
+        return [page for slabClass in self.classes for page in slabClass.pages]
+
+    def stats(self):
+        """
+        :return: list of (name, value) of the stats slabs command, <class>:<name> for each class with a page
+        """
+        stats = []
+        requestedBytes = self.largeBytes
+        for slabClass in self.classes:
+            if not slabClass.pages:
+                continue
+            prefix = str(slabClass.classId) + ':'
+            stats += [
+                (prefix + 'chunk_size', slabClass.chunkSize),
+                (prefix + 'chunks_per_page', slabClass.perPage),
+                (prefix + 'total_pages', len(slabClass.pages)),
+                (prefix + 'total_chunks', len(slabClass.pages) * slabClass.perPage),
+                (prefix + 'used_chunks', slabClass.usedChunks),
+                (prefix + 'free_chunks', slabClass.freeChunks),
+                (prefix + 'mem_requested', slabClass.requestedBytes),
+            ]
+            requestedBytes += slabClass.requestedBytes
+        fragmentation = 1 - requestedBytes / self.totalMalloced if self.totalMalloced else 0
+        stats += [
+            ('active_slabs', sum(1 for slabClass in self.classes if slabClass.pages)),
+            ('large_items', self.largeRecords),
+            ('large_bytes', self.largeBytes),
+            ('total_malloced', self.totalMalloced),
+            ('fragmentation', '{:.2f}'.format(fragmentation)),
+            ('chunks_moved', self.chunksMoved),
+            ('pages_reclaimed', self.pagesReclaimed),
+        ]
+        return stats
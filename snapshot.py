@@ -0,0 +1,208 @@
+# Length prefixed records of the snapshot file
+import struct
+
+# Checksum of the snapshot file, a torn or corrupted file is never loaded
+import zlib
+
+# The snapshot file is memory mapped and parsed in place when it's loaded
+import mmap
+
+# Write to a temporary file and rename it over the snapshot once it's complete
+import os
+
+# Write the snapshots off the event loop of the memcached server
+import asyncio
+
+# Skip the items that expired while the server was down
+import time
+
+# Skip the values too large for the memory limit the server was restarted with
+from itemstore import ItemTooLarge
+
+MAGIC = b'MCSNAP02'
+END_MAGIC = b'MCSNAPEN'
+# magic, clean shutdown, unix time the snapshot was taken at
+HEADER = struct.Struct('>8sBQ')
+# key length, flags with COMPRESSED_FLAG if the value is compressed, expiration unix time, value length,
+# followed by the key and the value, compressed values are written and loaded without decompressing them
+RECORD = struct.Struct('>BIQI')
+# end magic, number of records, crc32 of everything before the footer
+FOOTER = struct.Struct('>8sQI')
+
+WRITE_BUFFER_SIZE = 1024 * 1024 # Bytes of records packed before they're written to the file
+
+class SnapshotError(Exception):
+    """A snapshot file that can't be loaded"""
+
+def writeSnapshot(path, items, clean=False):
+    """Write the items to a snapshot file, atomically replacing the previous one
+    :param path: path of the snapshot file
+    :param items: list of (key, Item, memory, offset) from the least to the most recently used, as returned by
+                  ItemStore.snapshotItems
+    :param clean: True if the snapshot is taken as the server stops, after every write is done
+    :return: number of items written
+    """
+    now = time.time()
+    temporaryPath = path + '.tmp'
+    count = 0
+    with open(temporaryPath, 'wb') as snapshotFile:
+        header = HEADER.pack(MAGIC, clean, int(now))
+        snapshotFile.write(header)
+        checksum = zlib.crc32(header)
+        buffer = bytearray()
+        for key, item, memory, offset in items:
+            exptime = item.exptime
+            if exptime and exptime <= now:
+                continue
+            flags, dataBlock = item.persistedValue(memory, offset)
+            buffer += RECORD.pack(len(key), flags, exptime, len(dataBlock))
+            buffer += key
+            buffer += dataBlock
+            count += 1
+            if len(buffer) >= WRITE_BUFFER_SIZE:
+                checksum = zlib.crc32(buffer, checksum)
+                snapshotFile.write(buffer)
+                buffer = bytearray()
+        checksum = zlib.crc32(buffer, checksum)
+        snapshotFile.write(buffer)
+        snapshotFile.write(FOOTER.pack(END_MAGIC, count, checksum))
+        snapshotFile.flush()
+        os.fsync(snapshotFile.fileno())
+    os.replace(temporaryPath, path)
+    # Persist the rename itself
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+    return count
+
+def loadSnapshot(path, itemStore, requireClean=False, isLocal=None):
+    """Load the items of a snapshot file into the item store, keeping their expiration times
+    A clean snapshot is marked unclean once it's loaded: the writes made after the restart are newer than it,
+    so after a crash it must not be preferred to the database again
+    :param path: path of the snapshot file
+    :param itemStore: ItemStore object the items are stored in
+    :param requireClean: only load a snapshot taken as the server stopped
+    :param isLocal: function telling if a key belongs to this worker, None to load every key
+    :raise SnapshotError: if the file is truncated or corrupted
+    :return: number of items loaded
+    """
+    with open(path, 'r+b') as snapshotFile:
+        if os.fstat(snapshotFile.fileno()).st_size < HEADER.size + FOOTER.size:
+            raise SnapshotError('truncated snapshot file')
+        with mmap.mmap(snapshotFile.fileno(), 0, access=mmap.ACCESS_READ) as snapshot:
+            magic, clean, createdAt = HEADER.unpack_from(snapshot)
+            footerStart = len(snapshot) - FOOTER.size
+            endMagic, count, checksum = FOOTER.unpack_from(snapshot, footerStart)
+            if magic != MAGIC or endMagic != END_MAGIC:
+                raise SnapshotError('not a snapshot file')
+            if zlib.crc32(memoryview(snapshot)[:footerStart]) != checksum:
+                raise SnapshotError('snapshot checksum mismatch')
+            if requireClean and not clean:
+                return 0
+
+            now = time.time()
+            loaded = 0
+            offset = HEADER.size
+            unpackRecord = RECORD.unpack_from
+            recordSize = RECORD.size
+            for index in range(count):
+                keyLength, flags, exptime, valueLength = unpackRecord(snapshot, offset)
+                keyStart = offset + recordSize
+                valueStart = keyStart + keyLength
+                offset = valueStart + valueLength
+                if offset > footerStart:
+                    raise SnapshotError('truncated snapshot record')
+                if exptime and exptime <= now:
+                    continue
+                key = snapshot[keyStart:valueStart]
+                if isLocal is not None and not isLocal(key):
+                    continue
+                # Items are stored from the least to the most recently used so the recency order is kept
+                try:
+                    if itemStore.set(key, flags, snapshot[valueStart:offset], exptime) is not None:
+                        loaded += 1
+                except ItemTooLarge:
+                    continue
+            if clean:
+                uncleanHeader = HEADER.pack(MAGIC, False, createdAt)
+                uncleanChecksum = zlib.crc32(memoryview(snapshot)[HEADER.size:footerStart], zlib.crc32(uncleanHeader))
+        if clean:
+            markUnclean(snapshotFile.fileno(), uncleanHeader, footerStart, count, uncleanChecksum)
+        return loaded
+
+def markUnclean(fileDescriptor, uncleanHeader, footerStart, count, uncleanChecksum):
+    """Clear the clean flag of a loaded snapshot in place, with the checksum of the file without it
+    :param fileDescriptor: file descriptor of the snapshot file, open for writing
+    :param uncleanHeader: bytestring header with the clean flag cleared
+    :param footerStart: offset of the footer in the file
+    :param count: number of records of the snapshot
+    :param uncleanChecksum: crc32 of the file with the unclean header
+    :no return:
+    """
+    os.pwrite(fileDescriptor, uncleanHeader, 0)
+    os.pwrite(fileDescriptor, FOOTER.pack(END_MAGIC, count, uncleanChecksum), footerStart)
+    os.fsync(fileDescriptor)
+
+class Snapshotter:
+    """Periodically writes the items of an ItemStore to a snapshot file on a background thread
+    The list of items is taken on the event loop, which is a consistent point in time since every
+    command runs in a single step, and only the serialization and the disk writes run on the thread
+    """
+    INTERVAL = 300 # Seconds between two snapshots
+
+    def __init__(self, path, itemStore, interval=INTERVAL):
+        """
+        :param path: path of the snapshot file
+        :param itemStore: ItemStore object whose items are written
+        :param interval: seconds between two snapshots, 0 to only write one when the server stops
+        :no return:
+        """
+        self.path = path
+        self.itemStore = itemStore
+        self.interval = interval
+        self.handle = None
+        self.writeFuture = None
+
+    def start(self):
+        """Schedule the periodic snapshots on the running event loop
+        :no return:
+        """
+        if self.interval > 0:
+            self.handle = asyncio.get_running_loop().call_later(self.interval, self.snapshot)
+
+    def snapshot(self, clean=False):
+        """Write a snapshot of the current items unless the previous one is still being written
+        :param clean: True if the snapshot is taken as the server stops
+        :return: future of the number of items written
+        """
+        loop = asyncio.get_running_loop()
+        if self.interval > 0 and not clean:
+            self.handle = loop.call_later(self.interval, self.snapshot)
+        if self.writeFuture is not None and not self.writeFuture.done():
+            return self.writeFuture
+        items = self.itemStore.snapshotItems()
+        self.writeFuture = loop.run_in_executor(None, writeSnapshot, self.path, items, clean)
+        self.writeFuture.add_done_callback(self.written)
+        return self.writeFuture
+
+    def written(self, future):
+        """Report a snapshot that failed, the next one is tried at the next interval
+        :param future: future of the snapshot write
+        :no return:
+        """
+        if not future.cancelled() and future.exception() is not None:
+            print('memcached: snapshot failed:', future.exception())
+
+    async def close(self):
+        """Stop the periodic snapshots and write a final clean one
+        :return: number of items written
+        """
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.writeFuture is not None:
+            await asyncio.wait([self.writeFuture])
+        self.writeFuture = None
+        return await self.snapshot(clean=True)
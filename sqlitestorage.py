@@ -0,0 +1,455 @@
+# Schedule the group commits on the event loop of the memcached server
+import asyncio
+
+# Run the blocking sqlite calls off the event loop
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# Filter and purge the expired rows
+import time
+
+# The bytes column is the length of a compressed value before compression
+from compression import COMPRESSED_FLAG, uncompressedLength
+
+# Shard files of a sharded database
+import hashlib
+import os.path
+
+# Sqlite
+import sqlite3
+from sqlite3 import Error
+
+class SqliteStorage:
+    """Write-behind persistence of the memcached items in the keysTable of a sqlite database
+    Writes and deletes are journaled in memory and committed together in one transaction
+    once the flush interval passed or the batch size is reached, instead of one transaction per write
+
+    Every sqlite call runs on a dedicated thread pool with its own connections so the event loop
+    keeps serving other clients while the disk is busy. Reads use a pool of reader threads, the commits
+    and existence checks share a single writer thread so they're executed in the order they're issued
+
+    Reads are coalesced: a key already being read isn't read again, its callers share the pending read,
+    and the keys requested by every connection during one event loop iteration are read with a single query
+    """
+    DURABILITY_NONE = 'none'           # Batched commits that are never fsynced
+    DURABILITY_BATCHED = 'batched'     # Batched commits that are fsynced once per batch
+    DURABILITY_PER_WRITE = 'per-write' # Every write is committed and fsynced before it's acknowledged
+    DURABILITY_LEVELS = (DURABILITY_NONE, DURABILITY_BATCHED, DURABILITY_PER_WRITE)
+
+    FLUSH_INTERVAL = 0.1 # Seconds
+    BATCH_SIZE = 1000 # Journaled writes
+    READER_THREADS = 4
+    PURGE_INTERVAL = 60 # Seconds between the deletes of the expired rows
+    MAX_QUERY_PARAMETERS = 500
+
+    INSERT_OR_REPLACE_QUERY = """ INSERT OR REPLACE INTO keysTable(key, flags, bytes, dataBlock, exptime) VALUES (?, ?, ?, ?, ?) """
+    DELETE_QUERY = """ DELETE FROM keysTable WHERE key=? """
+    PURGE_QUERY = """ DELETE FROM keysTable WHERE exptime != 0 AND exptime <= ? """
+    SELECT_QUERY = """ SELECT key, flags, bytes, dataBlock, exptime FROM keysTable WHERE key IN ({}) """
+    EXISTS_QUERY = """ SELECT 1 FROM keysTable WHERE key=? AND (exptime = 0 OR exptime > ?) """
+
+    def __init__(self, databaseFile, durability=DURABILITY_BATCHED, flushInterval=FLUSH_INTERVAL, batchSize=BATCH_SIZE, readerThreads=READER_THREADS):
+        """
+        :param databaseFile: full path to a sqlite database file
+        :param durability: one of the DURABILITY_LEVELS
+        :param flushInterval: seconds a write can wait in the journal before it's committed
+        :param batchSize: number of journaled writes that triggers a commit right away
+        :param readerThreads: number of threads reading keys that missed in memory
+        :no return:
+        """
+        if durability not in self.DURABILITY_LEVELS:
+            raise ValueError('Unknown durability level {}'.format(durability))
+        self.databaseFile = databaseFile
+        self.durability = durability
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self.journal = {} # key -> keysTable row to write, or None to delete the key
+        self.flushingJournal = {} # the journal that is being committed by the writer thread
+        self.flushHandle = None
+        self.flushFuture = None
+        self.lastPurge = time.time()
+        self.pendingReads = {} # key -> future of its keysTable row, shared by every caller reading the key
+        self.readBatch = [] # (key, future) pairs read by the next query, sent once the current loop iteration is done
+        self.readHandle = None
+        self.readers = ThreadPoolExecutor(max_workers=readerThreads, thread_name_prefix='sqlite-reader')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite-writer')
+        self.localConnections = threading.local()
+        self.connections = []
+        self.connectionsLock = threading.Lock()
+
+    def create_sqlite_connection(self):
+        """ create a database connection to the SQLite database
+            specified by the class's self.databaseFile variable
+            in WAL mode so the commits don't block readers like the front end server
+        :return: Connection object
+        """
+        connection = sqlite3.connect(self.databaseFile, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        if self.durability == self.DURABILITY_NONE:
+            connection.execute('PRAGMA synchronous=OFF')
+        else:
+            connection.execute('PRAGMA synchronous=FULL')
+        return connection
+
+    def connection(self):
+        """The sqlite connection of the calling executor thread
+        :return: Connection object
+        """
+        connection = getattr(self.localConnections, 'connection', None)
+        if connection is None:
+            connection = self.create_sqlite_connection()
+            self.localConnections.connection = connection
+            with self.connectionsLock:
+                self.connections.append(connection)
+        return connection
+
+    def journaledRow(self, key):
+        """Look up the most recent write of a key that isn't committed yet
+        :param key: bytestring key
+        :return: (True, row) if the key is journaled, row being None for a delete, otherwise (False, None)
+        """
+        if key in self.journal:
+            return True, self.journal[key]
+        if key in self.flushingJournal:
+            return True, self.flushingJournal[key]
+        return False, None
+
+    async def get_many(self, keys):
+        """Read keys that missed in memory, journaled writes take precedence over the database
+        :param keys: list of bytestring keys
+        :return: dictionary of bytestring key to (flags, dataBlock, exptime) tuples for the keys that are stored
+                 and not expired, the data blocks are the bytes of the dataBlock BLOB column as they were stored
+        """
+        # A key that isn't UTF-8 can't have a row, reading it would fail the query shared with other keys
+        databaseKeys = [key for key in keys if not self.journaledRow(key)[0] and isUtf8(key)]
+        databaseRows = {}
+        if databaseKeys:
+            pendingReads = {key: self.readRow(key) for key in databaseKeys}
+            # Waiting doesn't cancel the shared reads if this caller is cancelled
+            await asyncio.wait(set(pendingReads.values()))
+            databaseRows = {key: pendingRead.result() for key, pendingRead in pendingReads.items()}
+
+        # Writes journaled while the database was read are more recent than the rows that were read
+        results = {}
+        now = time.time()
+        for key in keys:
+            journaled, row = self.journaledRow(key)
+            if not journaled:
+                row = databaseRows.get(key)
+            if row is not None and (not row[4] or row[4] > now):
+                results[key] = (row[1], row[3], row[4])
+        return results
+
+    def journaledWrites(self):
+        """
+        :return: number of writes and deletes waiting to be committed
+        """
+        return len(self.journal) + len(self.flushingJournal)
+
+    def readRow(self, key):
+        """Join the pending read of a key or add it to the next query
+        :param key: bytestring key
+        :return: future of the keysTable row of the key, None if it isn't in the database
+        """
+        pendingRead = self.pendingReads.get(key)
+        if pendingRead is None:
+            loop = asyncio.get_running_loop()
+            pendingRead = self.pendingReads[key] = loop.create_future()
+            self.readBatch.append((key, pendingRead))
+            if self.readHandle is None:
+                self.readHandle = loop.call_soon(self.readBatchedRows)
+        return pendingRead
+
+    def readBatchedRows(self):
+        """Read every key batched during the last loop iteration with a single query on a reader thread
+        :no return:
+        """
+        self.readHandle = None
+        batch = self.readBatch
+        self.readBatch = []
+        keys = list(dict.fromkeys(key for key, pendingRead in batch))
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(self.readers, self.selectRows, keys).add_done_callback(
+            lambda future: self.batchedRowsRead(batch, future))
+
+    def batchedRowsRead(self, batch, future):
+        """Callback run on the event loop once a batched query completed, resolving the reads of its keys
+        :param batch: list of (bytestring key, future of its row) of the query
+        :param future: future of the rows returned by selectRows
+        :no return:
+        """
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        rows = future.result() if error is None else {}
+        for key, pendingRead in batch:
+            if self.pendingReads.get(key) is pendingRead:
+                del self.pendingReads[key]
+            if pendingRead.done():
+                continue
+            if error is None:
+                pendingRead.set_result(rows.get(key))
+            else:
+                pendingRead.set_exception(error)
+
+    def forgetPendingRead(self, key):
+        """Make the next callers reading a key that was just written start a new read instead of joining
+        one that may have been sent before the write, the callers already waiting find the write in the journal
+        :param key: bytestring key
+        :no return:
+        """
+        self.pendingReads.pop(key, None)
+
+    def selectRows(self, keys):
+        """Executor method reading keysTable rows
+        :param keys: list of bytestring keys
+        :return: dictionary of bytestring key to keysTable row
+        """
+        rows = {}
+        connection = self.connection()
+        for start in range(0, len(keys), self.MAX_QUERY_PARAMETERS):
+            chunk = keys[start:start + self.MAX_QUERY_PARAMETERS]
+            interpolationString = "?," * (len(chunk) - 1) + "?"
+            cursor = connection.execute(self.SELECT_QUERY.format(interpolationString), tuple(key.decode() for key in chunk))
+            for row in cursor.fetchall():
+                rows[row[0].encode('utf-8')] = row
+        return rows
+
+    def set(self, key, flags, dataBlock, exptime=0):
+        """Journal a write of a key
+        :param key: bytestring key
+        :param flags: 16 bit unsigned integer, with COMPRESSED_FLAG if the value is compressed
+        :param dataBlock: bytestring value, its length before compression is the bytes column
+        :param exptime: unix time the item expires at, 0 if it never expires
+        :raise ValueError: if the key isn't UTF-8, it can't be persisted
+        :return: None once journaled, or a future that completes when the write is committed with per-write durability
+        """
+        if not isUtf8(key):
+            raise ValueError('key is not UTF-8')
+        length = uncompressedLength(dataBlock) if flags & COMPRESSED_FLAG else len(dataBlock)
+        row = (key.decode(), flags, length, dataBlock, exptime)
+        self.forgetPendingRead(key)
+        if self.durability == self.DURABILITY_PER_WRITE:
+            loop = asyncio.get_running_loop()
+            return loop.run_in_executor(self.writer, self.writeRows, [row], [])
+
+        self.journal[key] = row
+        self.scheduleFlush()
+        return None
+
+    def delete(self, key, checkExists=True):
+        """Journal the deletion of a key
+        :param key: bytestring key
+        :param checkExists: whether the caller needs to know if the key was persisted
+        :return: None if checkExists is False and the delete is journaled, otherwise
+                 an awaitable that resolves to True if the key was persisted or journaled
+        """
+        loop = asyncio.get_running_loop()
+        if not isUtf8(key):
+            # Never persisted, journaling it would fail the whole batch of the next flush
+            if not checkExists:
+                return None
+            found = loop.create_future()
+            found.set_result(False)
+            return found
+        self.forgetPendingRead(key)
+        if self.durability == self.DURABILITY_PER_WRITE:
+            return loop.run_in_executor(self.writer, self.writeRows, [], [(key.decode(),)])
+
+        journaled, row = self.journaledRow(key)
+        self.journal[key] = None
+        self.scheduleFlush()
+        if not checkExists:
+            return None
+        if journaled:
+            found = loop.create_future()
+            found.set_result(row is not None)
+            return found
+        # Submitted before the flush that commits this delete, so the writer thread still sees the key
+        return loop.run_in_executor(self.writer, self.rowExists, key)
+
+    def rowExists(self, key):
+        """Executor method checking if a key is in the keysTable
+        :param key: bytestring key
+        :return: True if the row exists
+        """
+        return self.connection().execute(self.EXISTS_QUERY, (key.decode(), time.time())).fetchone() is not None
+
+    def writeRows(self, rows, deletedKeys, purgeBefore=None):
+        """Executor method committing writes and deletes in a single transaction
+        :param rows: list of keysTable rows to insert or replace
+        :param deletedKeys: list of (key,) tuples to delete
+        :param purgeBefore: unix time, rows that expired before it are deleted as well
+        :return: True if any of the deletedKeys was deleted
+        """
+        connection = self.connection()
+        with connection:
+            connection.executemany(self.INSERT_OR_REPLACE_QUERY, rows)
+            cursor = connection.executemany(self.DELETE_QUERY, deletedKeys)
+            deleted = cursor.rowcount > 0
+            if purgeBefore is not None:
+                connection.execute(self.PURGE_QUERY, (purgeBefore,))
+        return deleted
+
+    def scheduleFlush(self):
+        """Commit the journal right away when the batch is full, otherwise once the flush interval passed
+        """
+        if len(self.journal) >= self.batchSize:
+            self.flush()
+        elif self.flushHandle is None:
+            loop = asyncio.get_running_loop()
+            self.flushHandle = loop.call_later(self.flushInterval, self.flush)
+
+    def flush(self):
+        """Hand every journaled write and delete to the writer thread to be committed in a single transaction
+        Only one transaction is in flight at a time, the journal keeps growing until it completes
+        :return: future of the transaction in flight or None if there is nothing to commit
+        """
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        if self.flushFuture is not None or not self.journal:
+            return self.flushFuture
+
+        # The rows are built before the journal is handed over, so a failure leaves it in place
+        rows = [row for row in self.journal.values() if row is not None]
+        deletedKeys = [(key.decode(),) for key, row in self.journal.items() if row is None]
+        self.flushingJournal = self.journal
+        self.journal = {}
+        purgeBefore = None
+        now = time.time()
+        if now - self.lastPurge >= self.PURGE_INTERVAL:
+            purgeBefore = self.lastPurge = now
+        loop = asyncio.get_running_loop()
+        self.flushFuture = loop.run_in_executor(self.writer, self.writeRows, rows, deletedKeys, purgeBefore)
+        self.flushFuture.add_done_callback(self.flushDone)
+        return self.flushFuture
+
+    def flushDone(self, future):
+        """Callback run on the event loop once the writer thread finished a transaction
+        The journal that failed to commit is kept for the next flush
+        :param future: future of the transaction
+        """
+        self.flushFuture = None
+        if future.cancelled() or future.exception() is not None:
+            print(future.exception() if not future.cancelled() else 'flush cancelled')
+            self.flushingJournal.update(self.journal)
+            self.journal = self.flushingJournal
+        self.flushingJournal = {}
+        if self.journal and self.flushHandle is None:
+            loop = asyncio.get_running_loop()
+            self.flushHandle = loop.call_later(self.flushInterval, self.flush)
+
+    async def close(self):
+        """Commit the journal, then stop the executor threads and close their database connections
+        """
+        while self.journal or self.flushFuture is not None:
+            flushFuture = self.flush()
+            try:
+                await flushFuture
+            except Error:
+                break
+        if self.flushHandle is not None:
+            self.flushHandle.cancel()
+            self.flushHandle = None
+        self.readers.shutdown()
+        self.writer.shutdown()
+        for connection in self.connections:
+            connection.close()
+
+
+def shardFiles(databaseFile, shardCount):
+    """The files of a database split in shards, the first shard is the database file itself
+    so the rows of an unsharded database stay where they are
+    :param databaseFile: full path to the sqlite database file
+    :param shardCount: number of shards
+    :return: list of the full paths of the shard files, e.g. database.sqlite, database-1.sqlite, ...
+    """
+    root, extension = os.path.splitext(databaseFile)
+    return [databaseFile] + ['{}-{}{}'.format(root, shardIndex, extension) for shardIndex in range(1, shardCount)]
+
+def isUtf8(key):
+    """The keys are stored as TEXT, a key that isn't valid UTF-8 is never persisted
+    :param key: bytestring key
+    :return: True if the key decodes as UTF-8
+    """
+    try:
+        key.decode()
+    except UnicodeDecodeError:
+        return False
+    return True
+
+def keyShard(key, shardCount):
+    """The shard a key is persisted in
+    Not the CRC32 the workers are chosen by, otherwise every worker would only write to some of the shards
+    :param key: bytestring key
+    :param shardCount: number of shards
+    :return: integer index of the shard
+    """
+    return int.from_bytes(hashlib.md5(key).digest()[:4], 'big') % shardCount
+
+class ShardedSqliteStorage:
+    """SqliteStorage split over several database files chosen by the hash of the keys
+    Sqlite serializes the writers of a database file, every shard has its own writer thread, journal
+    and connections so the commits of different shards run in parallel
+    """
+    def __init__(self, databaseFiles, durability=SqliteStorage.DURABILITY_BATCHED, flushInterval=SqliteStorage.FLUSH_INTERVAL,
+                 batchSize=SqliteStorage.BATCH_SIZE, readerThreads=SqliteStorage.READER_THREADS):
+        """
+        :param databaseFiles: list of the full paths of the shard files, as returned by shardFiles
+        :param durability: one of the SqliteStorage.DURABILITY_LEVELS
+        :param flushInterval: seconds a write can wait in the journal of its shard before it's committed
+        :param batchSize: number of journaled writes of a shard that triggers a commit right away
+        :param readerThreads: number of threads reading each shard
+        :no return:
+        """
+        self.shards = [SqliteStorage(databaseFile, durability, flushInterval, batchSize, readerThreads)
+                       for databaseFile in databaseFiles]
+
+    def shard(self, key):
+        """
+        :param key: bytestring key
+        :return: SqliteStorage of the shard the key is persisted in
+        """
+        return self.shards[keyShard(key, len(self.shards))]
+
+    def journaledWrites(self):
+        """
+        :return: number of writes and deletes waiting to be committed in every shard
+        """
+        return sum(shard.journaledWrites() for shard in self.shards)
+
+    async def get_many(self, keys):
+        """Read keys that missed in memory from their shards, the shards are read concurrently
+        :param keys: list of bytestring keys
+        :return: dictionary of bytestring key to (flags, dataBlock, exptime) as returned by SqliteStorage.get_many
+        """
+        shardKeys = {}
+        for key in keys:
+            shardKeys.setdefault(keyShard(key, len(self.shards)), []).append(key)
+        results = {}
+        for shardResults in await asyncio.gather(*(self.shards[shardIndex].get_many(keys) for shardIndex, keys in shardKeys.items())):
+            results.update(shardResults)
+        return results
+
+    def set(self, key, flags, dataBlock, exptime=0):
+        """Journal a write of a key in its shard
+        :return: as returned by SqliteStorage.set
+        """
+        return self.shard(key).set(key, flags, dataBlock, exptime)
+
+    def delete(self, key, checkExists=True):
+        """Journal the deletion of a key in its shard
+        :return: as returned by SqliteStorage.delete
+        """
+        return self.shard(key).delete(key, checkExists)
+
+    def flush(self):
+        """Commit the journal of every shard
+        :return: future that completes once every shard committed its journal
+        """
+        flushFutures = [flushFuture for flushFuture in (shard.flush() for shard in self.shards) if flushFuture is not None]
+        return asyncio.gather(*flushFutures)
+
+    async def close(self):
+        """Commit the journal of every shard and close them
+        """
+        await asyncio.gather(*(shard.close() for shard in self.shards))
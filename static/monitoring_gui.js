@@ -2,43 +2,293 @@
 
 const e = React.createElement;
 
-function ListItem(props) {
+const PAGE_SIZE = 200; // Keys fetched from the keys API at a time
+const ROW_HEIGHT = 50; // Pixels of a key row, rows have a fixed height so only the visible ones are rendered
+const VALUE_HEIGHT = 150; // Pixels of the value shown under an expanded key
+const OVERSCAN = 10; // Rows rendered above and below the visible ones
+const SEARCH_DELAY = 300; // Milliseconds without typing before a prefix search is sent
+
+function rowAt(offset, expandedIndices) {
+  // Index of the row at a pixel offset, expandedIndices are sorted
+  let extra = 0;
+  for (const index of expandedIndices) {
+    const top = index * ROW_HEIGHT + extra;
+    if (offset < top) {
+      break;
+    }
+    if (offset < top + ROW_HEIGHT + VALUE_HEIGHT) {
+      return index;
+    }
+    extra += VALUE_HEIGHT;
+  }
+  return Math.floor((offset - extra) / ROW_HEIGHT);
+}
+
+function rowTop(index, expandedIndices) {
+  let top = index * ROW_HEIGHT;
+  for (const expandedIndex of expandedIndices) {
+    if (expandedIndex >= index) {
+      break;
+    }
+    top += VALUE_HEIGHT;
+  }
+  return top;
+}
 
-    const [visibility, setVisibility] = React.useState(false)
+function ListItem(props) {
+  let value = null;
+  if (props.expanded) {
+    let text;
+    if (props.value === undefined) {
+      text = 'Loading…';
+    } else if (props.value === null) {
+      text = 'This key was deleted or has expired';
+    } else {
+      text = props.value.value + (props.value.truncated ? ' … (' + props.value.bytes + ' bytes)' : '');
+    }
+    value = <p className="key-value" style={{height: VALUE_HEIGHT}}>{text}</p>;
+  }
 
-    return <li><div class="list-item" onClick={() => setVisibility(!visibility)}><p class="key-name">{props.keyName}</p><p class="key-value" style={{display: visibility ? 'block': 'none'}}>{props.value}</p></div></li>;
+  return <li style={{top: props.top}}>
+    <div className="list-item" onClick={() => props.onToggle(props.index)}>
+      <p className="key-name" style={{height: ROW_HEIGHT}}>{props.keyName}</p>
+      {value}
+    </div>
+  </li>;
 }
 
 class KeyList extends React.Component {
   constructor(props) {
     super(props);
     this.state = {
-      keyList: props.keyList
+      keyList: [],
+      next: '',
+      loading: true,
+      prefix: '',
+      expanded: {},
+      values: {},
+      scrollTop: 0,
+      viewHeight: 0
     };
+    this.scroller = React.createRef();
+    this.request = 0;
+    this.searchTimeout = null;
+    this.onScroll = this.onScroll.bind(this);
+    this.onSearch = this.onSearch.bind(this);
+    this.onToggle = this.onToggle.bind(this);
+  }
+
+  componentDidMount() {
+    this.setState({viewHeight: this.scroller.current.clientHeight});
+    this.loadPage();
+  }
+
+  componentDidUpdate() {
+    // Load the next page once the rendered rows get close to the end of the loaded keys
+    const state = this.state;
+    if (state.next !== null && !state.loading && this.lastRenderedRow() >= state.keyList.length - OVERSCAN) {
+      this.loadPage();
+    }
+  }
+
+  expandedIndices() {
+    return Object.keys(this.state.expanded).map(Number).sort((a, b) => a - b);
+  }
+
+  lastRenderedRow() {
+    return rowAt(this.state.scrollTop + this.state.viewHeight, this.expandedIndices()) + OVERSCAN;
+  }
+
+  loadPage() {
+    const request = this.request;
+    const query = new URLSearchParams({prefix: this.state.prefix, after: this.state.next, limit: PAGE_SIZE});
+    this.setState({loading: true});
+    fetch('/api/keys?' + query)
+      .then((response) => response.json())
+      .then((page) => {
+        // A page of a previous search is dropped
+        if (request === this.request) {
+          this.setState((state) => ({keyList: state.keyList.concat(page.keys), next: page.next, loading: false}));
+        }
+      })
+      .catch(() => {
+        if (request === this.request) {
+          this.setState({next: null, loading: false});
+        }
+      });
+  }
+
+  onScroll(event) {
+    this.setState({scrollTop: event.target.scrollTop, viewHeight: event.target.clientHeight});
+  }
+
+  onSearch(event) {
+    const prefix = event.target.value;
+    clearTimeout(this.searchTimeout);
+    this.searchTimeout = setTimeout(() => {
+      this.request += 1;
+      this.scroller.current.scrollTop = 0;
+      this.setState({keyList: [], next: '', loading: true, prefix: prefix, expanded: {}, values: {}, scrollTop: 0},
+                    () => this.loadPage());
+    }, SEARCH_DELAY);
+  }
+
+  onToggle(index) {
+    const keyName = this.state.keyList[index].keyName;
+    const expanded = Object.assign({}, this.state.expanded);
+    if (expanded[index]) {
+      delete expanded[index];
+      this.setState({expanded: expanded});
+      return;
+    }
+    expanded[index] = true;
+    this.setState({expanded: expanded});
+    // Values are only fetched when their key is expanded
+    if (!(keyName in this.state.values)) {
+      const request = this.request;
+      fetch('/api/value?' + new URLSearchParams({key: keyName}))
+        .then((response) => response.ok ? response.json() : null)
+        .then((value) => {
+          if (request === this.request) {
+            this.setState((state) => ({values: Object.assign({}, state.values, {[keyName]: value})}));
+          }
+        });
+    }
   }
 
   render() {
-    let displayList
-    if (this.state.keyList.length > 0) {
-      displayList = <ul>
-        {this.state.keyList.map((item) =>
+    const state = this.state;
+    const expandedIndices = this.expandedIndices();
+    let displayList;
+    if (state.keyList.length > 0) {
+      // Only the rows in view and a few around them are rendered, positioned in a list as high as every loaded row
+      const first = Math.max(rowAt(state.scrollTop, expandedIndices) - OVERSCAN, 0);
+      const last = Math.min(this.lastRenderedRow(), state.keyList.length - 1);
+      const rows = [];
+      for (let index = first; index <= last; index++) {
+        const item = state.keyList[index];
+        rows.push(
           <ListItem
             key={item.keyName}
+            index={index}
+            top={rowTop(index, expandedIndices)}
             keyName={item.keyName}
-            value={item.value}
+            expanded={Boolean(state.expanded[index])}
+            value={state.values[item.keyName]}
+            onToggle={this.onToggle}
           />
-        )}
-      </ul>;
+        );
+      }
+      displayList = <ul style={{height: rowTop(state.keyList.length, expandedIndices)}}>{rows}</ul>;
+    } else if (state.loading) {
+      displayList = <h4>Loading keys…</h4>;
+    } else if (state.prefix) {
+      displayList = <h4>There aren't any keys starting with {state.prefix} stored in the memcached database.</h4>;
     } else {
       displayList = <h4>There aren't any keys stored in the memcached database. Add keys by connecting to the memcached server on port 11211 and using the set command.</h4>
     }
 
-
     return (
-      <div>{displayList}</div>
+      <div className="key-browser">
+        <input className="key-search" type="search" placeholder="Search keys by prefix" onChange={this.onSearch}/>
+        <div className="key-scroller" ref={this.scroller} onScroll={this.onScroll}>{displayList}</div>
+      </div>
     );
   }
 }
 
+const METRICS_HISTORY = 60; // Samples of the metrics feed charted, a minute at the default interval
+const CHART_HEIGHT = 40;
+
+const METRICS = [
+  {label: 'Operations / s', value: (sample) => sample.ops_per_sec, format: (value) => value.toFixed(0)},
+  {label: 'Get hit ratio', value: (sample) => sample.get_hit_ratio, format: (value) => (value * 100).toFixed(1) + '%'},
+  {label: 'Memory', value: (sample) => sample.bytes, max: (sample) => sample.limit_maxbytes,
+   format: (value, sample) => (value / 1048576).toFixed(1) + ' / ' + (sample.limit_maxbytes / 1048576).toFixed(0) + ' MB'},
+  {label: 'Evictions / s', value: (sample) => sample.evictions_per_sec, format: (value) => value.toFixed(1)},
+  {label: 'Connections', value: (sample) => sample.curr_connections, format: (value) => value.toFixed(0)},
+  {label: 'Latency p50 / p99', value: (sample) => sample.p99_us,
+   format: (value, sample) => '≤' + sample.p50_us + ' / ≤' + value + ' µs'}
+];
+
+function Sparkline(props) {
+  // The values of the history charted from 0 to their maximum, a missing value leaves a gap
+  const max = Math.max(props.max || 0, ...props.values.filter((value) => value !== null), 1);
+  const lines = [[]];
+  props.values.forEach((value, index) => {
+    if (value === null) {
+      lines.push([]);
+    } else {
+      const x = index + METRICS_HISTORY - props.values.length;
+      lines[lines.length - 1].push(x + ',' + (CHART_HEIGHT - value / max * CHART_HEIGHT));
+    }
+  });
+  return <svg viewBox={'0 0 ' + (METRICS_HISTORY - 1) + ' ' + CHART_HEIGHT} preserveAspectRatio="none">
+    {lines.filter((points) => points.length).map((points, index) =>
+      <polyline key={index} points={points.join(' ')} vectorEffect="non-scaling-stroke"/>
+    )}
+  </svg>;
+}
+
+const HOT_KEYS_SHOWN = 5;
+
+function HotKeys(props) {
+  // Estimated accesses per second of the hottest keys, decaying over the last few seconds
+  return <div className="metric hot-keys">
+    <p>Hot keys</p>
+    {props.hotKeys.length === 0 ? <p className="metric-value">–</p> :
+      <ol>
+        {props.hotKeys.slice(0, HOT_KEYS_SHOWN).map(([keyName, rate]) =>
+          <li key={keyName}><span className="hot-key-name">{keyName}</span> {rate.toFixed(1)}/s</li>
+        )}
+      </ol>}
+  </div>;
+}
+
+class MetricsPanel extends React.Component {
+  constructor(props) {
+    super(props);
+    this.state = {
+      samples: [],
+      connected: false
+    };
+  }
+
+  componentDidMount() {
+    // The front end relays the samples pushed by the memcached server, the browser reconnects the stream on its own
+    this.source = new EventSource('/api/metrics');
+    this.source.onmessage = (event) => {
+      const sample = JSON.parse(event.data);
+      this.setState((state) => ({samples: state.samples.concat([sample]).slice(-METRICS_HISTORY), connected: true}));
+    };
+    this.source.onerror = () => this.setState({connected: false});
+  }
+
+  componentWillUnmount() {
+    this.source.close();
+  }
+
+  render() {
+    const samples = this.state.samples;
+    if (samples.length === 0) {
+      return <p>{this.state.connected ? 'Waiting for the metrics…' : 'Connecting to the metrics of the memcached server…'}</p>;
+    }
+    const last = samples[samples.length - 1];
+    const metrics = METRICS.map((metric) => {
+      const value = metric.value(last);
+      return <div className="metric" key={metric.label}>
+        <p>{metric.label}</p>
+        <p className="metric-value">{value === null ? '–' : metric.format(value, last)}{this.state.connected ? '' : ' (offline)'}</p>
+        <Sparkline values={samples.map(metric.value)} max={metric.max ? metric.max(last) : 0}/>
+      </div>;
+    });
+    if (last.hot_keys) {
+      metrics.push(<HotKeys key="hot-keys" hotKeys={last.hot_keys}/>);
+    }
+    return metrics;
+  }
+}
+
 const domContainer = document.querySelector('#react-component');
-ReactDOM.render(<KeyList keyList={keyValuePairs}/>, domContainer);
+ReactDOM.render(<KeyList/>, domContainer);
+ReactDOM.render(<MetricsPanel/>, document.querySelector('#metrics-component'));
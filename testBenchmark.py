@@ -0,0 +1,68 @@
+import unittest
+import asyncio
+from benchmark import Benchmark, KeySampler, percentile
+from memcachedserver import MemcachedServer
+from itemstore import ItemStore
+
+
+class TestKeySampler(unittest.TestCase):
+
+    def testUniform(self):
+        sampler = KeySampler(10, seed=1)
+        samples = [sampler.sample() for index in range(1000)]
+        self.assertEqual(set(samples), set(range(10)))
+
+    def testZipfFavorsTheFirstKeys(self):
+        sampler = KeySampler(1000, 'zipf', seed=1)
+        samples = [sampler.sample() for index in range(10000)]
+        self.assertTrue(all(0 <= sample < 1000 for sample in samples))
+        self.assertGreater(samples.count(0), samples.count(10) * 5)
+        self.assertGreater(sum(sample < 100 for sample in samples), 5000)
+
+    def testUnknownDistribution(self):
+        with self.assertRaises(ValueError):
+            KeySampler(10, 'normal')
+
+    def testPercentile(self):
+        latencies = list(range(1, 1001))
+        self.assertEqual(percentile(latencies, 0.5), 501)
+        self.assertEqual(percentile(latencies, 0.999), 1000)
+        self.assertEqual(percentile([], 0.5), 0)
+
+
+class TestBenchmark(unittest.IsolatedAsyncioTestCase):
+
+    async def testRun(self):
+        loop = asyncio.get_running_loop()
+        itemStore = ItemStore(1024 * 1024)
+        server = await loop.create_server(lambda: MemcachedServer(None, itemStore), '127.0.0.1', 0)
+        benchmark = Benchmark('127.0.0.1', server.sockets[0].getsockname()[1], connections=4, duration=0.2, getRatio=0.5,
+                              valueSize=10, keyCount=50, distribution='zipf', pipelineDepth=3, seed=1)
+        results = await benchmark.run()
+        server.close()
+        self.assertEqual(len(itemStore), 50)
+        self.assertGreater(results['operations'], 0)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(results['hitRatio'], 1.0)
+        self.assertEqual(results['config']['pipelineDepth'], 3)
+        self.assertEqual(set(results['latencyUs']), {'all', 'get', 'set'})
+        self.assertLessEqual(results['latencyUs']['all']['p50'], results['latencyUs']['all']['p999'])
+
+    async def testScansAreSet(self):
+        loop = asyncio.get_running_loop()
+        itemStore = ItemStore(1024 * 1024)
+        server = await loop.create_server(lambda: MemcachedServer(None, itemStore), '127.0.0.1', 0)
+        benchmark = Benchmark('127.0.0.1', server.sockets[0].getsockname()[1], connections=2, duration=0.2, getRatio=1,
+                              valueSize=10, keyCount=50, pipelineDepth=3, seed=1, scanRatio=0.5)
+        results = await benchmark.run()
+        server.close()
+        scannedKeys = [key for key in itemStore.items if key.startswith(b'scan:')]
+        self.assertGreater(len(scannedKeys), 0)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(results['config']['scanRatio'], 0.5)
+        # The scans miss but aren't counted in the hit ratio
+        self.assertEqual(results['hitRatio'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import binaryprotocol
+from binaryprotocol import BinaryRequest, HEADER, SET_EXTRAS
+
+
+def requestPacket(opcode, key=b'', value=b'', extras=b'', opaque=0, cas=0):
+    return HEADER.pack(0x80, opcode, len(key), len(extras), 0, 0, len(extras) + len(key) + len(value), opaque, cas) + extras + key + value
+
+
+def parseRequest(packet):
+    return BinaryRequest(HEADER.unpack_from(packet), packet[HEADER.size:])
+
+
+class TestBinaryRequest(unittest.TestCase):
+
+    def testParse(self):
+        request = parseRequest(requestPacket(binaryprotocol.OPCODE_SETQ, b'capitalOfChina', b'Beijing', SET_EXTRAS.pack(14, 60), 7, 3))
+        self.assertEqual((request.key, request.value, request.opaque, request.cas), (b'capitalOfChina', b'Beijing', 7, 3))
+        self.assertEqual(SET_EXTRAS.unpack(request.extras), (14, 60))
+        self.assertTrue(request.quiet)
+        self.assertTrue(request.wellFormed)
+
+    def testMalformedKeyLength(self):
+        packet = HEADER.pack(0x80, binaryprotocol.OPCODE_GET, 20, 0, 0, 0, 5, 0, 0) + b'short'
+        self.assertFalse(parseRequest(packet).wellFormed)
+
+    def testItemResponse(self):
+        request = parseRequest(requestPacket(binaryprotocol.OPCODE_GETK, b'capitalOfChina', opaque=9))
+        response = request.itemResponse(14, b'Beijing', 5)
+        self.assertEqual(HEADER.unpack_from(response), (0x81, binaryprotocol.OPCODE_GETK, 14, 4, 0, 0, 25, 9, 5))
+        self.assertEqual(response[HEADER.size:], b'\x00\x00\x00\x0ecapitalOfChinaBeijing')
+
+    def testErrorResponse(self):
+        request = parseRequest(requestPacket(binaryprotocol.OPCODE_GET, b'capitalOfChina'))
+        response = request.errorResponse(binaryprotocol.STATUS_KEY_NOT_FOUND)
+        self.assertEqual(HEADER.unpack_from(response)[5], binaryprotocol.STATUS_KEY_NOT_FOUND)
+        self.assertEqual(response[HEADER.size:], b'Not found')
+
+    def testMetaCommand(self):
+        get = parseRequest(requestPacket(binaryprotocol.OPCODE_GET, b'capitalOfChina'))
+        self.assertEqual(get.metaCommand(), b'mg Y2FwaXRhbE9mQ2hpbmE= b f c v\r\n')
+        setRequest = parseRequest(requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Beijing', SET_EXTRAS.pack(14, 60), cas=3))
+        self.assertEqual(setRequest.metaCommand(), b'ms Y2FwaXRhbE9mQ2hpbmE= 7 b F14 T60 c C3\r\nBeijing\r\n')
+        delete = parseRequest(requestPacket(binaryprotocol.OPCODE_DELETEQ, b'capitalOfChina'))
+        self.assertEqual(delete.metaCommand(), b'md Y2FwaXRhbE9mQ2hpbmE= b\r\n')
+
+    def testMetaResponse(self):
+        get = parseRequest(requestPacket(binaryprotocol.OPCODE_GETQ, b'capitalOfChina'))
+        self.assertEqual(get.metaResponse(b'VA 7 f14 c5\r\nBeijing\r\n'), get.itemResponse(14, b'Beijing', 5))
+        self.assertEqual(get.metaResponse(b'EN\r\n'), b'')
+        setRequest = parseRequest(requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Beijing', SET_EXTRAS.pack(0, 0)))
+        self.assertEqual(HEADER.unpack_from(setRequest.metaResponse(b'HD c8\r\n'))[8], 8)
+        self.assertEqual(HEADER.unpack_from(setRequest.metaResponse(b'EX\r\n'))[5], binaryprotocol.STATUS_KEY_EXISTS)
+        self.assertEqual(HEADER.unpack_from(setRequest.metaResponse(b'SERVER_ERROR error storing data\r\n'))[5],
+                         binaryprotocol.STATUS_INTERNAL_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
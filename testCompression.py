@@ -0,0 +1,30 @@
+import unittest
+from compression import ValueCompressor, uncompressedLength
+
+
+class TestValueCompressor(unittest.TestCase):
+
+    def setUp(self):
+        self.compressor = ValueCompressor(threshold=64)
+        self.value = b'{"capitalOfChina": "Beijing", "biggestOcean": "Pacific"}' * 10
+
+    def testCompressAboveThreshold(self):
+        compressed = self.compressor.compress(self.value)
+        self.assertEqual(uncompressedLength(compressed), len(self.value))
+        self.assertEqual(self.compressor.decompress(compressed), self.value)
+        stats = dict(self.compressor.stats())
+        self.assertEqual(stats['compressed_values'], 1)
+        self.assertEqual(stats['compression_bytes_in'], len(self.value))
+        self.assertEqual(stats['compression_bytes_out'], len(compressed))
+        self.assertEqual(stats['compression_ratio'], '{:.2f}'.format(len(self.value) / len(compressed)))
+        self.assertEqual(stats['decompressions'], 1)
+
+    def testSmallAndIncompressibleValuesAreNotCompressed(self):
+        self.assertEqual(self.compressor.compress(b'Beijing'), None)
+        self.assertEqual(self.compressor.compress(bytes(range(256))), None)
+        self.assertEqual(ValueCompressor().compress(self.value), None)
+        self.assertEqual(self.compressor.compressedValues, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
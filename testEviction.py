@@ -0,0 +1,99 @@
+import unittest
+from itemstore import ItemStore
+from eviction import FrequencySketch, TinyLFUPolicy
+
+
+class TestFrequencySketch(unittest.TestCase):
+
+    def setUp(self):
+        self.sketch = FrequencySketch(256)
+
+    def testFrequencies(self):
+        for _ in range(5):
+            self.sketch.increment(b'capitalOfChina')
+        self.sketch.increment(b'biggestOcean')
+        self.assertEqual(self.sketch.frequency(b'capitalOfChina'), 5)
+        self.assertEqual(self.sketch.frequency(b'biggestOcean'), 1)
+        self.assertEqual(self.sketch.frequency(b'tallestMountain'), 0)
+
+    def testCountersSaturateAndAge(self):
+        for _ in range(100):
+            self.sketch.increment(b'capitalOfChina')
+        self.assertEqual(self.sketch.frequency(b'capitalOfChina'), FrequencySketch.MAX_COUNT)
+        self.sketch.halve()
+        self.assertEqual(self.sketch.frequency(b'capitalOfChina'), FrequencySketch.MAX_COUNT // 2)
+        self.assertEqual(self.sketch.additions, 50)
+        # Counting 10 accesses per counter halves every counter
+        for index in range(self.sketch.resetAfter - 50):
+            self.sketch.increment(b'key%d' % index)
+        self.assertLess(self.sketch.additions, self.sketch.resetAfter)
+        self.assertLessEqual(self.sketch.frequency(b'capitalOfChina'), FrequencySketch.MAX_COUNT // 4 + 1)
+
+
+class TestTinyLFU(unittest.TestCase):
+
+    def setUp(self):
+        self.itemStore = ItemStore(1024, evictionPolicy='tinylfu')
+        # The probe key is as long as the longest key of the tests
+        self.itemStore.set(b'scan000', 0, b'x' * 100)
+        self.itemSize = self.itemStore.memoryUsed
+        self.itemStore.delete(b'scan000')
+        # Room for 20 items, the window holds the last one added
+        self.itemStore.memoryLimit = self.itemSize * 20
+        self.itemStore.policy = TinyLFUPolicy(self.itemStore.items, self.itemStore.memoryLimit)
+        self.itemStore.policy.windowLimit = self.itemSize + 50
+        # A sketch sized for the keys of the tests, the smallest one would be as wide as the number of keys
+        self.itemStore.policy.sketch = FrequencySketch(4096)
+
+    def testScanDoesNotFlushTheHotKeys(self):
+        hotKeys = [b'hot%d' % index for index in range(10)]
+        for key in hotKeys:
+            self.itemStore.set(key, 0, b'x' * 100)
+        for _ in range(3):
+            for key in hotKeys:
+                self.assertIsNotNone(self.itemStore.get(key))
+        for index in range(200):
+            self.itemStore.set(b'scan%d' % index, 0, b'x' * 100)
+        self.assertTrue(all(key in self.itemStore for key in hotKeys))
+        self.assertLessEqual(self.itemStore.memoryUsed, self.itemStore.memoryLimit)
+        self.assertEqual(len(self.itemStore), 20)
+        self.assertEqual(self.itemStore.evictions, 190)
+        self.assertGreater(self.itemStore.policy.rejections, 0)
+
+    def testRejectedInsertIsNotReturned(self):
+        # New keys are candidates for the main space right away
+        self.itemStore.policy.windowLimit = 1
+        for index in range(20):
+            self.itemStore.set(b'hot%d' % index, 0, b'x' * 100)
+        # Not accessed more often than the probation keys
+        self.assertIsNone(self.itemStore.set(b'scan0', 0, b'x' * 100))
+        self.assertNotIn(b'scan0', self.itemStore)
+        self.assertEqual(self.itemStore.policy.rejections, 1)
+
+    def testLruLosesTheHotKeysToAScan(self):
+        itemStore = ItemStore(self.itemSize * 20)
+        hotKeys = [b'hot%d' % index for index in range(10)]
+        for key in hotKeys:
+            itemStore.set(key, 0, b'x' * 100)
+            itemStore.get(key)
+        for index in range(200):
+            itemStore.set(b'scan%d' % index, 0, b'x' * 100)
+        self.assertFalse(any(key in itemStore for key in hotKeys))
+
+    def testSegmentsFollowTheItems(self):
+        policy = self.itemStore.policy
+        item = self.itemStore.set(b'capitalOfChina', 0, b'x' * 100)
+        self.itemStore.set(b'biggestOcean', 0, b'x' * 100)
+        self.assertEqual(list(policy.window), [b'biggestOcean'])
+        self.assertEqual(list(policy.probation), [b'capitalOfChina'])
+        self.itemStore.get(b'capitalOfChina')
+        self.assertEqual(list(policy.protected), [b'capitalOfChina'])
+        self.assertEqual(policy.protectedSize, item.size)
+        self.itemStore.delete(b'capitalOfChina')
+        self.itemStore.delete(b'biggestOcean')
+        self.assertEqual((policy.windowSize, policy.protectedSize), (0, 0))
+        self.assertEqual((len(policy.window), len(policy.probation), len(policy.protected)), (0, 0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
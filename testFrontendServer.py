@@ -0,0 +1,104 @@
+import unittest
+import os.path
+import sqlite3
+import tempfile
+import time
+from compression import COMPRESSED_FLAG, ValueCompressor
+from sqlitestorage import keyShard, shardFiles
+
+# The front end server needs flask, which the memcached server doesn't
+try:
+    import frontendserver
+except ModuleNotFoundError as error:
+    if error.name != 'flask':
+        raise
+    frontendserver = None
+
+
+@unittest.skipIf(frontendserver is None, 'flask is not installed')
+class TestFrontendServer(unittest.TestCase):
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.databaseFiles = shardFiles(os.path.join(self.temporaryDirectory.name, 'database.sqlite'), 2)
+        for databaseFile in self.databaseFiles:
+            with sqlite3.connect(databaseFile) as connection:
+                connection.execute(""" CREATE TABLE keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob, exptime integer NOT NULL DEFAULT 0) """)
+            connection.close()
+        frontendserver.app.config['DATABASE_FILES'] = self.databaseFiles
+        self.client = frontendserver.app.test_client()
+
+    def tearDown(self):
+        self.temporaryDirectory.cleanup()
+
+    def insert(self, key, dataBlock, flags=0, exptime=0, length=None):
+        databaseFile = self.databaseFiles[keyShard(key.encode(), len(self.databaseFiles))]
+        with sqlite3.connect(databaseFile) as connection:
+            connection.execute(""" INSERT INTO keysTable VALUES (?, ?, ?, ?, ?) """,
+                               (key, flags, len(dataBlock) if length is None else length, dataBlock, exptime))
+        connection.close()
+
+    def keys(self, **parameters):
+        response = self.client.get('/api/keys', query_string=parameters)
+        self.assertEqual(response.status_code, 200)
+        page = response.get_json()
+        return [key['keyName'] for key in page['keys']], page['next']
+
+    def testKeysArePagedAcrossTheShards(self):
+        keys = ['key%02d' % index for index in range(10)]
+        for key in keys:
+            self.insert(key, b'x')
+        self.insert('expired', b'x', exptime=int(time.time()) - 1)
+        self.assertEqual(self.keys(limit=4), (keys[:4], 'key03'))
+        self.assertEqual(self.keys(limit=4, after='key03'), (keys[4:8], 'key07'))
+        self.assertEqual(self.keys(limit=4, after='key07'), (keys[8:], None))
+
+    def testCursorAtTheLastKey(self):
+        for key in ('capitalOfChina', 'capitalOfJapan'):
+            self.insert(key, b'x')
+        # A page ending exactly on the last key still has a cursor, the page after it is empty
+        self.assertEqual(self.keys(limit=2), (['capitalOfChina', 'capitalOfJapan'], 'capitalOfJapan'))
+        self.assertEqual(self.keys(limit=2, after='capitalOfJapan'), ([], None))
+
+    def testEmptyPage(self):
+        self.assertEqual(self.keys(), ([], None))
+        self.insert('capitalOfChina', b'x')
+        self.assertEqual(self.keys(prefix='biggest'), ([], None))
+
+    def testPrefixEndingWithTheLastCharacters(self):
+        for key in ('caf\xff', 'caf\xff1', 'caf\xff\U0010ffff', 'caf\u0100', 'cag', '\U0010ffff', '\U0010ffffa'):
+            self.insert(key, b'x')
+        self.assertEqual(self.keys(prefix='caf\xff'), (['caf\xff', 'caf\xff1', 'caf\xff\U0010ffff'], None))
+        self.assertEqual(self.keys(prefix='caf\xff\U0010ffff'), (['caf\xff\U0010ffff'], None))
+        self.assertEqual(self.keys(prefix='\U0010ffff'), (['\U0010ffff', '\U0010ffffa'], None))
+
+    def testPrefixEnd(self):
+        self.assertEqual(frontendserver.prefixEnd('capital'), 'capitam')
+        self.assertEqual(frontendserver.prefixEnd('caf\xff'), 'caf\u0100')
+        self.assertEqual(frontendserver.prefixEnd('caf\U0010ffff'), 'cag')
+        self.assertEqual(frontendserver.prefixEnd('\ud7ff'), '\ue000')
+        self.assertIsNone(frontendserver.prefixEnd('\U0010ffff\U0010ffff'))
+        self.assertIsNone(frontendserver.prefixEnd(''))
+
+    def testValue(self):
+        self.insert('capitalOfChina', b'Beijing', flags=14)
+        response = self.client.get('/api/value', query_string={'key': 'capitalOfChina'})
+        self.assertEqual(response.get_json(), {'keyName': 'capitalOfChina', 'flags': 14, 'bytes': 7,
+                                               'value': 'Beijing', 'truncated': False})
+        response = self.client.get('/api/value', query_string={'key': 'capitalOfJapan'})
+        self.assertEqual(response.status_code, 404)
+
+    def testCompressedValue(self):
+        value = b'<li>Beijing</li>' * 5000
+        compressed = ValueCompressor(threshold=100).compress(value)
+        self.insert('capitals', compressed, flags=14 | COMPRESSED_FLAG, length=len(value))
+        self.assertEqual(self.keys(), (['capitals'], None))
+        page = self.client.get('/api/keys').get_json()
+        self.assertEqual(page['keys'][0]['bytes'], len(value))
+        response = self.client.get('/api/value', query_string={'key': 'capitals'})
+        self.assertEqual(response.get_json(), {'keyName': 'capitals', 'flags': 14, 'bytes': len(value),
+                                               'value': value[:frontendserver.MAX_VALUE_PREVIEW].decode(), 'truncated': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import random
+from unittest.mock import patch
+from hotkeys import HotKeys
+
+
+class TestHotKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.hotKeys = HotKeys(size=3, width=256)
+
+    def testHottestKeysAreKept(self):
+        self.hotKeys = HotKeys(size=3)
+        accesses = [b'capitalOfChina'] * 500 + [b'biggestOcean'] * 300 + [b'tallestMountain'] * 200
+        # Many more distinct keys than counters, each accessed a few times
+        accesses += [b'key%d' % index for index in range(2000)] * 2
+        random.Random(7).shuffle(accesses)
+        for key in accesses:
+            self.hotKeys.record(key)
+        hottest = self.hotKeys.hottest()
+        self.assertEqual([key for key, rate in hottest], [b'capitalOfChina', b'biggestOcean', b'tallestMountain'])
+        self.assertEqual(len(self.hotKeys.counts), 3)
+        self.assertEqual(len(self.hotKeys.heap), 3)
+        # Counts only ever overestimate
+        self.assertGreaterEqual(self.hotKeys.counts[b'capitalOfChina'], 500)
+
+    def testSketchHasAFixedSize(self):
+        sizes = [len(counters) for counters in self.hotKeys.rows]
+        for index in range(10000):
+            self.hotKeys.record(b'key%d' % index)
+        self.assertEqual([len(counters) for counters in self.hotKeys.rows], sizes)
+        self.assertEqual(sizes, [256] * HotKeys.DEPTH)
+
+    def testCountsDecay(self):
+        with patch('hotkeys.time.monotonic', return_value=1000):
+            self.hotKeys.reset()
+            for _ in range(100):
+                self.hotKeys.record(b'capitalOfChina')
+            self.assertEqual(self.hotKeys.hottest(), [(b'capitalOfChina', 10.0)])
+        # Two decay intervals later the count was halved twice
+        with patch('hotkeys.time.monotonic', return_value=1025):
+            self.assertEqual(self.hotKeys.hottest(), [(b'capitalOfChina', 25 / 15)])
+            for _ in range(30):
+                self.hotKeys.record(b'biggestOcean')
+            self.assertEqual([key for key, rate in self.hotKeys.hottest()], [b'biggestOcean', b'capitalOfChina'])
+        with patch('hotkeys.time.monotonic', return_value=2000):
+            self.assertEqual(self.hotKeys.hottest(), [])
+
+    def testReset(self):
+        self.hotKeys.record(b'capitalOfChina')
+        self.hotKeys.reset()
+        self.assertEqual(self.hotKeys.hottest(), [])
+        self.assertEqual(sum(sum(counters) for counters in self.hotKeys.rows), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import time
+from itemstore import ItemStore, ItemTooLarge
+from compression import COMPRESSED_FLAG, ValueCompressor
+
+
+class TestItemStore(unittest.TestCase):
+
+    def setUp(self):
+        self.itemStore = ItemStore(64 * 1024)
+
+    def testSetAndGet(self):
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        item = self.itemStore.get(b'capitalOfChina')
+        self.assertEqual(item.flags, 14)
+        self.assertEqual(item.dataBlock, b'Beijing')
+        self.assertEqual(item.header, b'VALUE capitalOfChina 14 7\r\n')
+        self.assertEqual(item.reply(), b'VALUE capitalOfChina 14 7\r\nBeijing\r\n')
+        self.assertEqual(item.dataReply(), b'Beijing\r\n')
+        self.assertEqual(self.itemStore.memoryUsed, self.itemStore.slabs.pageSize + item.headerLength + ItemStore.ITEM_OVERHEAD)
+
+    def testBinaryValue(self):
+        self.itemStore.set(b'pickled', 0, b'\x80\x04\xff\r\n\x00')
+        self.assertEqual(self.itemStore.get(b'pickled').dataBlock, b'\x80\x04\xff\r\n\x00')
+
+    def testGetMissing(self):
+        self.assertEqual(self.itemStore.get(b'capitalOfChina'), None)
+
+    def testSetReplacesValue(self):
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.itemStore.set(b'capitalOfChina', 2, b'Peking')
+        self.assertEqual(len(self.itemStore), 1)
+        self.assertEqual(self.itemStore.get(b'capitalOfChina').dataBlock, b'Peking')
+        self.assertEqual(self.itemStore.memoryUsed, self.itemStore.slabs.pageSize + self.itemStore.itemOverhead +
+                         self.itemStore.get(b'capitalOfChina').headerLength)
+
+    def testDelete(self):
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertTrue(self.itemStore.delete(b'capitalOfChina'))
+        self.assertFalse(self.itemStore.delete(b'capitalOfChina'))
+        self.assertEqual(self.itemStore.memoryUsed, 0)
+
+    def testSetTooLarge(self):
+        with self.assertRaises(ItemTooLarge):
+            self.itemStore.set(b'bigValue', 0, b'x' * 64 * 1024)
+        self.assertEqual(len(self.itemStore), 0)
+
+    def testLeastRecentlyUsedEviction(self):
+        # Values larger than a page are accounted for exactly
+        item = self.itemStore.set(b'key0', 0, b'x' * 2000)
+        self.itemStore.memoryLimit = item.size * 3
+        self.itemStore.set(b'key1', 0, b'x' * 2000)
+        self.itemStore.set(b'key2', 0, b'x' * 2000)
+        self.itemStore.get(b'key0')
+        self.itemStore.set(b'key3', 0, b'x' * 2000)
+        self.assertNotIn(b'key1', self.itemStore)
+        self.assertIn(b'key0', self.itemStore)
+        self.assertIn(b'key2', self.itemStore)
+        self.assertIn(b'key3', self.itemStore)
+        self.assertEqual(self.itemStore.evictions, 1)
+        self.assertLessEqual(self.itemStore.memoryUsed, self.itemStore.memoryLimit)
+
+    def testExpiredItemIsDroppedWhenRead(self):
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing', time.time() - 1)
+        self.itemStore.set(b'biggestOcean', 4, b'Pacific', time.time() + 60)
+        self.assertEqual(self.itemStore.get(b'capitalOfChina'), None)
+        self.assertNotIn(b'capitalOfChina', self.itemStore)
+        self.assertEqual(self.itemStore.get(b'biggestOcean').dataBlock, b'Pacific')
+        self.assertEqual(self.itemStore.expiredItems, 1)
+
+    def testRemoveExpiredInBoundedBatches(self):
+        for i in range(5):
+            self.itemStore.set(b'key' + str(i).encode(), 0, b'x', time.time() - 1)
+        self.itemStore.set(b'biggestOcean', 4, b'Pacific', time.time() + 60)
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertTrue(self.itemStore.removeExpired(3))
+        self.assertEqual(len(self.itemStore), 4)
+        self.assertFalse(self.itemStore.removeExpired(3))
+        self.assertEqual(len(self.itemStore), 2)
+        self.assertEqual(self.itemStore.expiredItems, 5)
+
+    def testRemoveExpiredSkipsReplacedItems(self):
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing', time.time() - 1)
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing', time.time() + 60)
+        self.assertFalse(self.itemStore.removeExpired(10))
+        self.assertIn(b'capitalOfChina', self.itemStore)
+        self.assertEqual(self.itemStore.expiredItems, 0)
+
+    def testExpirationHeapStaysBounded(self):
+        exptime = time.time() + 86400
+        for _ in range(1000):
+            self.itemStore.set(b'capitalOfChina', 14, b'Beijing', exptime)
+            self.itemStore.touch(b'capitalOfChina', exptime)
+        self.assertLessEqual(len(self.itemStore.expirations), 2)
+        for index in range(100):
+            self.itemStore.set(b'key%d' % index, 0, b'x', exptime)
+            self.itemStore.delete(b'key%d' % index)
+        self.assertLessEqual(len(self.itemStore.expirations), 2 * len(self.itemStore) + 1)
+        self.assertEqual(self.itemStore.expiringItems, 1)
+        self.assertEqual(self.itemStore.expirations[0], (exptime, b'capitalOfChina'))
+
+    def testCasUniqueChangesOnEverySet(self):
+        first = self.itemStore.set(b'capitalOfChina', 14, b'Beijing').casUnique
+        second = self.itemStore.set(b'capitalOfChina', 14, b'Beijing').casUnique
+        self.assertNotEqual(first, second)
+        self.assertNotEqual(self.itemStore.set(b'biggestOcean', 4, b'Pacific').casUnique, second)
+
+    def testTouch(self):
+        casUnique = self.itemStore.set(b'capitalOfChina', 14, b'Beijing', time.time() + 60).casUnique
+        self.assertTrue(self.itemStore.touch(b'capitalOfChina', 0))
+        self.assertEqual(self.itemStore.get(b'capitalOfChina').exptime, 0)
+        self.assertEqual(self.itemStore.get(b'capitalOfChina').casUnique, casUnique)
+        self.assertTrue(self.itemStore.touch(b'capitalOfChina', time.time() - 1))
+        self.assertFalse(self.itemStore.removeExpired(10))
+        self.assertNotIn(b'capitalOfChina', self.itemStore)
+        self.assertFalse(self.itemStore.touch(b'capitalOfChina', 0))
+
+
+class TestCompressedItems(unittest.TestCase):
+
+    def setUp(self):
+        self.itemStore = ItemStore(1024 * 1024, ValueCompressor(threshold=100))
+        self.value = b'<li>Beijing</li>' * 100
+
+    def testLargeValuesAreKeptCompressed(self):
+        item = self.itemStore.set(b'capitals', 14, self.value)
+        self.assertLess(len(item.storedBlock), len(self.value))
+        self.assertEqual(item.header, b'VALUE capitals 14 1600\r\n')
+        self.assertEqual(item.length, 1600)
+        self.assertEqual(item.dataBlock, self.value)
+        self.assertEqual(item.dataReply(), self.value + b'\r\n')
+        self.assertLess(item.size, len(self.value))
+        self.assertEqual(item.persistedValue(), (14 | COMPRESSED_FLAG, item.storedBlock))
+        small = self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertEqual(small.persistedValue(), (14, b'Beijing'))
+
+    def testPersistedCompressedValueIsNotCompressedAgain(self):
+        flags, storedBlock = self.itemStore.set(b'capitals', 14, self.value).persistedValue()
+        itemStore = ItemStore(1024 * 1024)
+        item = itemStore.set(b'capitals', flags, storedBlock)
+        self.assertEqual(item.flags, 14)
+        self.assertEqual(item.storedBlock, storedBlock)
+        self.assertEqual(item.header, b'VALUE capitals 14 1600\r\n')
+        # The length comes from the frame of the compressed value
+        self.assertEqual(itemStore.compressor.decompressions, 0)
+        self.assertEqual(item.dataBlock, self.value)
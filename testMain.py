@@ -0,0 +1,170 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import os.path
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+from main import Supervisor, isReady, migrate_keys_table, rebalance_shards
+from sqlitestorage import keyShard, shardFiles
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.connection = sqlite3.connect(os.path.join(self.temporaryDirectory.name, 'database.sqlite'))
+
+    def tearDown(self):
+        self.connection.close()
+        self.temporaryDirectory.cleanup()
+
+    def testMigrateTextDataBlockToBlob(self):
+        self.connection.execute(""" CREATE TABLE keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock text) """)
+        self.connection.execute(""" INSERT INTO keysTable VALUES ('capitalOfChina', 14, 7, 'Beijing') """)
+        self.connection.execute(""" INSERT INTO keysTable VALUES ('capitalOfJapan', 2, 2, '東京') """)
+        self.connection.commit()
+        migrate_keys_table(self.connection)
+        columns = self.connection.execute(""" PRAGMA table_info(keysTable) """).fetchall()
+        self.assertEqual([column[2] for column in columns], ['TEXT', 'INTEGER', 'INTEGER', 'BLOB', 'INTEGER'])
+        rows = self.connection.execute(""" SELECT * FROM keysTable ORDER BY key """).fetchall()
+        self.assertEqual(rows, [('capitalOfChina', 14, 7, b'Beijing', 0), ('capitalOfJapan', 2, 6, '東京'.encode(), 0)])
+
+    def testMigrateAddsExptime(self):
+        self.connection.execute(""" CREATE TABLE keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob) """)
+        self.connection.execute(""" INSERT INTO keysTable VALUES ('pickled', 0, 2, X'80FF') """)
+        self.connection.commit()
+        migrate_keys_table(self.connection)
+        rows = self.connection.execute(""" SELECT * FROM keysTable """).fetchall()
+        self.assertEqual(rows, [('pickled', 0, 2, b'\x80\xff', 0)])
+
+    def testMigrateCurrentTableIsNoop(self):
+        self.connection.execute(""" CREATE TABLE keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob, exptime integer NOT NULL DEFAULT 0) """)
+        self.connection.execute(""" INSERT INTO keysTable VALUES ('pickled', 0, 2, X'80FF', 1700000000) """)
+        self.connection.commit()
+        migrate_keys_table(self.connection)
+        rows = self.connection.execute(""" SELECT * FROM keysTable """).fetchall()
+        self.assertEqual(rows, [('pickled', 0, 2, b'\x80\xff', 1700000000)])
+
+
+    def testRebalanceShards(self):
+        databaseFile = os.path.join(self.temporaryDirectory.name, 'database.sqlite')
+        keys = ['key%d' % index for index in range(50)]
+        self.connection.execute(""" CREATE TABLE keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob, exptime integer NOT NULL DEFAULT 0) """)
+        self.connection.executemany(""" INSERT INTO keysTable VALUES (?, 0, 1, X'00', 0) """, [(key,) for key in keys])
+        self.connection.commit()
+        for shardCount in (3, 2, 1):
+            for shardFile in shardFiles(databaseFile, shardCount)[1:]:
+                connection = sqlite3.connect(shardFile)
+                connection.execute(""" CREATE TABLE IF NOT EXISTS keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob, exptime integer NOT NULL DEFAULT 0) """)
+                connection.close()
+            rebalance_shards(databaseFile, shardCount)
+            for shardIndex, shardFile in enumerate(shardFiles(databaseFile, shardCount)):
+                connection = sqlite3.connect(shardFile)
+                shardKeys = sorted(row[0] for row in connection.execute(""" SELECT key FROM keysTable """))
+                connection.close()
+                self.assertEqual(shardKeys, sorted(key for key in keys if keyShard(key.encode(), shardCount) == shardIndex))
+            self.assertEqual(self.connection.execute(""" PRAGMA user_version """).fetchone()[0], shardCount)
+        self.assertFalse(os.path.exists(shardFiles(databaseFile, 3)[2]))
+
+    def testRebalanceShardsRemovesTheWalFiles(self):
+        databaseFile = os.path.join(self.temporaryDirectory.name, 'database.sqlite')
+        self.connection.execute(""" PRAGMA user_version = 2 """)
+        files = shardFiles(databaseFile, 2)
+        keys = [key for key in ('key%d' % index for index in range(50)) if keyShard(key.encode(), 2) == 1]
+        for shardFile in files:
+            connection = sqlite3.connect(shardFile)
+            connection.execute(""" CREATE TABLE IF NOT EXISTS keysTable (key text PRIMARY KEY, flags integer NOT NULL, bytes integer, dataBlock blob, exptime integer NOT NULL DEFAULT 0) """)
+            connection.close()
+        # The rows of the second shard are still in its -wal file, which isn't removed when the shard is closed
+        # while another connection like the front end server's has it open
+        connection = sqlite3.connect(files[1])
+        connection.execute(""" PRAGMA journal_mode=WAL """)
+        connection.execute(""" PRAGMA wal_autocheckpoint=0 """)
+        with connection:
+            connection.executemany(""" INSERT INTO keysTable VALUES (?, 0, 1, X'00', 0) """, [(key,) for key in keys])
+        try:
+            rebalance_shards(databaseFile, 1)
+            for path in (files[1], files[1] + '-wal', files[1] + '-shm'):
+                self.assertFalse(os.path.exists(path))
+        finally:
+            connection.close()
+        self.assertEqual(sorted(row[0] for row in self.connection.execute(""" SELECT key FROM keysTable """)), sorted(keys))
+
+
+class TestSupervisor(unittest.TestCase):
+
+    SLEEPING_CHILD = (sys.executable, '-c', 'import time; time.sleep(60)')
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.readyFile = os.path.join(self.temporaryDirectory.name, 'ready')
+        self.supervisor = Supervisor({'memcached-0': self.SLEEPING_CHILD}, self.temporaryDirectory.name,
+                                     self.readyFile, readyCheck=MagicMock(return_value=True))
+
+    def tearDown(self):
+        self.supervisor.stop()
+        self.temporaryDirectory.cleanup()
+
+    def testRestartDelayBacksOff(self):
+        self.assertEqual(self.supervisor.restartDelay('memcached-0'), 1)
+        self.supervisor.failures['memcached-0'] = 3
+        self.assertEqual(self.supervisor.restartDelay('memcached-0'), 8)
+        self.supervisor.failures['memcached-0'] = 10
+        self.assertEqual(self.supervisor.restartDelay('memcached-0'), Supervisor.MAX_RESTART_DELAY)
+
+    def testReadyFile(self):
+        self.supervisor.checkReady()
+        self.assertFalse(os.path.exists(self.readyFile))
+        self.supervisor.start('memcached-0')
+        self.supervisor.checkReady()
+        self.assertTrue(os.path.exists(self.readyFile))
+        self.assertEqual(self.supervisor.waitTimeout(), None)
+
+    def testCrashedChildIsRestarted(self):
+        self.supervisor.start('memcached-0')
+        self.supervisor.checkReady()
+        self.supervisor.processes['memcached-0'].kill()
+        self.supervisor.processes['memcached-0'].wait()
+        self.supervisor.reapChildren()
+        self.assertNotIn('memcached-0', self.supervisor.processes)
+        self.assertFalse(os.path.exists(self.readyFile))
+        self.assertEqual(self.supervisor.failures['memcached-0'], 1)
+        self.assertLessEqual(self.supervisor.waitTimeout(), Supervisor.RESTART_DELAY)
+
+        self.supervisor.restarts['memcached-0'] = 0
+        self.supervisor.restartDueChildren()
+        self.assertIsNone(self.supervisor.processes['memcached-0'].poll())
+
+    def testRunStopsChildrenOnSigterm(self):
+        # The signal is sent to this thread once the child is serving, run receives it with sigtimedwait
+        mainThread = threading.get_ident()
+        self.supervisor.readyCheck = lambda: signal.pthread_kill(mainThread, signal.SIGTERM) or True
+        process = MagicMock()
+        with patch('subprocess.Popen', MagicMock(return_value=process)):
+            process.poll.return_value = None
+            self.supervisor.run()
+        process.send_signal.assert_called_with(signal.SIGTERM)
+        self.assertEqual(self.supervisor.processes, {})
+        self.assertFalse(os.path.exists(self.readyFile))
+
+    def testIsReady(self):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+
+        def answer():
+            connection, address = listener.accept()
+            connection.recv(1024)
+            connection.sendall(b'END\r\n')
+            connection.close()
+
+        thread = threading.Thread(target=answer)
+        thread.start()
+        self.assertTrue(isReady('127.0.0.1', port))
+        thread.join()
+        listener.close()
+        self.assertFalse(isReady('127.0.0.1', port))
@@ -0,0 +1,160 @@
+import unittest
+import asyncio
+import threading
+from memcachedclient import AsyncClient, Client, HashRing, MemcachedClientError, encodeKey, parseValues
+from memcachedserver import MemcachedServer
+from itemstore import ItemStore
+
+
+class TestHashRing(unittest.TestCase):
+
+    def testKeysAreSpreadOverTheNodes(self):
+        ring = HashRing(['10.0.0.1:11211', '10.0.0.2:11211', '10.0.0.3:11211'])
+        counts = {}
+        for index in range(3000):
+            node = ring.node(b'key%d' % index)
+            counts[node] = counts.get(node, 0) + 1
+        self.assertEqual(len(counts), 3)
+        self.assertTrue(all(600 < count < 1400 for count in counts.values()), counts)
+
+    def testAddingANodeOnlyMovesItsShare(self):
+        nodes = ['10.0.0.%d:11211' % index for index in range(1, 5)]
+        ring = HashRing(nodes)
+        keys = [b'key%d' % index for index in range(4000)]
+        before = [ring.node(key) for key in keys]
+        ring.add('10.0.0.5:11211')
+        after = [ring.node(key) for key in keys]
+        moved = [(old, new) for old, new in zip(before, after) if old != new]
+        self.assertTrue(all(new == '10.0.0.5:11211' for old, new in moved))
+        self.assertLess(len(moved) / len(keys), 0.3)
+        ring.remove('10.0.0.5:11211')
+        self.assertEqual([ring.node(key) for key in keys], before)
+
+    def testEmptyRing(self):
+        with self.assertRaises(MemcachedClientError):
+            HashRing().node(b'key')
+
+
+class TestProtocolHelpers(unittest.TestCase):
+
+    def testEncodeKey(self):
+        self.assertEqual(encodeKey('capitalOfChina'), b'capitalOfChina')
+        for key in ('', 'capital of China', 'k' * 251, b'line\r\nbreak'):
+            with self.assertRaises(ValueError):
+                encodeKey(key)
+
+    def testParseValues(self):
+        reply = b'VALUE capitalOfChina 2 9 12\r\nBei\r\njing\r\nVALUE biggestOcean 0 7 13\r\nPacific\r\nEND\r\n'
+        self.assertEqual(parseValues(reply), {b'capitalOfChina': (2, b'Bei\r\njing', 12), b'biggestOcean': (0, b'Pacific', 13)})
+        with self.assertRaises(MemcachedClientError):
+            parseValues(b'SERVER_ERROR error retrieving stored data\r\n')
+
+
+class ServerNodes:
+    """In memory memcached servers on ephemeral ports, served by an event loop thread"""
+    def __init__(self, count):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.itemStores = [ItemStore(1024 * 1024) for index in range(count)]
+        self.servers = [asyncio.run_coroutine_threadsafe(self.startServer(itemStore), self.loop).result() for itemStore in self.itemStores]
+        self.addresses = ['127.0.0.1:%d' % server.sockets[0].getsockname()[1] for server in self.servers]
+
+    async def startServer(self, itemStore):
+        return await self.loop.create_server(lambda: MemcachedServer(None, itemStore), '127.0.0.1', 0)
+
+    def close(self):
+        for server in self.servers:
+            self.loop.call_soon_threadsafe(server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+class TestClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nodes = ServerNodes(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.nodes.close()
+
+    def setUp(self):
+        self.client = Client(self.nodes.addresses, poolSize=2)
+
+    def tearDown(self):
+        self.client.close()
+
+    def testStorageCommands(self):
+        self.assertTrue(self.client.set('capitalOfChina', 'Beijing', flags=2))
+        self.assertEqual(self.client.get('capitalOfChina'), b'Beijing')
+        self.assertFalse(self.client.add('capitalOfChina', 'Peking'))
+        self.assertTrue(self.client.append('capitalOfChina', '!'))
+        value, casUnique = self.client.gets('capitalOfChina')
+        self.assertEqual(value, b'Beijing!')
+        self.assertFalse(self.client.cas('capitalOfChina', 'Peking', casUnique + 1))
+        self.assertTrue(self.client.cas('capitalOfChina', 'Peking', casUnique))
+        self.assertTrue(self.client.delete('capitalOfChina'))
+        self.assertFalse(self.client.delete('capitalOfChina'))
+        self.assertEqual(self.client.get('capitalOfChina'), None)
+
+    def testCounters(self):
+        self.assertEqual(self.client.incr('counter'), None)
+        self.client.set('counter', '41')
+        self.assertEqual(self.client.incr('counter'), 42)
+        self.assertEqual(self.client.decr('counter', 50), 0)
+        self.assertTrue(self.client.touch('counter', 60))
+        self.client.set('capitalOfChina', 'Beijing')
+        with self.assertRaises(MemcachedClientError):
+            self.client.incr('capitalOfChina')
+
+    def testManyKeysAreSpreadAndBatched(self):
+        values = {'key%d' % index: b'value%d' % index for index in range(500)}
+        self.assertEqual(self.client.setMany(values), [])
+        self.assertTrue(all(len(itemStore) > 100 for itemStore in self.nodes.itemStores))
+        # 500 keys don't fit in one get line, they're split in several pipelined lines
+        self.assertEqual(self.client.getMany(list(values) + ['missing']), values)
+        self.assertEqual(self.client.deleteMany(values), 500)
+        self.assertEqual(self.client.getMany(values), {})
+
+    def testConnectionsAreReused(self):
+        for index in range(10):
+            self.client.get('capitalOfChina')
+        self.assertTrue(all(len(pool.idle) <= 1 for pool in self.client.pools.values()))
+
+
+class TestAsyncClient(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.itemStores = [ItemStore(1024 * 1024), ItemStore(1024 * 1024)]
+        loop = asyncio.get_running_loop()
+        self.servers = [await loop.create_server(lambda itemStore=itemStore: MemcachedServer(None, itemStore), '127.0.0.1', 0)
+                        for itemStore in self.itemStores]
+        self.client = AsyncClient([('127.0.0.1', server.sockets[0].getsockname()[1]) for server in self.servers], poolSize=2)
+
+    async def asyncTearDown(self):
+        self.client.close()
+        for server in self.servers:
+            server.close()
+
+    async def testCommands(self):
+        self.assertTrue(await self.client.set('capitalOfChina', 'Beijing'))
+        self.assertEqual(await self.client.get('capitalOfChina'), b'Beijing')
+        self.assertTrue(await self.client.replace('capitalOfChina', 'Peking'))
+        self.assertEqual((await self.client.gets('capitalOfChina'))[0], b'Peking')
+        self.assertTrue(await self.client.delete('capitalOfChina'))
+        self.assertEqual(await self.client.incr('counter'), None)
+
+    async def testConcurrentManyKeys(self):
+        values = {b'key%d' % index: b'value%d' % index for index in range(200)}
+        self.assertEqual(await self.client.setMany(values), [])
+        results = await asyncio.gather(*(self.client.getMany(values) for index in range(5)))
+        self.assertEqual(results, [values] * 5)
+        self.assertTrue(all(len(pool.idle) <= 2 for pool in self.client.pools.values()))
+        self.assertEqual(await self.client.deleteMany(values), 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
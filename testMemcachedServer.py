@@ -1,11 +1,16 @@
 import unittest
-from unittest.mock import MagicMock, call
-from memcachedserver import MemcachedServer
+from unittest.mock import AsyncMock, MagicMock, call, patch
+from memcachedserver import MemcachedServer, drainConnections
+from itemstore import Item, ItemStore
+from compression import COMPRESSED_FLAG, ValueCompressor
+from workerpeers import WorkerPeers
+from testBinaryProtocol import requestPacket
+import binaryprotocol
 import asyncio
-import sqlite3
+import time
 
 
-class TestMemcachedServer(unittest.TestCase):
+class TestMemcachedServer(unittest.IsolatedAsyncioTestCase):
 
     # Static variables for response strings
     CLIENT_ERROR_FORMATTING_SET = b'CLIENT_ERROR incorrect # of arguments for set command\r\n'
@@ -23,6 +28,7 @@ class TestMemcachedServer(unittest.TestCase):
     SERVER_ERROR_SET_FAILURE = b'SERVER_ERROR error storing data\r\n'
     SERVER_ERROR_GET_FAILURE = b'SERVER_ERROR error retrieving stored data\r\n'
     SERVER_ERROR_DELETE_FAILURE = b'SERVER_ERROR error deleting stored data\r\n'
+    SERVER_ERROR_OBJECT_TOO_LARGE = b'SERVER_ERROR object too large for cache\r\n'
 
     SET_SUCCESS = b'STORED\r\n'
     DELETE_SUCCESS = b'DELETED\r\n'
@@ -31,39 +37,33 @@ class TestMemcachedServer(unittest.TestCase):
 
     END = b'END\r\n'
 
-    INSERT_OR_REPLACE_SQL_QUERY = """ INSERT OR REPLACE INTO keysTable(key, flags, bytes, dataBlock) VALUES (?, ?, ?, ?) """
-    DELETE_SQL_QUERY = """ DELETE FROM keysTable WHERE key=? """
-
     TIMEOUT = 60
+    NOW = int(time.time())
 
     def setUp(self):
         self.memCachedServer = MemcachedServer(None)
         self.memCachedServer.transport = lambda: None
-        self.memCachedServer.timeout_handle = lambda: None
-        self.memCachedServer.sqliteConnection = lambda: None
+        self.memCachedServer.timeout_handle = MagicMock()
+        self.memCachedServer.storage = lambda: None
+        # The fake transports send everything right away on every Python version
+        self.memCachedServer.TRANSPORT_KEEPS_VIEWS = False
 
     def testInit(self):
         runningLoop = lambda: None
         runningLoop.call_later = MagicMock(return_value='timeoutHandle')
-        asyncio.get_running_loop = MagicMock(return_value=runningLoop)
-        memCachedInstance = MemcachedServer('databasePath')
-        self.assertEqual(memCachedInstance.databaseFile, 'databasePath')
+        with patch('asyncio.get_running_loop', MagicMock(return_value=runningLoop)):
+            memCachedInstance = MemcachedServer('storage')
+            asyncio.get_running_loop.assert_called()
+        self.assertEqual(memCachedInstance.storage, 'storage')
         self.assertEqual(memCachedInstance.expectingDataBlock, None)
         self.assertEqual(memCachedInstance.timeout_handle, 'timeoutHandle')
-        asyncio.get_running_loop.assert_called()
         runningLoop.call_later.assert_called_with(self.TIMEOUT, memCachedInstance._timeout)
 
-    def testSqliteConnection(self):
-        sqlite3.connect = MagicMock(return_value='databaseConnection')
-        databaseConnection = self.memCachedServer.create_sqlite_connection()
-        self.assertEqual(databaseConnection, 'databaseConnection')
-        sqlite3.connect.assert_called_with(None)
-
     def testConnectionMade(self):
-        self.memCachedServer.create_sqlite_connection = MagicMock()
-        self.memCachedServer.connection_made('TransportParameter')
-        self.assertEqual('TransportParameter', self.memCachedServer.transport)
-        self.memCachedServer.create_sqlite_connection.assert_called()
+        transport = MagicMock()
+        self.memCachedServer.connection_made(transport)
+        self.assertEqual(transport, self.memCachedServer.transport)
+        transport.set_write_buffer_limits.assert_called_with(MemcachedServer.WRITE_BUFFER_HIGH, MemcachedServer.WRITE_BUFFER_LOW)
 
     def testConnectionLost(self):
         self.memCachedServer.transport.close = MagicMock()
@@ -73,12 +73,179 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.transport.close.assert_called()
 
     def testDataReceived(self):
-        self.memCachedServer.timeout_handle.cancel = MagicMock()
+        self.memCachedServer.lastActivity = 0
         self.memCachedServer.handleReceivedData = MagicMock()
         self.memCachedServer.data_received('Data')
-        self.memCachedServer.timeout_handle.cancel.assert_called()
+        self.assertGreater(self.memCachedServer.lastActivity, 0)
+        self.memCachedServer.timeout_handle.cancel.assert_not_called()
         self.memCachedServer.handleReceivedData.assert_called_with('Data')
 
+    async def testIdleTimeoutIsResetByActivity(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.idleTimeout = 0.05
+        self.memCachedServer.lastActivity = time.monotonic()
+        self.memCachedServer._timeout()
+        self.memCachedServer.transport.close.assert_not_called()
+        await asyncio.sleep(0.03)
+        self.memCachedServer.data_received(b'get capitalOfChina\r\n')
+        await asyncio.sleep(0.03)
+        self.memCachedServer.transport.close.assert_not_called()
+        await asyncio.sleep(0.05)
+        self.memCachedServer.transport.close.assert_called()
+
+    async def testIdleTimeoutWaitsForPendingCommand(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.idleTimeout = 0.01
+        self.memCachedServer.lastActivity = 0
+        self.memCachedServer.waitFor(asyncio.sleep(60))
+        self.memCachedServer._timeout()
+        self.memCachedServer.transport.close.assert_not_called()
+        self.memCachedServer.timeout_handle.cancel()
+        self.memCachedServer.pendingTask.cancel()
+
+    def testMaxConnections(self):
+        self.memCachedServer.maxConnections = 1
+        self.memCachedServer.connection_made(MagicMock())
+        rejected = MemcachedServer(None, stats=self.memCachedServer.stats, maxConnections=1)
+        transport = MagicMock()
+        rejected.connection_made(transport)
+        transport.write.assert_called_with(b'SERVER_ERROR too many open connections\r\n')
+        transport.close.assert_called()
+        rejected.connection_lost(None)
+        self.assertEqual(self.memCachedServer.stats.currConnections, 1)
+        self.assertEqual(self.memCachedServer.stats.rejectedConnections, 1)
+
+    def testPeerConnectionsAreNotClientConnections(self):
+        self.memCachedServer.maxConnections = 1
+        self.memCachedServer.connection_made(MagicMock())
+        peer = MemcachedServer(None, stats=self.memCachedServer.stats, idleTimeout=0, isPeer=True)
+        transport = MagicMock()
+        peer.connection_made(transport)
+        transport.close.assert_not_called()
+        self.assertEqual(peer.timeout_handle, None)
+        self.assertEqual((self.memCachedServer.stats.currConnections, self.memCachedServer.stats.totalConnections), (1, 1))
+        peer.connection_lost(None)
+        self.assertEqual(self.memCachedServer.stats.currConnections, 1)
+
+    def testWriteBackpressure(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.pause_writing()
+        self.memCachedServer.transport.pause_reading.assert_called_once()
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 2 0 7\r\nBeijing\r\nget capitalOfChina\r\n')
+        self.memCachedServer.transport.write.assert_not_called()
+        self.memCachedServer.resume_writing()
+        self.memCachedServer.transport.resume_reading.assert_called_once()
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+        self.memCachedServer.transport.writelines.assert_called_once()
+        self.assertEqual(self.memCachedServer.receiveBuffer, bytearray())
+
+    async def testReceiveBufferIsBoundedWhileWaiting(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={})
+        self.memCachedServer.MAX_RECEIVE_BUFFER = 100
+        self.memCachedServer.handleReceivedData(b'get biggestOcean\r\n' + b'get capitalOfChina\r\n' * 10)
+        self.memCachedServer.transport.pause_reading.assert_called_once()
+        await self.memCachedServer.pendingTask
+        while self.memCachedServer.pendingTask is not None:
+            await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.resume_reading.assert_called_once()
+
+    def testLargeDataBlockIsStreamed(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport = MagicMock()
+        value = bytes(range(256)) * 1024
+        data = b'set pickled 0 0 262144\r\n' + value + b'\r\nget missing\r\n'
+        for start in range(0, len(data), 10000):
+            self.memCachedServer.handleReceivedData(data[start:start + 10000])
+            # The receive buffer never holds more than the last chunk
+            self.assertLessEqual(len(self.memCachedServer.receiveBuffer), 10000)
+        item = self.memCachedServer.itemStore.get(b'pickled')
+        self.assertEqual(item.dataBlock, value)
+        self.assertEqual(item.reply(), b'VALUE pickled 0 262144\r\n' + value + b'\r\n')
+        self.assertEqual(self.memCachedServer.transport.mock_calls, [call.write(self.SET_SUCCESS), call.writelines([self.END])])
+
+    def testStreamedDataBlockMustEndWithCrlf(self):
+        self.memCachedServer.storage = None
+        replies = self.replies(b'set pickled 0 0 100000\r\n' + b'x' * 100002)
+        self.assertEqual(replies, self.CLIENT_ERROR_FORMATTING_SET_DATA_BLOCK)
+        self.assertNotIn(b'pickled', self.memCachedServer.itemStore)
+
+    def testValueLargerThanMaxItemSizeIsSwallowed(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.maxItemSize = 100
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'set large 0 0 101 noreply\r\n' + b'x' * 50)
+        self.memCachedServer.transport.write.assert_called_once_with(self.SERVER_ERROR_OBJECT_TOO_LARGE)
+        self.assertEqual(self.memCachedServer.receiveBuffer, bytearray())
+        self.memCachedServer.handleReceivedData(b'x' * 51 + b'\r\nms large 101 T0\r\n' + b'x' * 101 + b'\r\nset small 0 0 1\r\nx\r\n')
+        self.memCachedServer.transport.write.assert_has_calls([call(self.SERVER_ERROR_OBJECT_TOO_LARGE), call(self.SET_SUCCESS)])
+        self.assertNotIn(b'large', self.memCachedServer.itemStore)
+        self.assertIn(b'small', self.memCachedServer.itemStore)
+
+    def testBinaryValueLargerThanMaxItemSizeIsSwallowed(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.maxItemSize = 100
+        setExtras = binaryprotocol.SET_EXTRAS.pack(0, 0)
+        responses = self.binaryResponses(requestPacket(binaryprotocol.OPCODE_SETQ, b'large', b'x' * 101, setExtras, opaque=1)
+                                         + requestPacket(binaryprotocol.OPCODE_SET, b'small', b'x' * 100, setExtras, opaque=2))
+        self.assertEqual([response[:3] for response in responses], [
+            (binaryprotocol.OPCODE_SETQ, binaryprotocol.STATUS_VALUE_TOO_LARGE, 1), (binaryprotocol.OPCODE_SET, 0, 2)])
+        self.assertNotIn(b'large', self.memCachedServer.itemStore)
+
+    def testLargeReplyIsWrittenInChunks(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport = MagicMock()
+        value = b'x' * (self.memCachedServer.WRITE_CHUNK_SIZE * 3)
+        self.memCachedServer.itemStore.set(b'large', 0, value)
+        # The transport asks to pause writing once it buffered the first chunk
+        self.memCachedServer.transport.write.side_effect = lambda data: self.memCachedServer.pause_writing()
+        self.memCachedServer.handleReceivedData(b'get large\r\nget large\r\n')
+        self.assertEqual(self.memCachedServer.transport.write.call_count, 1)
+        self.memCachedServer.transport.write.side_effect = None
+        self.memCachedServer.resume_writing()
+        written = [bytes(mockCall.args[0]) for mockCall in self.memCachedServer.transport.write.mock_calls]
+        self.assertTrue(all(len(chunk) <= self.memCachedServer.WRITE_CHUNK_SIZE for chunk in written))
+        reply = b'VALUE large 0 %d\r\n' % len(value) + value + b'\r\nEND\r\n'
+        self.assertEqual(b''.join(written), reply * 2)
+        self.assertEqual(len(self.memCachedServer.unsentBuffers), 0)
+
+    def testLargeMultiGetIsProducedAsTheTransportDrains(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport = MagicMock()
+        keys = [b'key%03d' % index for index in range(100)]
+        for key in keys:
+            self.memCachedServer.itemStore.set(key, 0, key * 1000)
+        pause = lambda data: self.memCachedServer.pause_writing()
+        self.memCachedServer.transport.write.side_effect = pause
+        self.memCachedServer.transport.writelines.side_effect = pause
+        with patch.object(Item, 'reply', autospec=True, side_effect=Item.reply) as reply:
+            self.memCachedServer.handleReceivedData(b'get ' + b' '.join(keys) + b'\r\n')
+            # Only the first chunk of the reply was produced before the transport asked to pause
+            self.assertLess(reply.call_count, 20)
+            self.assertLessEqual(self.memCachedServer.stats.bytesWritten, self.memCachedServer.WRITE_CHUNK_SIZE)
+            self.memCachedServer.transport.write.side_effect = None
+            self.memCachedServer.transport.writelines.side_effect = None
+            self.memCachedServer.resume_writing()
+            self.assertEqual(reply.call_count, 100)
+        written = b''.join(b''.join(args[0]) if name == 'writelines' else bytes(args[0])
+                           for name, args, kwargs in self.memCachedServer.transport.mock_calls if name in ('write', 'writelines'))
+        self.assertEqual(written, b''.join(b'VALUE %s 0 6000\r\n%s\r\n' % (key, key * 1000) for key in keys) + self.END)
+        self.assertEqual(len(self.memCachedServer.unsentBuffers), 0)
+
+    def testUnsentReplyIsKeptWhenItsChunkIsReused(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.TRANSPORT_KEEPS_VIEWS = True
+        # The transport keeps the reply it couldn't send as a view of the slab page
+        self.memCachedServer.transport.get_write_buffer_size.return_value = 100
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 2 0 7\r\nBeijing\r\nget capitalOfChina\r\n')
+        unsent = self.memCachedServer.transport.writelines.call_args[0][0][0]
+        self.assertIsInstance(unsent, memoryview)
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 2 0 6\r\nPeking\r\n')
+        self.assertEqual(unsent, b'VALUE capitalOfChina 2 7\r\nBeijing\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'Peking')
+
     def testHandleReceivedDataSetFormattingCorrect(self):
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
         inputMessageCorrect = b'set capitalOfChina 14 2400 16\r\n'
@@ -98,7 +265,7 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.handleReceivedData(inputMessageCorrect)
         self.memCachedServer.setKeyData.assert_not_called()
         self.assertEqual(self.memCachedServer.expectingDataBlock, [b'set', b'capitalOfChina', b'14', b'2400', b'16'])
-        dataBlockCorrect = b'hello world!!!!!'
+        dataBlockCorrect = b'hello world!!!!!\r\n'
         self.memCachedServer.handleReceivedData(dataBlockCorrect)
         self.memCachedServer.setKeyData.assert_called_with(dataBlockCorrect)
 
@@ -125,7 +292,6 @@ class TestMemcachedServer(unittest.TestCase):
             b'set capitalOfChina 14 2400.0 16\r\n',
             b'set capitalOfChina 14 2400 16.0\r\n',
             b'set capitalOfChina -14 2400 16\r\n',
-            b'set capitalOfChina 14 -2400 16\r\n',
             b'set capitalOfChina 14 2400 -16\r\n'
         ]
         self.memCachedServer.transport.write = MagicMock()
@@ -142,14 +308,57 @@ class TestMemcachedServer(unittest.TestCase):
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
         self.memCachedServer.transport.write.assert_called_with(self.CLIENT_ERROR_FORMATTING_SET_FLAGS_VALUE)
 
+    def testHandleReceivedDataPipelinedCommands(self):
+        self.memCachedServer.getKeyData = MagicMock()
+        self.memCachedServer.deleteKeyData = MagicMock()
+        self.memCachedServer.setKeyData = MagicMock(side_effect=lambda dataBlock: setattr(self.memCachedServer, 'expectingDataBlock', None))
+        self.memCachedServer.handleReceivedData(b'get capitalOfChina\r\nset capitalOfChina 14 2400 7\r\nBeijing\r\ndelete capitalOfChina\r\n')
+        self.memCachedServer.getKeyData.assert_called_with([b'get', b'capitalOfChina'])
+        self.memCachedServer.setKeyData.assert_called_with(b'Beijing\r\n')
+        self.memCachedServer.deleteKeyData.assert_called_with([b'delete', b'capitalOfChina'])
+        self.assertEqual(self.memCachedServer.receiveBuffer, bytearray())
+
+    def testHandleReceivedDataFragmentedCommand(self):
+        self.memCachedServer.setKeyData = MagicMock()
+        self.memCachedServer.handleReceivedData(b'set capitalOf')
+        self.assertEqual(self.memCachedServer.expectingDataBlock, None)
+        self.memCachedServer.handleReceivedData(b'China 14 2400 16\r\nthe data')
+        self.assertEqual(self.memCachedServer.expectingDataBlock, [b'set', b'capitalOfChina', b'14', b'2400', b'16'])
+        self.memCachedServer.setKeyData.assert_not_called()
+        self.memCachedServer.handleReceivedData(b' block!!\r')
+        self.memCachedServer.setKeyData.assert_not_called()
+        self.memCachedServer.handleReceivedData(b'\n')
+        self.memCachedServer.setKeyData.assert_called_with(b'the data block!!\r\n')
+
+    def testHandleReceivedDataDataBlockContainingLineBreaks(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 14 2400 9\r\nBei\r\njing\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'Bei\r\njing')
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
+    def testHandleReceivedDataQuitStopsProcessing(self):
+        self.memCachedServer.transport.close = MagicMock()
+        self.memCachedServer.getKeyData = MagicMock()
+        self.memCachedServer.handleReceivedData(b'quit\r\nget capitalOfChina\r\n')
+        self.memCachedServer.transport.close.assert_called()
+        self.memCachedServer.getKeyData.assert_not_called()
+
+    def testHandleReceivedDataLineTooLong(self):
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.transport.close = MagicMock()
+        self.memCachedServer.handleReceivedData(b'get ' + b'a' * 4096)
+        self.memCachedServer.transport.write.assert_called_with(b'CLIENT_ERROR line too long\r\n')
+        self.memCachedServer.transport.close.assert_called()
+
     def testHandleReceivedDataGetFormattingCorrect(self):
-        inputMessageCorrect = b'get capitalOfChina continentOfLatvia hemisphereOfBrasil'
+        inputMessageCorrect = b'get capitalOfChina continentOfLatvia hemisphereOfBrasil\r\n'
         self.memCachedServer.getKeyData = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageCorrect)
         self.memCachedServer.getKeyData.assert_called_with([b'get', b'capitalOfChina', b'continentOfLatvia', b'hemisphereOfBrasil'])
 
     def testHandleReceivedDataGetFormattingFail(self):
-        inputMessageFail = b'get'
+        inputMessageFail = b'get\r\n'
         self.memCachedServer.getKeyData = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageFail)
@@ -157,7 +366,7 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.getKeyData.assert_not_called()
 
     def testHandleReceivedDataDeleteFormattingCorrect(self):
-        inputMessageCorrect = b'delete capitalOfChina'
+        inputMessageCorrect = b'delete capitalOfChina\r\n'
         self.memCachedServer.deleteKeyData = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageCorrect)
@@ -165,7 +374,7 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.deleteKeyData.assert_called_with([b'delete', b'capitalOfChina'])
 
     def testHandleReceivedDataDeleteFormattingCorrectNoReply(self):
-        inputMessageCorrect = b'delete capitalOfChina noreply'
+        inputMessageCorrect = b'delete capitalOfChina noreply\r\n'
         self.memCachedServer.deleteKeyData = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageCorrect)
@@ -173,7 +382,7 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.deleteKeyData.assert_called_with([b'delete', b'capitalOfChina', b'noreply'])
 
     def testHandleReceivedDataDeleteFormattingFail(self):
-        inputMessageFail = b'delete '
+        inputMessageFail = b'delete \r\n'
         self.memCachedServer.deleteKeyData = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageFail)
@@ -181,7 +390,7 @@ class TestMemcachedServer(unittest.TestCase):
         self.memCachedServer.deleteKeyData.assert_not_called()
 
     def testHandleReceivedDataDeleteFormattingFailNoReply(self):
-        inputMessageFailNoReply = b'delete continentOfLatvia norel'
+        inputMessageFailNoReply = b'delete continentOfLatvia norel\r\n'
         self.memCachedServer.deleteKeyData = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
         self.memCachedServer.handleReceivedData(inputMessageFailNoReply)
@@ -190,145 +399,687 @@ class TestMemcachedServer(unittest.TestCase):
 
     def testSetKeyData(self):
         self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
-        self.memCachedServer.setKeyData(b'the data block!!\r\n')
-        sqlQueryValues = ('capitalOfChina', '14', '16', 'the data block!!')
-        cursor.execute.assert_called_with(self.INSERT_OR_REPLACE_SQL_QUERY, sqlQueryValues)
-        self.memCachedServer.sqliteConnection.cursor.assert_called()
-        self.memCachedServer.sqliteConnection.commit.assert_called()
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        with patch('time.time', MagicMock(return_value=self.NOW)):
+            self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        self.memCachedServer.storage.set.assert_called_with(b'capitalOfChina', 14, b'the data block!!', self.NOW + 2400)
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'the data block!!')
         self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
 
+    def testGetKeyDataBinaryValue(self):
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.itemStore.set(b'pickled', 0, b'\x80\x04\xff\r\n\x00')
+        self.memCachedServer.getKeyData([b'get', b'pickled'])
+        self.memCachedServer.transport.writelines.assert_called_once_with([
+            b'VALUE pickled 0 6\r\n\x80\x04\xff\r\n\x00\r\n',
+            b'END\r\n'
+        ])
+
+    def testExpirationTime(self):
+        with patch('time.time', MagicMock(return_value=self.NOW)):
+            self.assertEqual(self.memCachedServer.expirationTime(0), 0)
+            self.assertEqual(self.memCachedServer.expirationTime(-1), -1)
+            self.assertEqual(self.memCachedServer.expirationTime(2400), self.NOW + 2400)
+            self.assertEqual(self.memCachedServer.expirationTime(60 * 60 * 24 * 30), self.NOW + 60 * 60 * 24 * 30)
+            self.assertEqual(self.memCachedServer.expirationTime(self.NOW + 10), self.NOW + 10)
+            self.assertEqual(self.memCachedServer.expirationTime(self.NOW - 10), -1)
+
+    def testHandleReceivedDataSetNegativeExpTime(self):
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 14 -1 7\r\nPeking!\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina'), None)
+        self.memCachedServer.storage.set.assert_not_called()
+        self.memCachedServer.storage.delete.assert_called_with(b'capitalOfChina', checkExists=False)
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
+    def testGetKeyDataExpired(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing', self.NOW)
+        self.memCachedServer.getKeyData([b'get', b'capitalOfChina'])
+        self.memCachedServer.transport.writelines.assert_called_once_with([b'END\r\n'])
+
+    def testSetKeyDataMissingTerminator(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.setKeyData(b'the data block!!!!')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina'), None)
+        self.memCachedServer.transport.write.assert_called_with(self.CLIENT_ERROR_FORMATTING_SET_DATA_BLOCK)
+
+    def testSetKeyDataStoresInMemory(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
+        self.memCachedServer.storage = None
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        item = self.memCachedServer.itemStore.get(b'capitalOfChina')
+        self.assertEqual(item.flags, 14)
+        self.assertEqual(item.dataBlock, b'the data block!!')
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
+    def testSetKeyDataObjectTooLarge(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        self.memCachedServer.itemStore = ItemStore(32)
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina'), None)
+        self.memCachedServer.storage.set.assert_not_called()
+        self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_OBJECT_TOO_LARGE)
+
+    def testSetKeyDataEvictedRightAwayIsPersisted(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'0', b'16']
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        self.memCachedServer.itemStore.set = MagicMock(return_value=None)
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        self.memCachedServer.storage.set.assert_called_once_with(b'capitalOfChina', 14, b'the data block!!', 0)
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
     def testSetKeyDataNoReply(self):
         self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16', b'noreply']
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
-        self.memCachedServer.setKeyData(b'the data block!!\r\n')
-        sqlQueryValues = ('capitalOfChina', '14', '16', 'the data block!!')
-        cursor.execute.assert_called_with(self.INSERT_OR_REPLACE_SQL_QUERY, sqlQueryValues)
-        self.memCachedServer.sqliteConnection.cursor.assert_called()
-        self.memCachedServer.sqliteConnection.commit.assert_called()
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        with patch('time.time', MagicMock(return_value=self.NOW)):
+            self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        self.memCachedServer.storage.set.assert_called_with(b'capitalOfChina', 14, b'the data block!!', self.NOW + 2400)
         self.memCachedServer.transport.write.assert_not_called()
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
 
     def testSetKeyDataStorageError(self):
         self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = lambda x, y: 1/0
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.set = lambda *args: 1/0
         self.memCachedServer.setKeyData(b'the data block!!\r\n')
-        self.memCachedServer.sqliteConnection.commit.assert_not_called()
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina'), None)
         self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_SET_FAILURE)
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
 
     def testSetKeyDataIncorrectDataBlockLength(self):
         self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
         self.memCachedServer.setKeyData(b'the data block\r\n')
-        cursor.execute.assert_not_called()
-        self.memCachedServer.sqliteConnection.cursor.assert_not_called()
-        self.memCachedServer.sqliteConnection.commit.assert_not_called()
+        self.memCachedServer.storage.set.assert_not_called()
         self.memCachedServer.transport.write.assert_called_with(self.CLIENT_ERROR_FORMATTING_SET_DATA_BLOCK)
         self.assertEqual(self.memCachedServer.expectingDataBlock, None)
 
 
-    def testGetKeyData(self):
-        selectQueryString = """ SELECT * FROM keysTable WHERE key IN (?,?,?) """
+    async def testSetKeyDataWaitsForPerWriteDurability(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        cursor.fetchall = MagicMock(return_value=[('manchesterUnited', 1, 7, 'Ronaldo'),('capitalOfChina', 2, 7, 'Beijing'),('biggestOcean', 4, 7, 'Pacific')])
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.set = MagicMock(return_value=self.storageResult(True))
+        self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        self.memCachedServer.transport.write.assert_not_called()
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
+    async def testSetKeyDataPerWriteDurabilityStorageError(self):
+        self.memCachedServer.expectingDataBlock = [b'set', b'capitalOfChina', b'14', b'2400', b'16']
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.storage.set = MagicMock(return_value=self.storageError())
+        self.memCachedServer.setKeyData(b'the data block!!\r\n')
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_SET_FAILURE)
+
+    async def testGetKeyData(self):
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={
+            b'manchesterUnited': (1, b'Ronaldo', 0),
+            b'capitalOfChina': (2, b'Beijing', 0),
+            b'biggestOcean': (4, b'Pacific', 0)
+        })
         self.memCachedServer.getKeyData([b'get', b'manchesterUnited', b'capitalOfChina', b'biggestOcean'])
-        sqlQueryValues = ('manchesterUnited', 'capitalOfChina', 'biggestOcean')
-        self.memCachedServer.sqliteConnection.cursor.assert_called()
-        cursor.execute.assert_called_with(selectQueryString, sqlQueryValues)
-        cursor.fetchall.assert_called()
-        writeCalls = [
-            call(b'VALUE manchesterUnited 1 7\r\n'),
-            call(b'Ronaldo\r\n'),
-            call(b'VALUE capitalOfChina 2 7\r\n'),
-            call(b'Beijing\r\n'),
-            call(b'VALUE biggestOcean 4 7\r\n'),
-            call(b'Pacific\r\n'),
-            call(b'END\r\n')
-        ]
-        self.assertEqual(self.memCachedServer.transport.write.mock_calls, writeCalls)
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.get_many.assert_called_with([b'manchesterUnited', b'capitalOfChina', b'biggestOcean'])
+        self.memCachedServer.transport.writelines.assert_called_once_with([
+            b'VALUE manchesterUnited 1 7\r\nRonaldo\r\n',
+            b'VALUE capitalOfChina 2 7\r\nBeijing\r\n',
+            b'VALUE biggestOcean 4 7\r\nPacific\r\n',
+            b'END\r\n'
+        ])
+
+    async def testCompressedValues(self):
+        self.memCachedServer.itemStore = ItemStore(1024 * 1024, ValueCompressor(threshold=100))
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        value = b'<li>Beijing</li>' * 100
+        self.memCachedServer.handleReceivedData(b'set capitals 14 0 1600\r\n' + value + b'\r\n')
+        flags, storedBlock = self.memCachedServer.storage.set.call_args[0][1:3]
+        self.assertEqual(flags, 14 | COMPRESSED_FLAG)
+        self.assertEqual(self.memCachedServer.itemStore.compressor.decompress(storedBlock), value)
+        self.memCachedServer.handleReceivedData(b'append capitals 0 0 1\r\n!\r\n')
+        self.memCachedServer.handleReceivedData(b'get capitals\r\n')
+        self.memCachedServer.transport.writelines.assert_called_with([b'VALUE capitals 14 1601\r\n' + value + b'!\r\n', b'END\r\n'])
+        self.memCachedServer.handleReceivedData(b'mg capitals s v\r\n')
+        self.memCachedServer.transport.write.assert_called_with(b'VA 1601 s1601\r\n' + value + b'!\r\n')
+
+        # Values persisted compressed are read through without being compressed again
+        self.memCachedServer.itemStore = ItemStore(1024 * 1024)
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'capitals': (14 | COMPRESSED_FLAG, storedBlock, 0)})
+        self.memCachedServer.getKeyData([b'get', b'capitals'])
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.writelines.assert_called_with([b'VALUE capitals 14 1600\r\n' + value + b'\r\n', b'END\r\n'])
 
+    async def testRejectedValueIsCompressedOnce(self):
+        self.memCachedServer.itemStore = ItemStore(1024, ValueCompressor(threshold=100))
+        compressor = self.memCachedServer.itemStore.compressor
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        value = b''.join(b'%08x' % (i * 2654435761 % 2 ** 32) for i in range(500))
+        self.memCachedServer.handleReceivedData(b'set capitals 14 0 4000\r\n' + value + b'\r\n')
+        self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_OBJECT_TOO_LARGE)
+        self.assertEqual(compressor.compressedValues, 1)
+
+        # A persisted value too large for the memory is answered from the item built to store it
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'capitals': (14, value, 0)})
+        self.memCachedServer.getKeyData([b'get', b'capitals'])
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.writelines.assert_called_with([b'VALUE capitals 14 4000\r\n' + value + b'\r\n', b'END\r\n'])
+        self.assertEqual(compressor.compressedValues, 2)
+
+    def testGetKeyDataMemoryHit(self):
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock()
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.memCachedServer.getKeyData([b'get', b'capitalOfChina'])
+        self.memCachedServer.storage.get_many.assert_not_called()
+        self.assertEqual(self.memCachedServer.pendingTask, None)
+        self.memCachedServer.transport.writelines.assert_called_once_with([
+            b'VALUE capitalOfChina 2 7\r\nBeijing\r\n',
+            b'END\r\n'
+        ])
 
-    def testGetKeyDataStorageError(self):
+    async def testGetKeyDataReadThroughPopulatesMemory(self):
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'biggestOcean': (4, b'Pacific', 0)})
+        self.memCachedServer.getKeyData([b'get', b'capitalOfChina', b'biggestOcean', b'manchesterUnited'])
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.get_many.assert_called_with([b'biggestOcean', b'manchesterUnited'])
+        self.assertEqual(self.memCachedServer.itemStore.get(b'biggestOcean').dataBlock, b'Pacific')
+        self.memCachedServer.transport.writelines.assert_called_once_with([
+            b'VALUE capitalOfChina 2 7\r\nBeijing\r\n',
+            b'VALUE biggestOcean 4 7\r\nPacific\r\n',
+            b'END\r\n'
+        ])
+
+    async def testGetKeyDataStorageError(self):
         self.memCachedServer.transport.write = MagicMock()
-        cursor = lambda: None
-        cursor.execute = lambda x, y: 1/0
-        cursor.fetchall = MagicMock(return_value=[('manchesterUnited', 1, 7, 'Ronaldo'),('capitalOfChina', 2, 7, 'Beijing'),('biggestOcean', 4, 7, 'Pacific')])
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.get_many = AsyncMock(side_effect=ZeroDivisionError)
         self.memCachedServer.getKeyData([b'get', b'manchesterUnited', b'capitalOfChina', b'biggestOcean'])
-        self.memCachedServer.sqliteConnection.cursor.assert_called()
-        cursor.fetchall.assert_not_called()
+        await self.memCachedServer.pendingTask
         self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_GET_FAILURE)
 
-    def testDeleteKeyDataKeyFound(self):
-        deleteQuery = self.DELETE_SQL_QUERY
+    async def testPipelinedCommandsWaitForStorage(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'biggestOcean': (4, b'Pacific', 0)})
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.memCachedServer.handleReceivedData(b'get biggestOcean\r\ndelete capitalOfChina\r\n')
+        self.memCachedServer.storage.delete.assert_not_called()
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.delete.assert_called_with(b'capitalOfChina', checkExists=False)
+        replies = [
+            call.writelines([b'VALUE biggestOcean 4 7\r\nPacific\r\n', b'END\r\n']),
+            call.write(self.DELETE_SUCCESS)
+        ]
+        self.assertEqual(self.memCachedServer.transport.mock_calls, replies)
+
+    async def testDeleteKeyDataKeyFound(self):
         self.memCachedServer.transport.write = MagicMock()
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        cursor.rowcount = 1
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.delete = MagicMock(return_value=self.storageResult(True))
         self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited'])
-        sqlQueryValue = ('manchesterUnited',)
-        cursor.execute.assert_called_with(deleteQuery, sqlQueryValue)
-        self.memCachedServer.sqliteConnection.commit.assert_called()
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.delete.assert_called_with(b'manchesterUnited', checkExists=True)
         self.memCachedServer.transport.write.assert_called_with(self.DELETE_SUCCESS)
 
-    def testDeleteKeyDataKeyNotFound(self):
-        deleteQuery = self.DELETE_SQL_QUERY
+    async def testDeleteKeyDataKeyNotFound(self):
         self.memCachedServer.transport.write = MagicMock()
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        cursor.rowcount = 0
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.delete = MagicMock(return_value=self.storageResult(False))
         self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited'])
-        sqlQueryValue = ('manchesterUnited',)
-        cursor.execute.assert_called_with(deleteQuery, sqlQueryValue)
-        self.memCachedServer.sqliteConnection.commit.assert_called()
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.delete.assert_called_with(b'manchesterUnited', checkExists=True)
         self.memCachedServer.transport.write.assert_called_with(self.DELETE_NOT_FOUND)
 
     def testDeleteKeyDataNoReply(self):
-        deleteQuery = self.DELETE_SQL_QUERY
         self.memCachedServer.transport.write = MagicMock()
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
-        cursor = lambda: None
-        cursor.execute = MagicMock()
-        cursor.rowcount = 0
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
         self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited', b'noreply'])
-        sqlQueryValue = ('manchesterUnited',)
-        cursor.execute.assert_called_with(deleteQuery, sqlQueryValue)
-        self.memCachedServer.sqliteConnection.commit.assert_called()
+        self.memCachedServer.storage.delete.assert_called_with(b'manchesterUnited', checkExists=False)
+        self.assertEqual(self.memCachedServer.pendingTask, None)
         self.memCachedServer.transport.write.assert_not_called()
 
+    def testDeleteKeyDataKeyFoundInMemory(self):
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
+        self.memCachedServer.itemStore.set(b'manchesterUnited', 1, b'Ronaldo')
+        self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited'])
+        self.memCachedServer.storage.delete.assert_called_with(b'manchesterUnited', checkExists=False)
+        self.assertEqual(self.memCachedServer.itemStore.get(b'manchesterUnited'), None)
+        self.memCachedServer.transport.write.assert_called_with(self.DELETE_SUCCESS)
+
     def testDeleteKeyStorageError(self):
         self.memCachedServer.transport.write = MagicMock()
-        self.memCachedServer.sqliteConnection.commit = MagicMock()
-        cursor = lambda: None
-        cursor.execute = lambda x, y: 1/0
-        self.memCachedServer.sqliteConnection.cursor = MagicMock(return_value=cursor)
+        self.memCachedServer.storage.delete = lambda x, checkExists: 1/0
         self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited', b'noreply'])
-        self.memCachedServer.sqliteConnection.cursor.assert_called()
-        self.memCachedServer.sqliteConnection.commit.assert_not_called()
         self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_DELETE_FAILURE)
+
+    async def testDeleteKeyStorageErrorWhileWaiting(self):
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.storage.delete = MagicMock(return_value=self.storageError())
+        self.memCachedServer.deleteKeyData([b'delete', b'manchesterUnited'])
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_DELETE_FAILURE)
+
+    def testConnectionsAreTracked(self):
+        connections = set()
+        self.memCachedServer.connections = connections
+        self.memCachedServer.connection_made(MagicMock())
+        self.assertEqual(connections, {self.memCachedServer})
+        self.memCachedServer.connection_lost(None)
+        self.assertEqual(connections, set())
+
+    async def testDrainAnswersBufferedCommandsBeforeClosing(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'biggestOcean': (4, b'Pacific', 0)})
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.memCachedServer.handleReceivedData(b'get biggestOcean\r\ndelete capitalOfChina\r\n')
+        await drainConnections({self.memCachedServer}, 1)
+        replies = [
+            call.pause_reading(),
+            call.writelines([b'VALUE biggestOcean 4 7\r\nPacific\r\n', b'END\r\n']),
+            call.write(self.DELETE_SUCCESS),
+            call.close()
+        ]
+        self.assertEqual(self.memCachedServer.transport.mock_calls[:4], replies)
+
+    async def testDrainTimeoutClosesConnection(self):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.waitFor(asyncio.sleep(60))
+        await drainConnections({self.memCachedServer}, 0.01)
+        self.memCachedServer.transport.close.assert_called()
+        self.memCachedServer.pendingTask.cancel()
+
+    def replies(self, data):
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(data)
+        return b''.join(
+            b''.join(bytes(buffer) for buffer in mockCall.args[0]) if mockCall[0] == 'writelines' else mockCall.args[0]
+            for mockCall in self.memCachedServer.transport.mock_calls
+        )
+
+    def testAddAndReplace(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'replace capitalOfChina 2 0 7\r\nBeijing\r\n'), b'NOT_STORED\r\n')
+        self.assertEqual(self.replies(b'add capitalOfChina 2 0 7\r\nBeijing\r\n'), self.SET_SUCCESS)
+        self.assertEqual(self.replies(b'add capitalOfChina 2 0 6\r\nPeking\r\n'), b'NOT_STORED\r\n')
+        self.assertEqual(self.replies(b'replace capitalOfChina 3 0 6\r\nPeking\r\n'), self.SET_SUCCESS)
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'Peking')
+
+    def testAppendAndPrepend(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'append capitalOfChina 0 0 3\r\nxyz\r\n'), b'NOT_STORED\r\n')
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.assertEqual(self.replies(b'append capitalOfChina 5 0 1\r\n!\r\nprepend capitalOfChina 5 0 3\r\n>> \r\n'),
+                         self.SET_SUCCESS + self.SET_SUCCESS)
+        item = self.memCachedServer.itemStore.get(b'capitalOfChina')
+        self.assertEqual((item.flags, item.dataBlock), (2, b'>> Beijing!'))
+
+    def testGetsAndCas(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 7 1\r\nBeijing\r\n'), b'NOT_FOUND\r\n')
+        casUnique = self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing').casUnique
+        self.assertEqual(self.replies(b'gets capitalOfChina\r\n'),
+                         b'VALUE capitalOfChina 2 7 ' + str(casUnique).encode() + b'\r\nBeijing\r\nEND\r\n')
+        # The values of a gets reply are views of their chunks
+        items = {b'capitalOfChina': self.memCachedServer.itemStore.peek(b'capitalOfChina')}
+        buffers = list(self.memCachedServer.itemBuffers([b'capitalOfChina'], items, True))
+        self.assertIsInstance(buffers[1], memoryview)
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 6 ' + str(casUnique + 1).encode() + b'\r\nPeking\r\n'), b'EXISTS\r\n')
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 6 ' + str(casUnique).encode() + b'\r\nPeking\r\n'), self.SET_SUCCESS)
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 6 ' + str(casUnique).encode() + b' noreply\r\nNanjin\r\n'), b'')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'Peking')
+
+    def testStorageCommandFormatting(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'add capitalOfChina 2 0\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 7\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        self.assertEqual(self.replies(b'cas capitalOfChina 2 0 7 abc\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        self.assertEqual(self.replies(b'incr counter\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        self.assertEqual(self.replies(b'incr counter -1\r\n'), b'CLIENT_ERROR invalid numeric delta argument\r\n')
+        self.assertEqual(self.replies(b'touch counter soon\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        self.assertEqual(self.replies(b'gat capitalOfChina\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+
+    def testIncrAndDecr(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'incr counter 1\r\n'), b'NOT_FOUND\r\n')
+        self.memCachedServer.itemStore.set(b'counter', 5, b'41')
+        self.assertEqual(self.replies(b'incr counter 1\r\nincr counter 1 noreply\r\ndecr counter 50\r\n'), b'42\r\n0\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'counter').flags, 5)
+        self.memCachedServer.itemStore.set(b'counter', 0, b'18446744073709551615')
+        self.assertEqual(self.replies(b'incr counter 2\r\n'), b'1\r\n')
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.assertEqual(self.replies(b'incr capitalOfChina 1\r\n'), b'CLIENT_ERROR cannot increment or decrement non-numeric value\r\n')
+
+    async def testIncrReadsThroughAndPersists(self):
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'counter': (0, b'9', 0)})
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'incr counter 1\r\nincr counter 1\r\n')
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.get_many.assert_called_once_with([b'counter'])
+        self.memCachedServer.storage.set.assert_called_with(b'counter', 0, b'11', 0)
+        self.assertEqual(self.memCachedServer.transport.mock_calls, [call.write(b'10\r\n'), call.write(b'11\r\n')])
+
+    async def testIncrWaitsForPerWriteDurability(self):
+        self.memCachedServer.storage.set = MagicMock(return_value=self.storageResult(None))
+        self.memCachedServer.itemStore.set(b'counter', 0, b'1')
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'incr counter 1\r\n')
+        self.memCachedServer.transport.write.assert_not_called()
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.write.assert_called_with(b'2\r\n')
+
+    def testTouch(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'touch capitalOfChina 60\r\n'), b'NOT_FOUND\r\n')
+        casUnique = self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing').casUnique
+        self.assertEqual(self.replies(b'touch capitalOfChina 60\r\n'), b'TOUCHED\r\n')
+        item = self.memCachedServer.itemStore.get(b'capitalOfChina')
+        self.assertAlmostEqual(item.exptime, self.NOW + 60, delta=2)
+        self.assertEqual(item.casUnique, casUnique)
+        self.assertEqual(self.replies(b'touch capitalOfChina -1 noreply\r\n'), b'')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina'), None)
+
+    async def testGatTouchesAndPersists(self):
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'biggestOcean': (4, b'Pacific', 0)})
+        self.memCachedServer.storage.set = MagicMock(return_value=None)
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'gat 60 capitalOfChina biggestOcean\r\n')
+        await self.memCachedServer.pendingTask
+        self.assertAlmostEqual(self.memCachedServer.itemStore.get(b'biggestOcean').exptime, self.NOW + 60, delta=2)
+        self.memCachedServer.storage.set.assert_any_call(b'capitalOfChina', 2, b'Beijing', unittest.mock.ANY)
+        self.memCachedServer.transport.writelines.assert_called_once_with([
+            b'VALUE capitalOfChina 2 7\r\nBeijing\r\n',
+            b'VALUE biggestOcean 4 7\r\nPacific\r\n',
+            b'END\r\n'
+        ])
+
+    def testStats(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.connection_made(MagicMock())
+        self.replies(b'set capitalOfChina 2 0 7\r\nBeijing\r\nget capitalOfChina biggestOcean\r\nincr capitalOfChina 1\r\ndelete biggestOcean\r\n')
+        reply = self.replies(b'stats\r\n')
+        self.assertTrue(reply.endswith(self.END))
+        stats = dict(line.split()[1:] for line in reply.split(b'\r\n') if line.startswith(b'STAT '))
+        self.assertEqual(stats[b'curr_connections'], b'1')
+        self.assertEqual(stats[b'cmd_set'], b'1')
+        self.assertEqual(stats[b'cmd_get'], b'2')
+        self.assertEqual(stats[b'get_hits'], b'1')
+        self.assertEqual(stats[b'get_misses'], b'1')
+        self.assertEqual(stats[b'incr_hits'], b'1')
+        self.assertEqual(stats[b'delete_misses'], b'1')
+        self.assertEqual(stats[b'curr_items'], b'1')
+        self.assertEqual(stats[b'bytes_read'], b'0')
+        self.assertGreater(int(stats[b'bytes_written']), 0)
+
+    def testStatsLatency(self):
+        self.memCachedServer.storage = None
+        self.replies(b'set capitalOfChina 2 0 7\r\nBeijing\r\nget capitalOfChina\r\nget capitalOfChina\r\n')
+        reply = self.replies(b'stats latency\r\n')
+        self.assertIn(b'STAT get:count 2\r\n', reply)
+        self.assertIn(b'STAT set:count 1\r\n', reply)
+        self.assertIn(b'STAT get:p99_us ', reply)
+        self.assertEqual(self.replies(b'stats reset\r\n'), b'RESET\r\n')
+        self.assertIn(b'STAT items:1:number 1\r\n', self.replies(b'stats items\r\n'))
+        self.assertEqual(self.replies(b'stats unknown\r\n'), b'ERROR\r\n')
+
+    def testStatsHotKeys(self):
+        self.memCachedServer.storage = None
+        self.replies(b'set capitalOfChina 2 0 7\r\nBeijing\r\n' + b'get capitalOfChina biggestOcean\r\n' * 5 + b'delete biggestOcean\r\n')
+        reply = self.replies(b'stats hotkeys\r\n')
+        self.assertTrue(reply.endswith(self.END))
+        hotKeys = [line.split()[1] for line in reply.split(b'\r\n') if line.startswith(b'STAT ')]
+        self.assertEqual(hotKeys, [b'hotkey:capitalOfChina', b'hotkey:biggestOcean'])
+        self.replies(b'stats reset\r\n')
+        self.assertEqual(self.replies(b'stats hotkeys\r\n'), self.END)
+
+    async def testWatchMetrics(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.metricsFeed.interval = 0.01
+        self.memCachedServer.connection_made(MagicMock())
+        self.assertEqual(self.replies(b'watch metrics\r\n'), b'OK\r\n')
+        self.assertEqual(self.memCachedServer.metricsFeed.watchers, {self.memCachedServer})
+        self.replies(b'set capitalOfChina 2 0 7\r\nBeijing\r\nget capitalOfChina\r\n')
+        await asyncio.sleep(0.05)
+        metrics = [mockCall.args[0] for mockCall in self.memCachedServer.transport.mock_calls
+                   if mockCall[0] == 'write' and mockCall.args[0].startswith(b'METRICS {')]
+        self.assertTrue(metrics)
+        self.assertIn(b'"get_hit_ratio":1.0', metrics[0])
+        self.assertEqual(self.replies(b'watch fetchers\r\n'), b'CLIENT_ERROR bad command line format\r\n')
+        # A watching connection isn't idle
+        self.memCachedServer.lastActivity = 0
+        self.memCachedServer.idleTimeout = 1
+        self.memCachedServer._timeout()
+        self.assertFalse(self.memCachedServer.closing)
+        self.memCachedServer.connection_lost(None)
+        self.assertEqual(self.memCachedServer.metricsFeed.watchers, set())
+        self.assertEqual(self.memCachedServer.metricsFeed.handle, None)
+
+    async def testLatencyIncludesStorageWait(self):
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={})
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'get biggestOcean\r\n')
+        self.assertNotIn(b'get', self.memCachedServer.stats.latencies)
+        await self.memCachedServer.pendingTask
+        await asyncio.sleep(0)
+        self.assertEqual(sum(self.memCachedServer.stats.latencies[b'get']), 1)
+
+    def workerPeers(self):
+        # capitalOfFrance is owned by worker 1, the other keys by worker 0
+        peers = WorkerPeers(11211, 1, 2)
+        peers.forward = AsyncMock()
+        self.memCachedServer.peers = peers
+        return peers
+
+    async def testGetKeyDataForwardsKeysOwnedByOtherWorkers(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = b'VALUE capitalOfChina 2 7\r\nBeijing\r\nEND\r\n'
+        self.memCachedServer.transport.writelines = MagicMock()
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={})
+        self.memCachedServer.itemStore.set(b'capitalOfFrance', 3, b'Paris')
+        self.memCachedServer.getKeyData([b'get', b'capitalOfFrance', b'capitalOfChina', b'biggestOcean'])
+        await self.memCachedServer.pendingTask
+        peers.forward.assert_called_once_with(0, b'get capitalOfChina biggestOcean\r\n', multiLine=True)
+        self.memCachedServer.storage.get_many.assert_not_called()
+        reply = b''.join(self.memCachedServer.transport.writelines.call_args[0][0])
+        self.assertEqual(reply, b'VALUE capitalOfFrance 3 5\r\nParis\r\nVALUE capitalOfChina 2 7\r\nBeijing\r\nEND\r\n')
+
+    async def testGetKeyDataForwardError(self):
+        peers = self.workerPeers()
+        peers.forward.side_effect = ConnectionError
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.getKeyData([b'get', b'capitalOfChina'])
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.transport.write.assert_called_with(self.SERVER_ERROR_GET_FAILURE)
+
+    async def testSetKeyDataForwardsKeyOwnedByOtherWorker(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = self.SET_SUCCESS
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.storage.set = MagicMock()
+        self.memCachedServer.handleReceivedData(b'set capitalOfChina 2 0 7\r\nBeijing\r\n')
+        await self.memCachedServer.pendingTask
+        peers.forward.assert_called_once_with(0, b'set capitalOfChina 2 0 7\r\nBeijing\r\n')
+        self.memCachedServer.storage.set.assert_not_called()
+        self.assertNotIn(b'capitalOfChina', self.memCachedServer.itemStore)
+        self.memCachedServer.transport.write.assert_called_with(self.SET_SUCCESS)
+
+    async def testDeleteKeyDataForwardsKeyOwnedByOtherWorker(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = self.DELETE_SUCCESS
+        self.memCachedServer.transport.write = MagicMock()
+        self.memCachedServer.deleteKeyData([b'delete', b'capitalOfChina', b'noreply'])
+        await self.memCachedServer.pendingTask
+        peers.forward.assert_called_once_with(0, b'delete capitalOfChina\r\n')
+        self.memCachedServer.transport.write.assert_not_called()
+
+    def testMetaGetAndSet(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'mg capitalOfChina v\r\n'), b'EN\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 7 F14 T60 c\r\nBeijing\r\n'),
+                         b'HD c' + str(self.memCachedServer.itemStore.lastCasUnique).encode() + b'\r\n')
+        self.assertRegex(self.replies(b'mg capitalOfChina s f t v k O42\r\n'),
+                         rb'^VA 7 s7 f14 t(59|60) kcapitalOfChina O42\r\nBeijing\r\n$')
+        self.assertEqual(self.replies(b'mg capitalOfChina\r\n'), b'HD\r\n')
+        self.assertEqual(self.replies(b'mg capitalOfChina T-1\r\nmg capitalOfChina\r\n'), b'HD\r\nEN\r\n')
+
+    def testMetaQuietPipeline(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        reply = self.replies(b'ms biggestOcean 7 q\r\nPacific\r\nmg capitalOfChina v q O1\r\nmg capitalOfFrance v q O2\r\n'
+                             b'md manchesterUnited q O3\r\nmd capitalOfChina q C999 O4\r\nmn\r\n')
+        # A quiet md miss is suppressed like its hit, a cas mismatch is still answered
+        self.assertEqual(reply, b'VA 7 O1\r\nBeijing\r\nEX O4\r\nMN\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'biggestOcean').dataBlock, b'Pacific')
+
+    def testMetaSetModesAndCas(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'ms capitalOfChina 3 MA\r\nxyz\r\n'), b'NS\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 7 ME F2\r\nBeijing\r\n'), b'HD\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 1 MA\r\n!\r\nms capitalOfChina 3 MP\r\n>> \r\n'), b'HD\r\nHD\r\n')
+        item = self.memCachedServer.itemStore.get(b'capitalOfChina')
+        self.assertEqual((item.flags, item.dataBlock), (2, b'>> Beijing!'))
+        casUnique = str(item.casUnique).encode()
+        self.assertEqual(self.replies(b'ms capitalOfChina 6 C' + casUnique + b'0\r\nPeking\r\n'), b'EX\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 6 C' + casUnique + b'\r\nPeking\r\n'), b'HD\r\n')
+        self.assertEqual(self.replies(b'ms biggestOcean 7 C1\r\nPacific\r\n'), b'NF\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 7 MX\r\n'), b'CLIENT_ERROR invalid mode for ms\r\n')
+        self.assertEqual(self.replies(b'ms capitalOfChina 2\r\nPeking\r\n'), b'CLIENT_ERROR bad data chunk\r\nERROR\r\n')
+
+    def testMetaDelete(self):
+        self.memCachedServer.storage = None
+        casUnique = self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing').casUnique
+        self.assertEqual(self.replies(b'md capitalOfChina C' + str(casUnique + 1).encode() + b'\r\n'), b'EX\r\n')
+        self.assertEqual(self.replies(b'md capitalOfChina k\r\nmd capitalOfChina\r\n'), b'HD kcapitalOfChina\r\nNF\r\n')
+
+    def testMetaArithmetic(self):
+        self.memCachedServer.storage = None
+        self.assertEqual(self.replies(b'ma counter\r\n'), b'NF\r\n')
+        self.assertEqual(self.replies(b'ma counter N0 J10 v\r\n'), b'VA 2\r\n10\r\n')
+        self.assertEqual(self.replies(b'ma counter D5 v\r\nma counter MD D20 v\r\nma counter q\r\n'), b'VA 2\r\n15\r\nVA 1\r\n0\r\n')
+        self.assertEqual(self.memCachedServer.itemStore.get(b'counter').dataBlock, b'1')
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        self.assertEqual(self.replies(b'ma capitalOfChina\r\n'), b'CLIENT_ERROR cannot increment or decrement non-numeric value\r\n')
+        self.assertEqual(self.memCachedServer.stats.incrHits, 3)
+
+    async def testMetaCommandsReadThroughAndPersist(self):
+        self.memCachedServer.storage.get_many = AsyncMock(return_value={b'capitalOfChina': (2, b'Beijing', 0)})
+        self.memCachedServer.storage.delete = MagicMock(return_value=None)
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'mg capitalOfChina v\r\nmd capitalOfChina q\r\nmn\r\n')
+        await self.memCachedServer.pendingTask
+        self.memCachedServer.storage.delete.assert_called_once_with(b'capitalOfChina', checkExists=False)
+        self.assertEqual(self.memCachedServer.transport.mock_calls, [call.write(b'VA 7\r\nBeijing\r\n'), call.write(b'MN\r\n')])
+
+    async def testMetaSetForwardsKeyOwnedByOtherWorker(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = b'HD\r\n'
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'ms capitalOfChina 7 q T60\r\nBeijing\r\nmn\r\n')
+        await self.memCachedServer.pendingTask
+        peers.forward.assert_called_once_with(0, b'ms capitalOfChina 7 T60\r\nBeijing\r\n')
+        self.assertNotIn(b'capitalOfChina', self.memCachedServer.itemStore)
+        self.assertEqual(self.memCachedServer.transport.mock_calls, [call.write(b'MN\r\n')])
+
+    async def testQuietMetaDeleteMissForwardedToOtherWorker(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = b'NF O3\r\n'
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(b'md capitalOfChina q O3\r\nmn\r\n')
+        await self.memCachedServer.pendingTask
+        self.assertEqual(self.memCachedServer.transport.mock_calls, [call.write(b'MN\r\n')])
+
+    def binaryResponses(self, data):
+        reply = self.replies(data)
+        responses = []
+        while reply:
+            header = binaryprotocol.HEADER.unpack_from(reply)
+            end = binaryprotocol.HEADER_SIZE + header[6]
+            responses.append((header[1], header[5], header[7], reply[binaryprotocol.HEADER_SIZE:end]))
+            reply = reply[end:]
+        return responses
+
+    def testBinarySetGetDelete(self):
+        self.memCachedServer.storage = None
+        setExtras = binaryprotocol.SET_EXTRAS.pack(14, 0)
+        responses = self.binaryResponses(
+            requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Beijing', setExtras, opaque=1)
+            + requestPacket(binaryprotocol.OPCODE_GET, b'capitalOfChina', opaque=2)
+            + requestPacket(binaryprotocol.OPCODE_GETK, b'capitalOfFrance', opaque=3)
+            + requestPacket(binaryprotocol.OPCODE_DELETE, b'capitalOfChina', opaque=4)
+            + requestPacket(binaryprotocol.OPCODE_DELETE, b'capitalOfChina', opaque=5))
+        self.assertTrue(self.memCachedServer.binaryProtocol)
+        self.assertEqual(responses, [
+            (binaryprotocol.OPCODE_SET, 0, 1, b''),
+            (binaryprotocol.OPCODE_GET, 0, 2, b'\x00\x00\x00\x0eBeijing'),
+            (binaryprotocol.OPCODE_GETK, binaryprotocol.STATUS_KEY_NOT_FOUND, 3, b'capitalOfFranceNot found'),
+            (binaryprotocol.OPCODE_DELETE, 0, 4, b''),
+            (binaryprotocol.OPCODE_DELETE, binaryprotocol.STATUS_KEY_NOT_FOUND, 5, b'Not found'),
+        ])
+        self.assertEqual(self.memCachedServer.stats.cmdGet, 2)
+
+    def testBinaryQuietPipeline(self):
+        self.memCachedServer.storage = None
+        self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing')
+        packets = (requestPacket(binaryprotocol.OPCODE_SETQ, b'biggestOcean', b'Pacific', binaryprotocol.SET_EXTRAS.pack(0, 0), opaque=1)
+                   + requestPacket(binaryprotocol.OPCODE_GETKQ, b'capitalOfChina', opaque=2)
+                   + requestPacket(binaryprotocol.OPCODE_GETQ, b'capitalOfFrance', opaque=3)
+                   + requestPacket(binaryprotocol.OPCODE_NOOP, opaque=4))
+        # A fragmented packet waits for the rest of its body
+        self.assertEqual(self.binaryResponses(packets[:30]), [])
+        responses = self.binaryResponses(packets[30:])
+        self.assertEqual(responses, [
+            (binaryprotocol.OPCODE_GETKQ, 0, 2, b'\x00\x00\x00\x02capitalOfChinaBeijing'),
+            (binaryprotocol.OPCODE_NOOP, 0, 4, b''),
+        ])
+        self.assertEqual(self.memCachedServer.itemStore.get(b'biggestOcean').dataBlock, b'Pacific')
+
+    def testBinaryCasAndErrors(self):
+        self.memCachedServer.storage = None
+        casUnique = self.memCachedServer.itemStore.set(b'capitalOfChina', 2, b'Beijing').casUnique
+        setExtras = binaryprotocol.SET_EXTRAS.pack(2, 0)
+        responses = self.binaryResponses(
+            requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Peking', setExtras, cas=casUnique + 1)
+            + requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Peking', setExtras, cas=casUnique)
+            + requestPacket(binaryprotocol.OPCODE_SET, b'capitalOfChina', b'Peking')
+            + requestPacket(0x30, b'capitalOfChina'))
+        self.assertEqual([response[1] for response in responses], [
+            binaryprotocol.STATUS_KEY_EXISTS, 0, binaryprotocol.STATUS_INVALID_ARGUMENTS, binaryprotocol.STATUS_UNKNOWN_COMMAND])
+        self.assertEqual(self.memCachedServer.itemStore.get(b'capitalOfChina').dataBlock, b'Peking')
+
+    async def testBinaryGetForwardsKeyOwnedByOtherWorker(self):
+        peers = self.workerPeers()
+        peers.forward.return_value = b'VA 7 f2 c9\r\nBeijing\r\n'
+        self.memCachedServer.transport = MagicMock()
+        self.memCachedServer.handleReceivedData(requestPacket(binaryprotocol.OPCODE_GET, b'capitalOfChina', opaque=6))
+        await self.memCachedServer.pendingTask
+        peers.forward.assert_called_once_with(0, b'mg Y2FwaXRhbE9mQ2hpbmE= b f c v\r\n')
+        response = self.memCachedServer.transport.write.call_args[0][0]
+        self.assertEqual(binaryprotocol.HEADER.unpack_from(response), (0x81, 0, 0, 4, 0, 0, 11, 6, 9))
+
+    async def storageResult(self, value):
+        return value
+
+    async def storageError(self):
+        return 1/0
@@ -0,0 +1,55 @@
+import unittest
+import time
+from itemstore import Item
+from metaprotocol import MetaCommand, MetaCommandError, remainingTtl
+
+
+class TestMetaCommand(unittest.TestCase):
+
+    def testParseFlags(self):
+        request = MetaCommand(b'mg capitalOfChina s v T30 Oabc q'.split())
+        self.assertEqual(request.key, b'capitalOfChina')
+        self.assertEqual(request.returnFlags, [b's', b'v', b'T', b'O', b'q'])
+        self.assertEqual(request.numericFlag(b'T'), 30)
+        self.assertEqual(request.numericFlag(b'C'), None)
+        self.assertTrue(request.quiet)
+
+    def testParseSet(self):
+        request = MetaCommand(b'ms capitalOfChina 7 F14 MA'.split())
+        self.assertEqual(request.dataLength, 7)
+        self.assertEqual(request.numericFlag(b'F'), 14)
+        self.assertEqual(request.mode, b'append')
+        self.assertEqual(MetaCommand(b'ms capitalOfChina 7'.split()).mode, b'set')
+        self.assertEqual(MetaCommand(b'ma counter MD'.split()).mode, b'decr')
+
+    def testBase64Key(self):
+        request = MetaCommand(b'mg Y2FwaXRhbCBvZiBDaGluYQ== b k'.split())
+        self.assertEqual(request.key, b'capital of China')
+        self.assertEqual(request.reply(b'EN'), b'EN b kY2FwaXRhbCBvZiBDaGluYQ==\r\n')
+        with self.assertRaises(MetaCommandError):
+            MetaCommand(b'mg Y2Fw!!== b'.split())
+
+    def testInvalidCommandLines(self):
+        for line in (b'mg', b'mg capitalOfChina x', b'mg capitalOfChina Tsoon', b'ms capitalOfChina', b'ms capitalOfChina 7 F65536',
+                     b'ms capitalOfChina 7 MX', b'ma counter D-1', b'mg ' + b'k' * 251):
+            with self.assertRaises(MetaCommandError, msg=line):
+                MetaCommand(line.split())
+
+    def testReply(self):
+        item = Item(b'capitalOfChina', 14, b'Beijing', int(time.time()) + 60, casUnique=3)
+        request = MetaCommand(b'mg capitalOfChina k v c f s t O123'.split())
+        self.assertRegex(request.reply(b'VA', item, item.dataBlock),
+                         rb'^VA 7 kcapitalOfChina c3 f14 s7 t(59|60) O123\r\nBeijing\r\n$')
+        self.assertEqual(request.reply(b'EN'), b'EN kcapitalOfChina O123\r\n')
+
+    def testForwardedParams(self):
+        request = MetaCommand(b'md capitalOfChina q O1'.split())
+        self.assertEqual(request.forwardedParams(), [b'md', b'capitalOfChina', b'O1'])
+
+    def testRemainingTtl(self):
+        self.assertEqual(remainingTtl(0), -1)
+        self.assertEqual(remainingTtl(time.time() - 10), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
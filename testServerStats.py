@@ -0,0 +1,169 @@
+import unittest
+import asyncio
+import json
+from unittest.mock import MagicMock, patch
+from itemstore import ItemStore
+from compression import ValueCompressor
+from serverstats import MetricsFeed, ServerStats
+
+
+class TestServerStats(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = ServerStats()
+
+    def testLatencyBuckets(self):
+        self.stats.recordLatency(b'get', 500)           # below 1 microsecond
+        self.stats.recordLatency(b'get', 3000)          # 3 microseconds, below 4
+        self.stats.recordLatency(b'get', 10 ** 12)      # beyond the last bucket
+        counts = self.stats.latencies[b'get']
+        self.assertEqual(counts[0], 1)
+        self.assertEqual(counts[2], 1)
+        self.assertEqual(counts[-1], 1)
+        self.assertEqual(sum(counts), 3)
+
+    def testPercentiles(self):
+        self.assertEqual(self.stats.percentile([0] * ServerStats.LATENCY_BUCKETS, 0.5), 0)
+        for _ in range(99):
+            self.stats.recordLatency(b'get', 5000)
+        self.stats.recordLatency(b'get', 900000)
+        counts = self.stats.latencies[b'get']
+        self.assertEqual(self.stats.percentile(counts, 0.5), 8)
+        self.assertEqual(self.stats.percentile(counts, 0.99), 8)
+        self.assertEqual(self.stats.percentile(counts, 0.999), 1024)
+
+    def testLatencyStats(self):
+        self.stats.recordLatency(b'get', 5000)
+        self.stats.recordLatency(b'get', 6000)
+        stats = dict(self.stats.latency())
+        self.assertEqual(stats['get:count'], 2)
+        self.assertEqual(stats['get:p50_us'], 8)
+        self.assertEqual(stats['get:le_8'], 2)
+
+    def testGeneralStats(self):
+        itemStore = ItemStore(1024)
+        itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.stats.getHits = 3
+        stats = dict(self.stats.general(itemStore))
+        self.assertEqual(stats['get_hits'], 3)
+        self.assertEqual(stats['curr_items'], 1)
+        self.assertEqual(stats['bytes'], itemStore.memoryUsed)
+        self.assertEqual(stats['limit_maxbytes'], 1024)
+        self.assertNotIn('journaled_writes', stats)
+        self.assertNotIn('compression_ratio', stats)
+        self.assertEqual(stats['eviction_policy'], 'lru')
+        self.assertNotIn('tinylfu_admissions', stats)
+
+    def testEvictionPolicyStats(self):
+        stats = dict(self.stats.general(ItemStore(1024 * 1024, evictionPolicy='tinylfu')))
+        self.assertEqual(stats['eviction_policy'], 'tinylfu')
+        self.assertEqual(stats['tinylfu_rejections'], 0)
+
+    def testCompressionStats(self):
+        itemStore = ItemStore(1024 * 1024, ValueCompressor(threshold=100))
+        itemStore.set(b'capitals', 0, b'<li>Beijing</li>' * 100)
+        stats = dict(self.stats.general(itemStore))
+        self.assertEqual(stats['compression_threshold'], 100)
+        self.assertEqual(stats['compressed_values'], 1)
+        self.assertEqual(stats['compression_bytes_in'], 1600)
+
+    def testSlabStats(self):
+        itemStore = ItemStore(64 * 1024)
+        itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        itemStore.set(b'capitals', 0, b'x' * 2000)
+        stats = dict(self.stats.slabs(itemStore))
+        self.assertEqual(stats['1:chunk_size'], 64)
+        self.assertEqual(stats['1:used_chunks'], 1)
+        self.assertEqual(stats['1:free_chunks'], 15)
+        self.assertEqual(stats['1:mem_requested'], len(b'VALUE capitalOfChina 14 7\r\nBeijing\r\n'))
+        self.assertEqual(stats['active_slabs'], 1)
+        self.assertEqual(stats['large_items'], 1)
+        self.assertEqual(stats['total_malloced'], 1024 + stats['large_bytes'])
+
+    def testItemStats(self):
+        itemStore = ItemStore(64 * 1024)
+        itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        itemStore.set(b'biggestOcean', 0, b'Pacific', 1)
+        self.assertEqual(itemStore.get(b'biggestOcean'), None)
+        classId = itemStore.set(b'capitals', 0, b'x' * 200).page.slabClass.classId
+        itemStore.evict(b'capitals')
+        self.assertEqual(self.stats.items(itemStore), [
+            ('items:1:number', 1), ('items:1:evicted', 0), ('items:1:reclaimed', 1), ('items:1:outofmemory', 0),
+            ('items:%d:number' % classId, 0), ('items:%d:evicted' % classId, 1),
+            ('items:%d:reclaimed' % classId, 0), ('items:%d:outofmemory' % classId, 0),
+        ])
+
+    def testHotKeysStats(self):
+        for _ in range(3):
+            self.stats.hotKeys.record(b'capitalOfChina')
+        self.stats.hotKeys.record(b'biggestOcean')
+        self.assertEqual([name for name, rate in self.stats.hotkeys()], ['hotkey:capitalOfChina', 'hotkey:biggestOcean'])
+        self.assertEqual(ServerStats(hotKeysSize=0).hotkeys(), [])
+
+    def testReset(self):
+        self.stats.currConnections = 2
+        self.stats.totalConnections = 5
+        self.stats.getHits = 3
+        self.stats.recordLatency(b'get', 5000)
+        self.stats.reset()
+        self.assertEqual(self.stats.getHits, 0)
+        self.assertEqual(self.stats.totalConnections, 0)
+        self.assertEqual(self.stats.currConnections, 2)
+        self.assertEqual(self.stats.latency(), [])
+
+
+class TestMetricsFeed(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.stats = ServerStats()
+        self.itemStore = ItemStore(1024)
+        self.feed = MetricsFeed(self.stats, self.itemStore, 0.01)
+
+    async def asyncTearDown(self):
+        if self.feed.handle is not None:
+            self.feed.handle.cancel()
+
+    def testSampleIsOverTheLastInterval(self):
+        self.stats.recordLatency(b'get', 900000)
+        with patch('serverstats.time.monotonic', return_value=100):
+            self.feed.previous = self.feed.counters()
+        self.stats.cmdGet = 4
+        self.stats.getHits = 3
+        for _ in range(10):
+            self.stats.recordLatency(b'get', 5000)
+        self.itemStore.evictions = 2
+        with patch('serverstats.time.monotonic', return_value=102):
+            sample = self.feed.sample()
+        self.assertEqual(sample['ops_per_sec'], 5)
+        self.assertEqual(sample['get_hit_ratio'], 0.75)
+        self.assertEqual(sample['evictions_per_sec'], 1)
+        self.assertEqual(sample['limit_maxbytes'], 1024)
+        # The slow command was before the interval
+        self.assertEqual(sample['p999_us'], 8)
+        self.assertEqual(sample['hot_keys'], [])
+
+    def testSampleAfterAReset(self):
+        self.stats.recordLatency(b'get', 5000)
+        self.stats.recordLatency(b'get', 5000)
+        self.feed.previous = self.feed.counters()
+        self.stats.reset()
+        self.stats.recordLatency(b'set', 5000)
+        sample = self.feed.sample()
+        self.assertGreater(sample['ops_per_sec'], 0)
+        self.assertEqual(sample['get_hit_ratio'], None)
+        self.assertEqual(sample['p50_us'], 8)
+
+    async def testSamplesArePublishedToTheWatchers(self):
+        watcher = MagicMock(writingPaused=False)
+        pausedWatcher = MagicMock(writingPaused=True)
+        self.feed.watch(watcher)
+        self.feed.watch(pausedWatcher)
+        await asyncio.sleep(0.05)
+        line = watcher.write.call_args.args[0]
+        self.assertTrue(line.startswith(b'METRICS ') and line.endswith(b'\r\n'))
+        self.assertEqual(json.loads(line[8:])['curr_items'], 0)
+        pausedWatcher.write.assert_not_called()
+        self.feed.unwatch(watcher)
+        self.assertIsNotNone(self.feed.handle)
+        self.feed.unwatch(pausedWatcher)
+        self.assertEqual(self.feed.handle, None)
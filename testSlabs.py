@@ -0,0 +1,159 @@
+import unittest
+from itemstore import Item, ItemStore
+from slabs import SlabAllocator
+
+
+class TestSlabAllocator(unittest.TestCase):
+
+    def setUp(self):
+        self.slabs = SlabAllocator(pageSize=1024)
+
+    def item(self, key, dataBlock):
+        item = Item(key, 0, dataBlock)
+        self.slabs.allocate(item)
+        return item
+
+    def testSizeClasses(self):
+        self.assertEqual(self.slabs.chunkSizes[:4], [64, 80, 104, 136])
+        self.assertEqual(self.slabs.chunkSizes[-1], 1024)
+        self.assertIs(self.slabs.slabClass(64), self.slabs.classes[0])
+        self.assertIs(self.slabs.slabClass(65), self.slabs.classes[1])
+        self.assertIsNone(self.slabs.slabClass(1025))
+
+    def testRecordsShareAPage(self):
+        first = self.item(b'capitalOfChina', b'Beijing')
+        second = self.item(b'biggestOcean', b'Pacific')
+        self.assertIs(first.page, second.page)
+        self.assertEqual(first.page.slabClass.chunkSize, 64)
+        self.assertEqual(self.slabs.totalMalloced, 1024)
+        self.assertEqual(first.dataBlock, b'Beijing')
+        self.assertEqual(second.reply(), b'VALUE biggestOcean 0 7\r\nPacific\r\n')
+
+    def testFreedItemKeepsItsValue(self):
+        first = self.item(b'capitalOfChina', b'Beijing')
+        self.item(b'biggestOcean', b'Pacific')
+        self.slabs.free(first)
+        # The freed chunk is reused by the next record
+        third = self.item(b'tallestPeak', b'Everest')
+        self.assertEqual(third.offset, 0)
+        self.assertEqual(first.dataBlock, b'Beijing')
+        self.assertIsNone(first.page.slabClass)
+
+    def testReplyIsAViewOfTheChunk(self):
+        item = self.item(b'capitalOfChina', b'Beijing')
+        reply = item.reply()
+        self.assertIsInstance(reply, memoryview)
+        self.assertIs(reply.obj, item.page.memory)
+        self.assertEqual(reply, b'VALUE capitalOfChina 0 7\r\nBeijing\r\n')
+
+    def testRetainedPageIsCopiedBeforeItsChunkIsReused(self):
+        first = self.item(b'capitalOfChina', b'Beijing')
+        self.item(b'biggestOcean', b'Pacific')
+        reply = first.reply()
+        self.slabs.retain([b'END\r\n', reply])
+        self.slabs.free(first)
+        third = self.item(b'tallestPeak', b'Everest')
+        self.assertEqual(third.offset, 0)
+        # The view the transport kept still reads the freed record, the page writes to a copy of its memory
+        self.assertEqual(reply, b'VALUE capitalOfChina 0 7\r\nBeijing\r\n')
+        self.assertIsNot(third.page.memory, reply.obj)
+        self.assertFalse(third.page.retained)
+        self.assertEqual(third.dataBlock, b'Everest')
+
+    def testRetainedPageIsNotReused(self):
+        item = self.item(b'capitalOfChina', b'Beijing')
+        self.slabs.retain([item.reply()])
+        self.slabs.free(item)
+        self.assertIsNone(self.slabs.spareMemory)
+        self.assertEqual(self.slabs.pagesByMemory, {})
+
+    def testEmptyPageIsReleased(self):
+        item = self.item(b'capitalOfChina', b'Beijing')
+        self.slabs.free(item)
+        self.assertEqual(self.slabs.totalMalloced, 0)
+        self.assertEqual(self.slabs.pages(), [])
+
+    def testLargeRecordsAreKeptOutsideTheSlabs(self):
+        item = self.item(b'capitals', b'x' * 2000)
+        self.assertIsNone(item.page.slabClass)
+        self.assertIs(item.reply(), item.page.memory)
+        self.assertEqual(self.slabs.totalMalloced, item.recordLength)
+        self.slabs.free(item)
+        self.assertEqual(self.slabs.totalMalloced, 0)
+
+    def testReclaimMovesTheChunksOfTheEmptiestPage(self):
+        # 16 chunks of 64 bytes per page, the first page keeps one item and the second one half of its items
+        items = [self.item(b'key%02d' % index, b'%02d' % index) for index in range(32)]
+        slabClass = items[0].page.slabClass
+        for item in items[1:16] + items[16:24]:
+            self.slabs.free(item)
+        self.assertEqual(slabClass.freeChunks, 23)
+        self.assertTrue(self.slabs.reclaim(slabClass))
+        self.assertEqual(len(slabClass.pages), 1)
+        self.assertEqual(self.slabs.totalMalloced, 1024)
+        self.assertIs(items[0].page, items[24].page)
+        for index in [0] + list(range(24, 32)):
+            self.assertEqual(items[index].dataBlock, b'%02d' % index)
+        self.assertEqual(self.slabs.chunksMoved, 1)
+        self.assertFalse(self.slabs.reclaim(slabClass))
+
+    def testFragmentationStats(self):
+        self.item(b'capitalOfChina', b'Beijing')
+        stats = dict(self.slabs.stats())
+        self.assertEqual(stats['1:total_pages'], 1)
+        self.assertEqual(stats['1:used_chunks'], 1)
+        self.assertEqual(stats['fragmentation'], '{:.2f}'.format(1 - stats['1:mem_requested'] / 1024))
+
+
+class TestSlabItemStore(unittest.TestCase):
+
+    def testMemoryLimitHoldsWhileTheSizesChange(self):
+        itemStore = ItemStore(256 * 1024)
+        values = {}
+        for step, size in enumerate([10, 300, 1000, 10, 3000, 300]):
+            for index in range(300):
+                key = b'key%d' % index
+                value = (b'%d:%d:' % (step, index)).ljust(size, b'x')
+                itemStore.set(key, 0, value)
+                values[key] = value
+                self.assertLessEqual(itemStore.memoryUsed, itemStore.memoryLimit)
+        self.assertGreater(itemStore.evictions, 0)
+        for key, item in itemStore.items.items():
+            self.assertEqual(item.dataBlock, values[key])
+        self.assertEqual(itemStore.slabs.totalMalloced, len(itemStore.slabs.pages()) * itemStore.slabs.pageSize +
+                         itemStore.slabs.largeBytes)
+
+    def testSetEvictsFromTheClassOfTheValueFirst(self):
+        itemStore = ItemStore(256 * 1024)
+        itemStore.set(b'oldest', 0, b'x' * 10)
+        for index in range(1000):
+            itemStore.set(b'large%04d' % index, 0, b'x' * 500)
+        # The values took the chunks of the least recently used values of their class, evicting the small value
+        # would have freed a chunk of the wrong class
+        self.assertIn(b'oldest', itemStore)
+        self.assertNotIn(b'large0000', itemStore)
+        self.assertEqual(itemStore.evictions, 1000 + 1 - len(itemStore))
+        self.assertLessEqual(itemStore.memoryUsed, itemStore.memoryLimit)
+
+    def testEvictionsOfASetAreBounded(self):
+        itemStore = ItemStore(1024 * 1024)
+        index = 0
+        while itemStore.evictions == 0:
+            itemStore.set(b'key%d' % index, 0, b'x' * (10 + index % 90))
+            index += 1
+        # A new page for a class that has none would take a page of chunks freed in every other class
+        itemStore.set(b'large', 0, b'x' * 500)
+        self.assertLessEqual(itemStore.evictions, ItemStore.MAX_EVICTIONS_PER_SET + 2)
+        self.assertLessEqual(itemStore.memoryUsed, itemStore.memoryLimit)
+
+    def testSnapshotItemsAreNotChangedByLaterWrites(self):
+        itemStore = ItemStore(64 * 1024)
+        itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        key, item, memory, offset = itemStore.snapshotItems()[0]
+        itemStore.delete(b'capitalOfChina')
+        itemStore.set(b'biggestOcean', 4, b'Pacific')
+        self.assertEqual(bytes(item.persistedValue(memory, offset)[1]), b'Beijing')
+
+
+if __name__ == '__main__':
+    unittest.main()
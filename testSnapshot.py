@@ -0,0 +1,100 @@
+import unittest
+import asyncio
+import os
+import time
+import tempfile
+from unittest.mock import patch
+from itemstore import ItemStore
+from snapshot import Snapshotter, SnapshotError, loadSnapshot, writeSnapshot
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temporaryDirectory.name, 'items.snapshot')
+        self.itemStore = ItemStore(1024 * 1024)
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+        self.itemStore.set(b'pickled', 0, b'\x80\x04\xff\r\n\x00', int(time.time()) + 60)
+        self.itemStore.set(b'expired', 0, b'gone', int(time.time()) - 1)
+
+    def tearDown(self):
+        self.temporaryDirectory.cleanup()
+
+    def testWriteAndLoad(self):
+        self.assertEqual(writeSnapshot(self.path, self.itemStore.snapshotItems()), 2)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+        itemStore = ItemStore(1024 * 1024)
+        self.assertEqual(loadSnapshot(self.path, itemStore), 2)
+        self.assertEqual(list(itemStore.items), [b'capitalOfChina', b'pickled'])
+        self.assertEqual(itemStore.get(b'capitalOfChina').flags, 14)
+        self.assertEqual(itemStore.get(b'capitalOfChina').dataBlock, b'Beijing')
+        pickled = itemStore.get(b'pickled')
+        self.assertEqual(pickled.dataBlock, b'\x80\x04\xff\r\n\x00')
+        self.assertEqual(pickled.exptime, self.itemStore.get(b'pickled').exptime)
+
+    def testItemsExpiredSinceTheSnapshotAreSkipped(self):
+        writeSnapshot(self.path, self.itemStore.snapshotItems())
+        itemStore = ItemStore(1024 * 1024)
+        with patch('snapshot.time.time', return_value=time.time() + 120):
+            self.assertEqual(loadSnapshot(self.path, itemStore), 1)
+        self.assertEqual(list(itemStore.items), [b'capitalOfChina'])
+
+    def testOnlyLocalKeysAreLoaded(self):
+        writeSnapshot(self.path, self.itemStore.snapshotItems())
+        itemStore = ItemStore(1024 * 1024)
+        self.assertEqual(loadSnapshot(self.path, itemStore, isLocal=lambda key: key == b'pickled'), 1)
+        self.assertEqual(list(itemStore.items), [b'pickled'])
+
+    def testUncleanSnapshotCanBeRequiredClean(self):
+        writeSnapshot(self.path, self.itemStore.snapshotItems())
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 0)
+        writeSnapshot(self.path, self.itemStore.snapshotItems(), clean=True)
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 2)
+
+    def testLoadedSnapshotIsNoLongerClean(self):
+        writeSnapshot(self.path, self.itemStore.snapshotItems(), clean=True)
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 2)
+        # A crash after the restart must not bring back the values overwritten since
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 0)
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024)), 2)
+
+    def testCorruptedSnapshotIsNotLoaded(self):
+        writeSnapshot(self.path, self.itemStore.snapshotItems())
+        with open(self.path, 'r+b') as snapshotFile:
+            snapshotFile.seek(30)
+            snapshotFile.write(b'X')
+        with self.assertRaises(SnapshotError):
+            loadSnapshot(self.path, ItemStore(1024 * 1024))
+        with open(self.path, 'r+b') as snapshotFile:
+            snapshotFile.truncate(40)
+        with self.assertRaises(SnapshotError):
+            loadSnapshot(self.path, ItemStore(1024 * 1024))
+
+
+class TestSnapshotter(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temporaryDirectory.name, 'items.snapshot')
+        self.itemStore = ItemStore(1024 * 1024)
+        self.itemStore.set(b'capitalOfChina', 14, b'Beijing')
+
+    async def asyncTearDown(self):
+        self.temporaryDirectory.cleanup()
+
+    async def testPeriodicAndFinalSnapshots(self):
+        snapshotter = Snapshotter(self.path, self.itemStore, 0.05)
+        snapshotter.start()
+        while snapshotter.writeFuture is None:
+            await asyncio.sleep(0.01)
+        await snapshotter.writeFuture
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 0)
+        self.itemStore.set(b'biggestOcean', 0, b'Pacific')
+        self.assertEqual(await snapshotter.close(), 2)
+        self.assertEqual(snapshotter.handle, None)
+        self.assertEqual(loadSnapshot(self.path, ItemStore(1024 * 1024), requireClean=True), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
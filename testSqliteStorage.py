@@ -0,0 +1,254 @@
+import unittest
+import asyncio
+from unittest.mock import MagicMock
+import os.path
+import sqlite3
+import tempfile
+import time
+from sqlitestorage import ShardedSqliteStorage, SqliteStorage, keyShard, shardFiles
+from compression import COMPRESSED_FLAG, ValueCompressor
+
+
+class TestSqliteStorage(unittest.IsolatedAsyncioTestCase):
+
+    CREATE_KEYS_TABLE = """ CREATE TABLE IF NOT EXISTS keysTable (
+                                key text PRIMARY KEY,
+                                flags integer NOT NULL,
+                                bytes integer,
+                                dataBlock blob,
+                                exptime integer NOT NULL DEFAULT 0
+                            ); """
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.databaseFile = os.path.join(self.temporaryDirectory.name, 'database.sqlite')
+        connection = sqlite3.connect(self.databaseFile)
+        connection.execute(self.CREATE_KEYS_TABLE)
+        connection.execute(""" INSERT INTO keysTable VALUES ('biggestOcean', 4, 7, CAST('Pacific' AS BLOB), 0) """)
+        connection.commit()
+        connection.close()
+        self.storage = SqliteStorage(self.databaseFile, batchSize=3)
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.temporaryDirectory.cleanup()
+
+    def persistedRows(self):
+        connection = sqlite3.connect(self.databaseFile)
+        rows = connection.execute(""" SELECT * FROM keysTable ORDER BY key """).fetchall()
+        connection.close()
+        return rows
+
+    async def testWalMode(self):
+        await self.storage.get_many([b'biggestOcean'])
+        journalMode = self.storage.connections[0].execute('PRAGMA journal_mode').fetchone()[0]
+        self.assertEqual(journalMode, 'wal')
+
+    def testUnknownDurability(self):
+        with self.assertRaises(ValueError):
+            SqliteStorage(self.databaseFile, durability='sometimes')
+
+    async def testSetIsJournaledUntilFlush(self):
+        self.assertEqual(self.storage.set(b'capitalOfChina', 14, b'Beijing'), None)
+        self.assertEqual(self.persistedRows(), [('biggestOcean', 4, 7, b'Pacific', 0)])
+        await self.storage.flush()
+        self.assertEqual(self.persistedRows(), [('biggestOcean', 4, 7, b'Pacific', 0), ('capitalOfChina', 14, 7, b'Beijing', 0)])
+        self.assertEqual(self.storage.journal, {})
+        self.assertEqual(self.storage.flushingJournal, {})
+
+    async def testFlushInterval(self):
+        self.storage.flushInterval = 0.01
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertNotEqual(self.storage.flushHandle, None)
+        await asyncio.sleep(0.05)
+        if self.storage.flushFuture is not None:
+            await self.storage.flushFuture
+        self.assertIn(('capitalOfChina', 14, 7, b'Beijing', 0), self.persistedRows())
+
+    async def testBatchSizeTriggersFlush(self):
+        self.storage.set(b'key0', 0, b'a')
+        self.storage.set(b'key1', 0, b'b')
+        self.assertEqual(self.storage.flushFuture, None)
+        self.storage.set(b'key2', 0, b'c')
+        self.assertNotEqual(self.storage.flushFuture, None)
+        await self.storage.flushFuture
+        self.assertEqual(len(self.persistedRows()), 4)
+
+    async def testGetManyReadsJournalBeforeDatabase(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        self.storage.set(b'biggestOcean', 5, b'Atlantic')
+        results = await self.storage.get_many([b'capitalOfChina', b'biggestOcean', b'manchesterUnited'])
+        self.assertEqual(results, {b'capitalOfChina': (14, b'Beijing', 0), b'biggestOcean': (5, b'Atlantic', 0)})
+
+    async def testGetManyReadsJournalBeingFlushed(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        flushFuture = self.storage.flush()
+        self.assertEqual(self.storage.journal, {})
+        results = await self.storage.get_many([b'capitalOfChina'])
+        self.assertEqual(results, {b'capitalOfChina': (14, b'Beijing', 0)})
+        await flushFuture
+
+    async def testGetManyPrefersWritesJournaledWhileReading(self):
+        pendingRead = asyncio.ensure_future(self.storage.get_many([b'biggestOcean']))
+        await asyncio.sleep(0)
+        self.storage.delete(b'biggestOcean', checkExists=False)
+        self.assertEqual(await pendingRead, {})
+
+    async def testConcurrentReadsAreCoalesced(self):
+        self.storage.selectRows = MagicMock(wraps=self.storage.selectRows)
+        results = await asyncio.gather(*([self.storage.get_many([b'biggestOcean']) for index in range(5)]
+                                         + [self.storage.get_many([b'manchesterUnited', b'biggestOcean'])]))
+        self.assertEqual(results, [{b'biggestOcean': (4, b'Pacific', 0)}] * 6)
+        # One query for the keys of every caller of the loop iteration, each key read once
+        self.storage.selectRows.assert_called_once_with([b'biggestOcean', b'manchesterUnited'])
+        self.assertEqual(self.storage.pendingReads, {})
+        del self.storage.selectRows
+
+    async def testNonUtf8KeyIsAMissWithoutFailingTheBatch(self):
+        results = await asyncio.gather(self.storage.get_many([b'biggestOcean']), self.storage.get_many([b'\xff']),
+                                       return_exceptions=True)
+        self.assertEqual(results, [{b'biggestOcean': (4, b'Pacific', 0)}, {}])
+
+    async def testNonUtf8DeleteKeepsTheRestOfTheBatch(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertEqual(self.storage.delete(b'\xff', checkExists=False), None)
+        self.assertFalse(await self.storage.delete(b'\xfe'))
+        self.storage.set(b'tallestMountain', 0, b'Everest')
+        with self.assertRaises(ValueError):
+            self.storage.set(b'\xff', 0, b'x')
+        await self.storage.flush()
+        self.assertEqual([row[0] for row in self.persistedRows()], ['biggestOcean', 'capitalOfChina', 'tallestMountain'])
+
+    async def testWriteDuringReadStartsANewRead(self):
+        pendingRead = asyncio.ensure_future(self.storage.get_many([b'biggestOcean']))
+        await asyncio.sleep(0)
+        self.assertIn(b'biggestOcean', self.storage.pendingReads)
+        self.storage.set(b'biggestOcean', 5, b'Atlantic')
+        self.assertNotIn(b'biggestOcean', self.storage.pendingReads)
+        self.assertEqual(await pendingRead, {b'biggestOcean': (5, b'Atlantic', 0)})
+
+    async def testFailedReadFailsEveryCaller(self):
+        self.storage.selectRows = MagicMock(side_effect=sqlite3.OperationalError('disk I/O error'))
+        results = await asyncio.gather(self.storage.get_many([b'biggestOcean']), self.storage.get_many([b'biggestOcean']),
+                                       return_exceptions=True)
+        self.assertTrue(all(isinstance(result, sqlite3.OperationalError) for result in results))
+        self.assertEqual(self.storage.selectRows.call_count, 1)
+        del self.storage.selectRows
+
+    async def testBinaryValue(self):
+        self.storage.set(b'pickled', 0, b'\x80\x04\xff\r\n\x00')
+        await self.storage.flush()
+        self.assertIn(('pickled', 0, 6, b'\x80\x04\xff\r\n\x00', 0), self.persistedRows())
+        results = await self.storage.get_many([b'pickled'])
+        self.assertEqual(results, {b'pickled': (0, b'\x80\x04\xff\r\n\x00', 0)})
+
+    async def testCompressedValueBytesAreItsLengthBeforeCompression(self):
+        value = b'<li>Beijing</li>' * 100
+        compressed = ValueCompressor(threshold=100).compress(value)
+        self.storage.set(b'capitals', 14 | COMPRESSED_FLAG, compressed)
+        await self.storage.flush()
+        self.assertIn(('capitals', 14 | COMPRESSED_FLAG, 1600, compressed, 0), self.persistedRows())
+
+    async def testExpiredRowsAreNotRead(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing', int(time.time()) - 1)
+        self.storage.set(b'biggestOcean', 4, b'Pacific', int(time.time()) + 60)
+        self.assertEqual(await self.storage.get_many([b'capitalOfChina']), {})
+        await self.storage.flush()
+        results = await self.storage.get_many([b'capitalOfChina', b'biggestOcean'])
+        self.assertEqual(list(results), [b'biggestOcean'])
+        self.assertFalse(await self.storage.delete(b'capitalOfChina'))
+
+    async def testFlushPurgesExpiredRows(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing', int(time.time()) - 1)
+        await self.storage.flush()
+        self.assertEqual(len(self.persistedRows()), 2)
+        self.storage.lastPurge = 0
+        self.storage.set(b'manchesterUnited', 1, b'Ronaldo')
+        await self.storage.flush()
+        self.assertEqual([row[0] for row in self.persistedRows()], ['biggestOcean', 'manchesterUnited'])
+
+    async def testDeleteIsJournaled(self):
+        self.assertTrue(await self.storage.delete(b'biggestOcean'))
+        self.assertFalse(await self.storage.delete(b'biggestOcean'))
+        self.assertFalse(await self.storage.delete(b'manchesterUnited'))
+        self.assertEqual(await self.storage.get_many([b'biggestOcean']), {})
+        self.assertEqual(len(self.persistedRows()), 1)
+        await self.storage.flush()
+        self.assertEqual(self.persistedRows(), [])
+
+    async def testDeleteWithoutExistenceCheck(self):
+        self.assertEqual(self.storage.delete(b'biggestOcean', checkExists=False), None)
+        self.assertEqual(self.storage.journal, {b'biggestOcean': None})
+
+    async def testPerWriteDurability(self):
+        await self.storage.close()
+        self.storage = SqliteStorage(self.databaseFile, durability=SqliteStorage.DURABILITY_PER_WRITE)
+        await self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        self.assertEqual(self.storage.journal, {})
+        self.assertIn(('capitalOfChina', 14, 7, b'Beijing', 0), self.persistedRows())
+        self.assertTrue(await self.storage.delete(b'capitalOfChina'))
+        self.assertNotIn(('capitalOfChina', 14, 7, b'Beijing', 0), self.persistedRows())
+
+    async def testFailedFlushKeepsJournal(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        self.storage.writeRows = MagicMock(side_effect=sqlite3.OperationalError('database is locked'))
+        with self.assertRaises(sqlite3.OperationalError):
+            await self.storage.flush()
+        self.assertEqual(self.storage.journal[b'capitalOfChina'], ('capitalOfChina', 14, 7, b'Beijing', 0))
+        self.assertNotEqual(self.storage.flushHandle, None)
+        del self.storage.writeRows
+
+    async def testCloseFlushesJournal(self):
+        self.storage.set(b'capitalOfChina', 14, b'Beijing')
+        await self.storage.close()
+        self.assertIn(('capitalOfChina', 14, 7, b'Beijing', 0), self.persistedRows())
+        self.storage = SqliteStorage(self.databaseFile)
+
+
+class TestShardedSqliteStorage(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.temporaryDirectory = tempfile.TemporaryDirectory()
+        self.databaseFiles = shardFiles(os.path.join(self.temporaryDirectory.name, 'database.sqlite'), 3)
+        for databaseFile in self.databaseFiles:
+            connection = sqlite3.connect(databaseFile)
+            connection.execute(TestSqliteStorage.CREATE_KEYS_TABLE)
+            connection.close()
+        self.storage = ShardedSqliteStorage(self.databaseFiles)
+
+    async def asyncTearDown(self):
+        await self.storage.close()
+        self.temporaryDirectory.cleanup()
+
+    def persistedKeys(self, databaseFile):
+        connection = sqlite3.connect(databaseFile)
+        keys = [row[0] for row in connection.execute(""" SELECT key FROM keysTable ORDER BY key """)]
+        connection.close()
+        return keys
+
+    def testShardFiles(self):
+        self.assertEqual(shardFiles('/data/database.sqlite', 1), ['/data/database.sqlite'])
+        self.assertEqual(shardFiles('/data/database.sqlite', 3),
+                         ['/data/database.sqlite', '/data/database-1.sqlite', '/data/database-2.sqlite'])
+
+    def testKeysAreSpreadOverTheShards(self):
+        counts = [0] * 3
+        for index in range(3000):
+            counts[keyShard(b'key%d' % index, 3)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts), counts)
+
+    async def testWritesAndReadsAreRouted(self):
+        keys = [b'key%d' % index for index in range(30)]
+        for key in keys:
+            self.storage.set(key, 0, key.upper())
+        self.assertEqual(self.storage.journaledWrites(), 30)
+        await self.storage.flush()
+        self.assertEqual(self.storage.journaledWrites(), 0)
+        for shardIndex, databaseFile in enumerate(self.databaseFiles):
+            shardKeys = sorted(key.decode() for key in keys if keyShard(key, 3) == shardIndex)
+            self.assertTrue(shardKeys)
+            self.assertEqual(self.persistedKeys(databaseFile), shardKeys)
+        results = await self.storage.get_many(keys + [b'missing'])
+        self.assertEqual(results, {key: (0, key.upper(), 0) for key in keys})
+        self.assertTrue(await self.storage.delete(keys[0]))
+        self.assertEqual(await self.storage.get_many(keys[:1]), {})
@@ -0,0 +1,55 @@
+import unittest
+from unittest.mock import MagicMock
+from workerpeers import PeerConnection, WorkerPeers, keyOwner, replyEnd
+
+
+class TestWorkerPeers(unittest.IsolatedAsyncioTestCase):
+
+    def testKeyOwner(self):
+        self.assertEqual(keyOwner(b'capitalOfChina', 2), 0)
+        self.assertEqual(keyOwner(b'capitalOfFrance', 2), 1)
+        self.assertEqual(keyOwner(b'capitalOfFrance', 1), 0)
+
+    def testIsLocal(self):
+        peers = WorkerPeers(11211, 1, 2)
+        self.assertTrue(peers.isLocal(b'capitalOfFrance'))
+        self.assertFalse(peers.isLocal(b'capitalOfChina'))
+        self.assertEqual(peers.owner(b'capitalOfChina'), 0)
+
+    def testReplyEndSingleLine(self):
+        self.assertEqual(replyEnd(bytearray(b'STORED\r\nDELETED\r\n'), 0, False), 8)
+        self.assertEqual(replyEnd(bytearray(b'STORED\r\nDELETED\r\n'), 8, False), 17)
+        self.assertEqual(replyEnd(bytearray(b'STOR'), 0, False), -1)
+
+    def testReplyEndMultiLine(self):
+        reply = bytearray(b'VALUE capitalOfChina 2 9\r\nBei\r\njing\r\nEND\r\n')
+        self.assertEqual(replyEnd(reply, 0, True), len(reply))
+        self.assertEqual(replyEnd(reply[:-3], 0, True), -1)
+        self.assertEqual(replyEnd(reply[:30], 0, True), -1)
+        self.assertEqual(replyEnd(bytearray(b'SERVER_ERROR error retrieving stored data\r\n'), 0, True), 43)
+
+    def testReplyEndMetaValue(self):
+        reply = bytearray(b'VA 9 O1\r\nBei\r\njing\r\nHD\r\n')
+        self.assertEqual(replyEnd(reply, 0, False), 20)
+        self.assertEqual(replyEnd(reply, 20, False), 24)
+        self.assertEqual(replyEnd(reply[:15], 0, False), -1)
+
+    async def testPeerConnectionResolvesRepliesInOrder(self):
+        connection = PeerConnection()
+        connection.connection_made(MagicMock())
+        stored = connection.request(b'set capitalOfChina 2 0 7\r\nBeijing\r\n')
+        values = connection.request(b'get capitalOfChina\r\n', multiLine=True)
+        connection.data_received(b'STORED\r\nVALUE capitalOfChina 2 7\r\nBei')
+        self.assertEqual(await stored, b'STORED\r\n')
+        self.assertFalse(values.done())
+        connection.data_received(b'jing\r\nEND\r\n')
+        self.assertEqual(await values, b'VALUE capitalOfChina 2 7\r\nBeijing\r\nEND\r\n')
+        self.assertEqual(connection.receiveBuffer, bytearray())
+
+    async def testPeerConnectionLost(self):
+        connection = PeerConnection()
+        connection.connection_made(MagicMock())
+        stored = connection.request(b'set capitalOfChina 2 0 7\r\nBeijing\r\n')
+        connection.connection_lost(None)
+        with self.assertRaises(ConnectionError):
+            await stored
@@ -0,0 +1,160 @@
+# Connections between the memcached worker processes
+import asyncio
+from collections import deque
+
+# Hash the keys to the worker that owns them
+import zlib
+
+# Unix socket paths of the workers
+import os.path
+import tempfile
+
+def keyOwner(key, workerCount):
+    """Index of the worker that owns a key
+    :param key: bytestring key
+    :param workerCount: number of worker processes
+    :return: worker index
+    """
+    return zlib.crc32(key) % workerCount
+
+def peerSocketPath(port, workerIndex):
+    """Path of the unix socket a worker listens on for the commands forwarded by the other workers
+    :param port: port the workers serve the clients on
+    :param workerIndex: index of the worker
+    :return: socket path
+    """
+    return os.path.join(tempfile.gettempdir(), 'memcached-{}-worker-{}.sock'.format(port, workerIndex))
+
+def replyEnd(buffer, start, multiLine):
+    """Find the end of a text protocol reply
+    :param buffer: bytearray of received replies
+    :param start: offset the reply starts at
+    :param multiLine: whether the reply is made of VALUE or STAT lines terminated by END
+    :return: offset right after the reply, including the value of a VA reply, or -1 if the reply isn't complete yet
+    """
+    position = start
+    while True:
+        lineEnd = buffer.find(b'\r\n', position)
+        if lineEnd == -1:
+            return -1
+        line = buffer[position:lineEnd]
+        position = lineEnd + 2
+        if line.startswith(b'VA '):
+            # Meta command reply followed by its value
+            position += int(line.split()[1]) + 2
+            return position if position <= len(buffer) else -1
+        if not multiLine:
+            return position
+        if line.startswith(b'VALUE '):
+            position += int(line.split()[3]) + 2
+            if position > len(buffer):
+                return -1
+        elif not line.startswith(b'STAT '):
+            return position
+
+class PeerConnection(asyncio.Protocol):
+    """Pipelined text protocol connection to another worker
+    Replies come back in the order the commands were sent so each one resolves the oldest pending future
+    """
+    def __init__(self):
+        self.transport = None
+        self.pendingReplies = deque() # (future, multiLine)
+        self.receiveBuffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        while self.pendingReplies:
+            future, multiLine = self.pendingReplies.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError('connection to the worker was lost'))
+
+    def data_received(self, data):
+        self.receiveBuffer += data
+        offset = 0
+        while self.pendingReplies:
+            future, multiLine = self.pendingReplies[0]
+            end = replyEnd(self.receiveBuffer, offset, multiLine)
+            if end == -1:
+                break
+            self.pendingReplies.popleft()
+            if not future.done():
+                future.set_result(bytes(self.receiveBuffer[offset:end]))
+            offset = end
+        del self.receiveBuffer[:offset]
+
+    def isOpen(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    def request(self, data, multiLine=False):
+        """Send a command to the worker, commands are never sent with noreply so every one gets a reply
+        :param data: bytestring of the command line and its data block
+        :param multiLine: whether the reply is made of VALUE or STAT lines terminated by END
+        :return: future of the reply bytes
+        """
+        self.transport.write(data)
+        future = asyncio.get_running_loop().create_future()
+        self.pendingReplies.append((future, multiLine))
+        return future
+
+class WorkerPeers:
+    """Key ownership of one worker process among the workers sharing the client port
+    Every key is owned by a single worker so the in memory items stay coherent,
+    the commands for keys owned by another worker are forwarded to it over its unix socket
+    """
+    def __init__(self, port, workerIndex, workerCount):
+        """
+        :param port: port the workers serve the clients on
+        :param workerIndex: index of this worker
+        :param workerCount: number of worker processes
+        :no return:
+        """
+        self.port = port
+        self.workerIndex = workerIndex
+        self.workerCount = workerCount
+        self.connections = {}
+        self.connecting = {}
+
+    def owner(self, key):
+        return keyOwner(key, self.workerCount)
+
+    def isLocal(self, key):
+        return keyOwner(key, self.workerCount) == self.workerIndex
+
+    async def connection(self, workerIndex):
+        """Open connection to a worker, connecting once if there's none
+        :param workerIndex: index of the worker
+        :return: PeerConnection object
+        """
+        connection = self.connections.get(workerIndex)
+        if connection is not None and connection.isOpen():
+            return connection
+
+        connecting = self.connecting.get(workerIndex)
+        if connecting is None:
+            loop = asyncio.get_running_loop()
+            connecting = asyncio.ensure_future(loop.create_unix_connection(PeerConnection, peerSocketPath(self.port, workerIndex)))
+            self.connecting[workerIndex] = connecting
+        try:
+            transport, connection = await connecting
+        finally:
+            if self.connecting.get(workerIndex) is connecting:
+                del self.connecting[workerIndex]
+        self.connections[workerIndex] = connection
+        return connection
+
+    async def forward(self, workerIndex, data, multiLine=False):
+        """Forward a command to the worker that owns its keys
+        :param workerIndex: index of the worker
+        :param data: bytestring of the command line and its data block
+        :param multiLine: whether the reply is made of VALUE or STAT lines terminated by END
+        :return: bytestring of the reply
+        """
+        connection = await self.connection(workerIndex)
+        return await connection.request(data, multiLine)
+
+    def close(self):
+        for connection in self.connections.values():
+            if connection.isOpen():
+                connection.transport.close()